@@ -43,6 +43,33 @@ def argument_parser():
     )
     parser.add_argument("--height", type=int, default=128, help="height of an image")
     parser.add_argument("--width", type=int, default=256, help="width of an image")
+    parser.add_argument(
+        "--image-cache-dir",
+        type=str,
+        default="",
+        help="directory to cache images decoded and resized to height x width, "
+        "built once and memory-mapped (disabled if empty)",
+    )
+    parser.add_argument(
+        "--jpeg-draft",
+        action="store_true",
+        help="decode JPEGs at the smallest DCT scale that is at least height x width "
+        "instead of full resolution, faster but check rank1/mAP parity first, see "
+        "benchmarks/decode_bench.py",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        type=str,
+        default="",
+        help="directory of the datasets packed by tools.pack_shards, read instead "
+        "of the image files (disabled if empty)",
+    )
+    parser.add_argument(
+        "--dataset-norm",
+        action="store_true",
+        help="normalize images with the mean and std of the train images, "
+        "computed once per dataset and resolution (ImageNet values otherwise)",
+    )
     parser.add_argument(
         "--train-sampler",
         type=str,
@@ -68,6 +95,12 @@ def argument_parser():
         action="store_true",
         help="randomly alter the intensities of RGB channels",
     )
+    parser.add_argument(
+        "--batch-augment",
+        action="store_true",
+        help="decode training images to uint8 in the dataloader workers and run "
+        "color augmentation, normalization and random erasing on whole batches",
+    )
 
     # ************************************************************
     # Optimization options
@@ -170,6 +203,14 @@ def argument_parser():
     parser.add_argument(
         "--margin", type=float, default=0.3, help="margin for triplet loss"
     )
+    parser.add_argument(
+        "--triplet-mining",
+        type=str,
+        default="hard",
+        choices=["hard", "batch_all", "semi_hard"],
+        help="triplets of the triplet loss: hardest positive and negative of every "
+        "anchor, all triplets with a positive loss, or semi-hard negatives",
+    )
     parser.add_argument(
         "--num-instances", type=int, default=4, help="number of instances per identity"
     )
@@ -193,6 +234,14 @@ def argument_parser():
     parser.add_argument(
         "--no-pretrained", action="store_true", help="do not load pretrained weights"
     )
+    parser.add_argument(
+        "--partial-fc",
+        type=float,
+        default=0,
+        help="train the classifier on the identities of the batch plus random other "
+        "identities, this fraction of all of them per step, with sparse gradients "
+        "and updates of their rows only (0 for the full softmax)",
+    )
 
     # ************************************************************
     # Test settings
@@ -220,9 +269,82 @@ def argument_parser():
         "--test_size",
         type=int,
         default=800,
-        help="test-size for vehicleID dataset, choices=[800,1600,2400]",
+        choices=[800, 1600, 2400, 3200, 6000, 13164],
+        help="test-size for vehicleID dataset",
     )
     parser.add_argument("--query-remove", type=bool, default=True)
+    parser.add_argument(
+        "--vehicleid-splits",
+        type=int,
+        default=0,
+        help="evaluate vehicleID as the mean and std over this many random gallery "
+        "selections of a single feature extraction (0 to use the dataset's split)",
+    )
+    parser.add_argument(
+        "--eval-workers",
+        type=int,
+        default=1,
+        help="number of parallel workers for evaluation: random VehicleID splits, "
+        "or target datasets whose metrics are computed in worker processes while "
+        "the features of the next target are extracted",
+    )
+    parser.add_argument(
+        "--eval-method",
+        type=str,
+        default="sort",
+        choices=["sort", "count"],
+        help="compute CMC/mAP by sorting every gallery (sort) or by counting the "
+        "gallery samples ranked in front of each correct match (count)",
+    )
+    parser.add_argument(
+        "--eval-block-size",
+        type=int,
+        default=256,
+        help="number of queries whose distances are computed and evaluated at a time "
+        "(0 or less to build the full query-by-gallery distance matrix)",
+    )
+    parser.add_argument(
+        "--feature-cache-dir",
+        type=str,
+        default="",
+        help="directory to cache query/gallery features, which are reused as long as "
+        "the weights, arch, image size and image list are unchanged",
+    )
+    parser.add_argument(
+        "--normalize-feature",
+        action="store_true",
+        help="L2-normalize features at extraction and rank with cosine distance",
+    )
+    parser.add_argument(
+        "--feature-dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "bfloat16"],
+        help="precision in which features are stored and distances are computed",
+    )
+    parser.add_argument(
+        "--precision-drift",
+        action="store_true",
+        help="also evaluate float32 features to report the rank1/mAP drift of "
+        "--feature-dtype, in the same way, e.g. on a product-quantized gallery",
+    )
+    parser.add_argument(
+        "--pq-subvectors",
+        type=int,
+        default=0,
+        help="evaluate on a product-quantized gallery with this many sub-vectors per "
+        "feature (0 to disable)",
+    )
+    parser.add_argument(
+        "--pq-bits", type=int, default=8, help="bits per product quantization code"
+    )
+    parser.add_argument(
+        "--pq-train-size",
+        type=int,
+        default=20000,
+        help="number of training images to learn the product quantizer from "
+        "(0 for all)",
+    )
     # ************************************************************
     # Miscs
     # ************************************************************
@@ -239,11 +361,26 @@ def argument_parser():
         "--save-dir", type=str, default="log", help="path to save log and model weights"
     )
     parser.add_argument("--use-cpu", action="store_true", help="use cpu")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16"],
+        help="precision of the forward pass in training and feature extraction, "
+        "with autocast (losses and weights stay in float32)",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="use the channels_last memory format for the model and images, "
+        "faster for conv backbones, notably in bfloat16",
+    )
     parser.add_argument(
         "--gpu-devices",
         default="0",
         type=str,
-        help="gpu device ids for CUDA_VISIBLE_DEVICES",
+        help="gpu device ids for CUDA_VISIBLE_DEVICES (ignored under torchrun, where "
+        "every process uses the GPU of its local rank)",
     )
 
     parser.add_argument(
@@ -256,6 +393,14 @@ def argument_parser():
         action="store_true",
         help="use available gpus instead of specified devices (useful when using managed clusters)",
     )
+    parser.add_argument(
+        "--dist-backend",
+        type=str,
+        default="",
+        help="torch.distributed backend when launched with torchrun, one process "
+        "per device or CPU share (nccl on GPU and gloo on CPU if empty); "
+        "--train-batch-size is then the batch size of every process",
+    )
     return parser
 
 
@@ -271,13 +416,20 @@ def dataset_kwargs(parsed_args):
         "split_id": parsed_args.split_id,
         "height": parsed_args.height,
         "width": parsed_args.width,
+        "image_cache_dir": parsed_args.image_cache_dir,
+        "jpeg_draft": parsed_args.jpeg_draft,
+        "shard_dir": parsed_args.shard_dir,
+        "dataset_norm": parsed_args.dataset_norm,
+        "test_size": parsed_args.test_size,
         "train_batch_size": parsed_args.train_batch_size,
         "test_batch_size": parsed_args.test_batch_size,
         "workers": parsed_args.workers,
         "train_sampler": parsed_args.train_sampler,
+        "num_instances": parsed_args.num_instances,
         "random_erase": parsed_args.random_erase,
         "color_jitter": parsed_args.color_jitter,
         "color_aug": parsed_args.color_aug,
+        "batch_augment": parsed_args.batch_augment,
     }
 
 
@@ -0,0 +1,80 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Images/sec of the training augmentation (color augmentation, normalization and
+random erasing) run per sample, as in the dataloader workers, against the batch
+stage of --batch-augment, where workers only convert to uint8 tensors and the
+collated batch is augmented at once. Images are already resized, so decoding and
+resizing, which both paths share, are not measured.
+
+Usage: python -m benchmarks.augment_bench [--device cuda]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data.dataloader import default_collate
+
+from src.transforms import build_batch_transform, build_transforms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=128)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    imgs = [
+        Image.fromarray(
+            rng.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+        )
+        for _ in range(max(args.batch_size))
+    ]
+    kwargs = dict(random_erase=True, color_aug=True)
+    per_sample, _ = build_transforms(args.height, args.width, **kwargs)
+    to_uint8, _ = build_transforms(
+        args.height, args.width, batch_augment=True, **kwargs
+    )
+    batch_transform = build_batch_transform(**kwargs)
+
+    def run_per_sample(batch):
+        return default_collate([per_sample(img) for img in batch]).to(args.device)
+
+    def run_batch(batch):
+        return batch_transform(
+            default_collate([to_uint8(img) for img in batch]).to(args.device)
+        )
+
+    print(
+        f"{'batch size':>10} | {'per-sample img/s':>16} | {'batch img/s':>11} | "
+        f"{'speedup':>7} | {'mean diff':>9}"
+    )
+    for batch_size in args.batch_size:
+        batch = imgs[:batch_size]
+        results = []
+        for fn in (run_per_sample, run_batch):
+            fn(batch)  # warm up
+            start = time.perf_counter()
+            for _ in range(args.iters):
+                out = fn(batch)
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            results.append(
+                (args.iters * batch_size / (time.perf_counter() - start), out)
+            )
+        (ips_sample, out_sample), (ips_batch, out_batch) = results
+        print(
+            f"{batch_size:10d} | {ips_sample:16.0f} | {ips_batch:11.0f} | "
+            f"{ips_batch / ips_sample:6.1f}x | "
+            f"{(out_batch.mean() - out_sample.mean()).abs().item():9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
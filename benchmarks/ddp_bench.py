@@ -0,0 +1,114 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Training throughput (images/sec) of DistributedDataParallel with 1, 2 and 4
+processes on one machine, as launched by torchrun. Every process trains on its
+own synthetic batches of --batch-size images (the batch size of a process, as
+with --train-batch-size), with cross entropy and triplet losses, and the CPU
+threads are divided among the processes so that all runs use the same cores.
+Data loading is not measured.
+
+Usage: python -m benchmarks.ddp_bench [--world-size 1 2 4] [--arch resnet18]
+"""
+
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from src import models
+from src.losses import CrossEntropyLoss, TripletLoss
+
+NUM_CLASSES = 100
+
+
+def run(rank, world_size, args, num_threads, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port + world_size)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(rank)
+
+    model = models.init_model(
+        name=args.arch,
+        num_classes=NUM_CLASSES,
+        loss={"xent", "htri"},
+        pretrained=False,
+        use_gpu=False,
+    )
+    model = nn.parallel.DistributedDataParallel(model)
+    model.train()
+    criterion_xent = CrossEntropyLoss(num_classes=NUM_CLASSES, use_gpu=False)
+    criterion_htri = TripletLoss(margin=0.3)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+
+    imgs = torch.randn(args.batch_size, 3, args.height, args.width)
+    # P x K batches, as drawn by RandomIdentitySampler
+    pids = torch.arange(args.batch_size) // 4 + rank * args.batch_size
+
+    def step():
+        outputs, features = model(imgs)
+        loss = criterion_xent(outputs, pids % NUM_CLASSES) + criterion_htri(
+            features, pids
+        )
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(args.warmup):
+        step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        step()
+    dist.barrier()
+    if rank == 0:
+        elapsed = time.perf_counter() - start
+        results[world_size] = world_size * args.batch_size * args.iters / elapsed
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world-size", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--arch", type=str, default="resnet18")
+    parser.add_argument("--height", type=int, default=128)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--port", type=int, default=29600)
+    args = parser.parse_args()
+
+    num_cpus = os.cpu_count()
+    results = mp.Manager().dict()
+    print(
+        f"{'processes':>9} | {'threads/proc':>12} | {'img/s':>7} | "
+        f"{'speedup':>7} | {'efficiency':>10}"
+    )
+    for world_size in args.world_size:
+        num_threads = max(1, num_cpus // world_size)
+        mp.spawn(
+            run,
+            args=(world_size, args, num_threads, results),
+            nprocs=world_size,
+            join=True,
+        )
+        speedup = results[world_size] / results[args.world_size[0]]
+        print(
+            f"{world_size:9d} | {num_threads:12d} | {results[world_size]:7.1f} | "
+            f"{speedup:6.2f}x | "
+            f"{speedup * args.world_size[0] / world_size:9.0%}"
+        )
+    if num_cpus < max(args.world_size):
+        print(
+            f"Only {num_cpus} CPUs: processes beyond that share cores and cannot "
+            "scale"
+        )
+
+
+if __name__ == "__main__":
+    main()
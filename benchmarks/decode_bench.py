@@ -0,0 +1,89 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Decode + resize throughput of read_image at full resolution against reduced
+resolution JPEG decoding (draft_size, with --jpeg-draft), on synthetic
+JPEGs of several sizes, with the mean absolute difference of the resized images.
+
+Whether rank-1/mAP are unchanged is checked on the real data by evaluating the
+same weights with and without the flag (the feature cache keys differ):
+    python main.py -s veri -t veri --evaluate --load-weights <path>
+    python main.py -s veri -t veri --evaluate --load-weights <path> --jpeg-draft
+
+Usage: python -m benchmarks.decode_bench [--height 128 --width 256]
+"""
+
+import argparse
+import os.path as osp
+import tempfile
+import time
+
+import numpy as np
+import torchvision.transforms as T
+from PIL import Image
+
+from src.dataset_loader import read_image
+
+
+def synthetic_jpeg(path, width, height, seed):
+    # smooth gradients plus noise compress like photos, unlike pure noise
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack(
+        [
+            128
+            + 100
+            * np.sin(x / rng.uniform(10, 60) + c)
+            * np.cos(y / rng.uniform(10, 60))
+            for c in range(3)
+        ],
+        2,
+    )
+    img += rng.normal(0, 8, img.shape)
+    Image.fromarray(img.clip(0, 255).astype(np.uint8)).save(path, quality=90)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=128)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        nargs="+",
+        default=["320x240", "640x480", "1280x960", "1920x1080"],
+        help="image sizes (width x height)",
+    )
+    parser.add_argument("--num-images", type=int, default=50)
+    args = parser.parse_args()
+
+    to_tensor = T.Compose([T.Resize((args.height, args.width)), T.ToTensor()])
+    draft_size = (args.height, args.width)
+    print(
+        f"{'image size':>10} | {'decoded at':>10} | {'full img/s':>10} | "
+        f"{'draft img/s':>11} | {'speedup':>7} | {'mean abs diff':>13}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            width, height = map(int, size.split("x"))
+            paths = [
+                osp.join(tmp_dir, f"{size}_{i}.jpg") for i in range(args.num_images)
+            ]
+            for i, path in enumerate(paths):
+                synthetic_jpeg(path, width, height, i)
+
+            results = []
+            for draft in (None, draft_size):
+                start = time.perf_counter()
+                imgs = [to_tensor(read_image(path, draft)) for path in paths]
+                results.append((len(paths) / (time.perf_counter() - start), imgs))
+            (ips_full, full), (ips_draft, drafted) = results
+            decoded = read_image(paths[0], draft_size).size
+            diff = np.mean([(a - b).abs().mean().item() for a, b in zip(full, drafted)])
+            print(
+                f"{size:>10} | {'{}x{}'.format(*decoded):>10} | {ips_full:10.0f} | "
+                f"{ips_draft:11.0f} | {ips_draft / ips_full:6.1f}x | {diff:13.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
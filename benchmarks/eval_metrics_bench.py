@@ -0,0 +1,84 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Compare the blocked CMC/mAP evaluation in src/eval_metrics.py ("sort" and
+"count" methods) with the original per-query loops on synthetic query x gallery
+sets. Peak memory is the NumPy allocation peak reported by tracemalloc.
+
+Usage: python -m benchmarks.eval_metrics_bench
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from src.eval_metrics import eval_ranks
+
+from .reference import reference_eval, squared_euclidean, synthetic_reid_set
+
+
+def _timeit(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def _peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        nargs="+",
+        default=["200x1000", "1000x5000", "1678x11579"],
+        help="query x gallery sizes",
+    )
+    parser.add_argument("--num-pids", type=int, default=200)
+    parser.add_argument("--block-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        f"{'size':>12} | {'metric':>9} | {'method':>6} | {'time (s)':>8} "
+        f"| {'speedup':>7} | {'peak MB':>8} | {'max |dCMC|':>10} | {'|dmAP|':>8}"
+    )
+    for size in args.sizes:
+        num_q, num_g = map(int, size.split("x"))
+        qf, gf, q_pids, g_pids, q_camids, g_camids = synthetic_reid_set(
+            num_q, num_g, args.num_pids
+        )
+        distmat = squared_euclidean(qf, gf)
+        for metric, remove_junk in (("veri", True), ("vehicleid", False)):
+            inputs = (distmat, q_pids, g_pids, q_camids, g_camids, 50, remove_junk)
+            t_loop, (cmc_ref, mAP_ref) = _timeit(
+                lambda: reference_eval(*inputs), args.repeats
+            )
+            print(f"{size:>12} | {metric:>9} | {'loop':>6} | {t_loop:8.3f} |")
+            for method in ("sort", "count"):
+
+                def run():
+                    return eval_ranks(
+                        *inputs, block_size=args.block_size, method=method
+                    )
+
+                t, (cmc, mAP) = _timeit(run, args.repeats)
+                print(
+                    f"{size:>12} | {metric:>9} | {method:>6} | {t:8.3f} "
+                    f"| {t_loop / t:6.1f}x | {_peak_memory(run):8.1f} "
+                    f"| {np.abs(cmc - cmc_ref).max():10.2e} | {abs(mAP - mAP_ref):8.1e}"
+                )
+
+
+if __name__ == "__main__":
+    main()
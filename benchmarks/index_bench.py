@@ -0,0 +1,137 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Recall@k and queries/sec of the gallery indexes in src/retrieval, checked against
+the exact evaluation of src/eval_metrics.py.
+
+Features are read from the entries written by main.py with --feature-cache-dir
+(the entry keys are printed when they are written or loaded), e.g. for VeRi:
+    python -m benchmarks.index_bench --feature-cache-dir log/features \
+        --query-key <key> --gallery-key <key>
+Product quantizers are learned from --train-key features if given (the training
+set, extracted by main.py with --pq-subvectors), otherwise from the gallery.
+Without keys, a synthetic VeRi-sized set is used.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from src.eval_metrics import evaluate, evaluate_features, evaluate_index
+from src.feature_store import FeatureStore
+from src.retrieval import init_index
+
+from .reference import synthetic_reid_set
+
+
+def load_features(args):
+    if args.query_key and args.gallery_key:
+        store = FeatureStore(args.feature_cache_dir)
+        qf, q_pids, q_camids = store.load(args.query_key)
+        gf, g_pids, g_camids = store.load(args.gallery_key)
+        return qf.float(), gf.float(), q_pids, g_pids, q_camids, g_camids
+    print("No feature cache keys given, using synthetic features")
+    qf, gf, q_pids, g_pids, q_camids, g_camids = synthetic_reid_set(1678, 11579, 200)
+    return (
+        torch.from_numpy(qf),
+        torch.from_numpy(gf),
+        q_pids,
+        g_pids,
+        q_camids,
+        g_camids,
+    )
+
+
+def topk_to_distmat(distances, indices, num_g):
+    """Dense distance matrix in which gallery samples that were not retrieved are
+    ranked last, so that the standard evaluation can score the retrieved lists."""
+    distmat = torch.full((indices.size(0), num_g), float("inf"))
+    found = indices >= 0
+    rows = torch.arange(indices.size(0)).unsqueeze(1).expand_as(indices)
+    distmat[rows[found], indices[found]] = distances[found]
+    return distmat.numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--feature-cache-dir", type=str, default="log/features")
+    parser.add_argument("--query-key", type=str, default="")
+    parser.add_argument("--gallery-key", type=str, default="")
+    parser.add_argument("--train-key", type=str, default="")
+    parser.add_argument("-k", type=int, default=50, help="number of neighbours")
+    parser.add_argument("--nlist", type=int, nargs="+", default=[64, 256])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--pq-subvectors", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--pq-bits", type=int, default=8)
+    args = parser.parse_args()
+
+    qf, gf, q_pids, g_pids, q_camids, g_camids = load_features(args)
+    num_q, num_g = qf.size(0), gf.size(0)
+    print(f"# query: {num_q}, # gallery: {num_g}, dim: {qf.size(1)}")
+
+    cmc, mAP = evaluate_features(qf, gf, q_pids, g_pids, q_camids, g_camids)
+    print(f"exact evaluate: rank1 {cmc[0]:.1%} rank5 {cmc[4]:.1%} mAP {mAP:.1%}")
+
+    def run(index):
+        start = time.perf_counter()
+        distances, indices = index.search(qf, args.k)
+        qps = num_q / (time.perf_counter() - start)
+        return qps, distances, indices
+
+    flat = init_index("flat").build(gf)
+    flat_results = run(flat)
+    exact_ids = flat_results[2].numpy()
+
+    print(
+        f"{'index':>22} | {'bytes/vec':>9} | {'build (s)':>9} | {'QPS':>9} "
+        f"| {'recall@k':>8} | {'rank1':>6} | {'rank5':>6} | {'mAP@k':>6}"
+    )
+
+    def report(name, code_size, build_time, qps, distances, indices):
+        ids = indices.numpy()
+        recall = np.mean(
+            [len(np.intersect1d(a, b)) / len(b) for a, b in zip(ids, exact_ids)]
+        )
+        distmat = topk_to_distmat(distances, indices, num_g)
+        cmc_k, mAP_k = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+        print(
+            f"{name:>22} | {code_size:9d} | {build_time:9.2f} | {qps:9.0f} "
+            f"| {recall:8.3f} | {cmc_k[0]:6.1%} | {cmc_k[4]:6.1%} | {mAP_k:6.1%}"
+        )
+
+    raw_size = gf.size(1) * gf.element_size()
+    report("flat", raw_size, 0.0, *flat_results)
+    for nlist in args.nlist:
+        start = time.perf_counter()
+        ivf = init_index("ivf", nlist=nlist).build(gf)
+        build_time = time.perf_counter() - start
+        for nprobe in args.nprobe:
+            if nprobe > nlist:
+                continue
+            ivf.nprobe = nprobe
+            report(
+                f"ivf nlist={nlist} nprobe={nprobe}", raw_size, build_time, *run(ivf)
+            )
+
+    if args.train_key:
+        tf = FeatureStore(args.feature_cache_dir).load(args.train_key)[0].float()
+    else:
+        tf = gf
+    for num_subvectors in args.pq_subvectors:
+        start = time.perf_counter()
+        pq = init_index("pq", num_subvectors=num_subvectors, nbits=args.pq_bits)
+        pq.train(tf)
+        pq.add(gf)
+        build_time = time.perf_counter() - start
+        report(f"pq m={num_subvectors}", pq.code_size, build_time, *run(pq))
+        # full (non top-k) evaluation on the compressed gallery
+        cmc_pq, mAP_pq = evaluate_index(qf, pq, q_pids, g_pids, q_camids, g_camids)
+        print(
+            f"{'':>22}   evaluate on PQ gallery: rank1 {cmc_pq[0]:.1%} "
+            f"mAP {mAP_pq:.1%} (exact {mAP:.1%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Training step time of --precision bfloat16 (autocast) and --channels-last against
+float32, and the rank-1/mAP parity of the features they extract. Images are
+synthetic: every identity is a random smooth image seen under noise, so that even
+an untrained model ranks them better than chance. Use --load-weights to measure
+parity on trained weights instead.
+
+Usage: python -m benchmarks.precision_bench [--arch resnet50] [--device cuda]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src import models
+from src.eval_metrics import evaluate_features
+from src.losses import CrossEntropyLoss, TripletLoss
+from src.utils.torchtools import autocast_context, load_pretrained_weights
+
+CONFIGS = [
+    ("float32", False),
+    ("float32", True),
+    ("bfloat16", False),
+    ("bfloat16", True),
+]
+
+
+def make_images(num_ids, num_imgs, height, width, generator):
+    """Return (num_ids * num_imgs, 3, height, width) images and their pids"""
+    bases = torch.randn(num_ids, 3, height // 8, width // 8, generator=generator)
+    bases = F.interpolate(bases, size=(height, width), mode="bilinear")
+    imgs = bases.repeat_interleave(num_imgs, 0)
+    imgs += torch.randn(imgs.size(), generator=generator)
+    return imgs, torch.arange(num_ids).repeat_interleave(num_imgs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", type=str, default="resnet18")
+    parser.add_argument("--load-weights", type=str, default="")
+    parser.add_argument("--height", type=int, default=128)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--num-ids", type=int, default=100)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    use_gpu = args.device.startswith("cuda")
+    generator = torch.Generator().manual_seed(0)
+    num_classes = args.batch_size // 4
+    model = models.init_model(
+        name=args.arch,
+        num_classes=num_classes,
+        loss={"xent", "htri"},
+        pretrained=False,
+        use_gpu=use_gpu,
+    )
+    if args.load_weights:
+        load_pretrained_weights(model, args.load_weights)
+    model = model.to(args.device)
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    criterion_xent = CrossEntropyLoss(num_classes=num_classes, use_gpu=use_gpu)
+    criterion_htri = TripletLoss(margin=0.3)
+
+    train_imgs, train_pids = make_images(
+        num_classes, 4, args.height, args.width, generator
+    )
+    train_imgs, train_pids = train_imgs.to(args.device), train_pids.to(args.device)
+    # query and gallery images of the same identities
+    test_imgs, test_pids = make_images(
+        args.num_ids, 2, args.height, args.width, generator
+    )
+    q_pids, g_pids = test_pids[0::2].numpy(), test_pids[1::2].numpy()
+    # different cameras, so that no gallery sample is discarded
+    q_camids, g_camids = np.zeros_like(q_pids), np.ones_like(g_pids)
+
+    def sync():
+        if use_gpu:
+            torch.cuda.synchronize()
+
+    print(
+        f"{'precision':>9} | {'channels_last':>13} | {'step ms':>7} | "
+        f"{'img/s':>6} | {'rank1':>6} | {'mAP':>6} | {'feat rel err':>12}"
+    )
+    reference = None
+    for precision, channels_last in CONFIGS:
+        model.load_state_dict(state_dict)
+        memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
+        model = model.to(memory_format=memory_format)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9)
+        imgs = train_imgs.contiguous(memory_format=memory_format)
+
+        def step():
+            with autocast_context(precision, use_gpu):
+                outputs, features = model(imgs)
+            loss = criterion_xent(outputs.float(), train_pids) + criterion_htri(
+                features.float(), train_pids
+            )
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        model.train()
+        step()  # warm up
+        sync()
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            step()
+        sync()
+        step_time = (time.perf_counter() - start) / args.iters
+
+        # features of the initial weights, so that every config sees the same model
+        model.load_state_dict(state_dict)
+        model.eval()
+        features = []
+        with torch.no_grad():
+            for batch in test_imgs.split(args.batch_size):
+                batch = batch.to(args.device).contiguous(memory_format=memory_format)
+                with autocast_context(precision, use_gpu):
+                    features.append(model(batch).float().cpu())
+        features = torch.cat(features)
+        if reference is None:
+            reference = features
+        rel_err = ((features - reference).norm(dim=1) / reference.norm(dim=1)).max()
+
+        cmc, mAP = evaluate_features(
+            features[0::2],
+            features[1::2],
+            q_pids,
+            g_pids,
+            q_camids,
+            g_camids,
+            block_size=len(q_pids),
+        )
+        print(
+            f"{precision:>9} | {str(channels_last):>13} | {step_time * 1000:7.1f} | "
+            f"{args.batch_size / step_time:6.1f} | {cmc[0]:6.1%} | {mAP:6.1%} | "
+            f"{rel_err.item():12.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
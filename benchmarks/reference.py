@@ -0,0 +1,94 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import numpy as np
+import torch
+
+
+def reference_eval(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, remove_junk):
+    """Per-query loop evaluation that src/eval_metrics.py used before it was
+    vectorized, kept as the ground truth for the benchmarks."""
+    num_q, num_g = distmat.shape
+    if num_g < max_rank:
+        max_rank = num_g
+
+    indices = np.argsort(distmat, axis=1)
+    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
+
+    all_cmc = []
+    all_AP = []
+    num_valid_q = 0.0
+
+    for q_idx in range(num_q):
+        if remove_junk:
+            order = indices[q_idx]
+            remove = (g_pids[order] == q_pids[q_idx]) & (
+                g_camids[order] == q_camids[q_idx]
+            )
+        else:
+            remove = False
+        keep = np.invert(remove)
+        raw_cmc = matches[q_idx][keep]
+        if not np.any(raw_cmc):
+            continue
+
+        cmc = raw_cmc.cumsum()
+        cmc[cmc > 1] = 1
+
+        all_cmc.append(cmc[:max_rank])
+        num_valid_q += 1.0
+
+        num_rel = raw_cmc.sum()
+        tmp_cmc = raw_cmc.cumsum()
+        tmp_cmc = [x / (i + 1.0) for i, x in enumerate(tmp_cmc)]
+        tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
+        AP = tmp_cmc.sum() / num_rel
+        all_AP.append(AP)
+
+    all_cmc = np.asarray(all_cmc).astype(np.float32)
+    all_cmc = all_cmc.sum(0) / num_valid_q
+    mAP = np.mean(all_AP)
+
+    return all_cmc, mAP
+
+
+def synthetic_reid_set(
+    num_q, num_g, num_pids, num_cams=20, feat_dim=256, noise=2.0, seed=0
+):
+    """Random features clustered by identity, with VeRi-like camera ids."""
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_pids, feat_dim).astype(np.float32)
+    q_pids = rng.randint(num_pids, size=num_q)
+    g_pids = np.concatenate([np.arange(num_pids), rng.randint(num_pids, size=num_g)])
+    g_pids = g_pids[:num_g]
+    q_camids = rng.randint(num_cams, size=num_q)
+    g_camids = rng.randint(num_cams, size=num_g)
+    qf = centers[q_pids] + noise * rng.randn(num_q, feat_dim).astype(np.float32)
+    gf = centers[g_pids] + noise * rng.randn(num_g, feat_dim).astype(np.float32)
+    return qf, gf, q_pids, g_pids, q_camids, g_camids
+
+
+def squared_euclidean(qf, gf):
+    distmat = (qf**2).sum(1, keepdims=True) + (gf**2).sum(1)[np.newaxis, :]
+    distmat -= 2 * qf @ gf.T
+    return distmat
+
+
+def reference_triplet_hard(inputs, targets, margin):
+    """Per-anchor loop hard mining that src/losses/hard_mine_triplet_loss.py used
+    before it was vectorized, kept as the ground truth for the benchmarks."""
+    n = inputs.size(0)
+    dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
+    dist = dist + dist.t()
+    dist.addmm_(inputs, inputs.t(), beta=1, alpha=-2)
+    dist = dist.clamp(min=1e-12).sqrt()
+
+    mask = targets.expand(n, n).eq(targets.expand(n, n).t())
+    dist_ap, dist_an = [], []
+    for i in range(n):
+        dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
+        dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
+    dist_ap = torch.cat(dist_ap)
+    dist_an = torch.cat(dist_an)
+
+    y = torch.ones_like(dist_an)
+    return torch.nn.functional.margin_ranking_loss(dist_an, dist_ap, y, margin=margin)
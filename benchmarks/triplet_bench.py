@@ -0,0 +1,73 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Forward + backward time of the triplet loss at several batch sizes: the original
+per-anchor loop of hard mining against the vectorized hard, batch_all and
+semi_hard mining of --triplet-mining. Batches are P x K, as drawn by
+RandomIdentitySampler.
+
+Usage: python -m benchmarks.triplet_bench [--device cuda]
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.reference import reference_triplet_hard
+from src.losses import TripletLoss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--num-instances", type=int, default=4)
+    parser.add_argument("--feat-dim", type=int, default=2048)
+    parser.add_argument("--margin", type=float, default=0.3)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    def sync():
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    def timeit(fn, inputs, targets):
+        inputs = inputs.clone().requires_grad_()
+        fn(inputs, targets).backward()  # warm up
+        sync()
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            loss = fn(inputs, targets)
+            loss.backward()
+        sync()
+        return (time.perf_counter() - start) / args.iters * 1000, loss.item()
+
+    losses = {
+        mining: TripletLoss(margin=args.margin, mining=mining)
+        for mining in TripletLoss.minings
+    }
+    print(
+        f"{'batch size':>10} | {'loop ms':>7} | {'hard ms':>7} | {'speedup':>7} | "
+        f"{'batch_all ms':>12} | {'semi_hard ms':>12} | {'hard loss diff':>14}"
+    )
+    for batch_size in args.batch_size:
+        torch.manual_seed(0)
+        inputs = torch.randn(batch_size, args.feat_dim, device=args.device)
+        targets = torch.arange(batch_size, device=args.device) // args.num_instances
+
+        loop_ms, loop_loss = timeit(
+            lambda x, t: reference_triplet_hard(x, t, args.margin), inputs, targets
+        )
+        times = {}
+        for mining, criterion in losses.items():
+            times[mining] = timeit(criterion, inputs, targets)
+        hard_ms, hard_loss = times["hard"]
+        print(
+            f"{batch_size:10d} | {loop_ms:7.2f} | {hard_ms:7.2f} | "
+            f"{loop_ms / hard_ms:6.1f}x | {times['batch_all'][0]:12.2f} | "
+            f"{times['semi_hard'][0]:12.2f} | {abs(hard_loss - loop_loss):14.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
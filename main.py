@@ -1,30 +1,49 @@
 # Copyright (c) EEEM071, University of Surrey
 
+import contextlib
 import datetime
+import io
+import multiprocessing
 import os
 import os.path as osp
 import sys
 import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributed.algorithms.join import Join
 from args import argument_parser, dataset_kwargs, optimizer_kwargs, lr_scheduler_kwargs
 from src import models
+from src.models import PartialFC
 from src.data_manager import ImageDataManager
-from src.eval_metrics import evaluate
+from src.distance import compute_distance_matrix, to_numpy
+from src.eval_metrics import (
+    evaluate,
+    evaluate_features,
+    evaluate_index,
+    evaluate_random_splits,
+)
+from src.feature_store import FeatureStore, hash_state_dict
 from src.losses import CrossEntropyLoss, TripletLoss, DeepSupervision
 from src.lr_schedulers import init_lr_scheduler
 from src.optimizers import init_optimizer
+from src.retrieval import init_index
+from src.transforms import get_normalization
 from src.utils.avgmeter import AverageMeter
-from src.utils.generaltools import set_random_seed
+from src.utils.generaltools import peak_memory_mb, set_random_seed
 from src.utils.iotools import check_isfile
 from src.utils.loggers import Logger, RankLogger
 from src.utils.torchtools import (
     count_num_param,
     accuracy,
+    autocast_context,
+    is_main_process,
     load_pretrained_weights,
     save_checkpoint,
     resume_from_checkpoint,
@@ -41,22 +60,46 @@ def main():
     global args
 
     set_random_seed(args.seed)
-    if not args.use_avai_gpus:
+    # launched by torchrun, which sets the rank and world size of every process
+    distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    # every rank uses the GPU of its local rank among all the available ones
+    # (restrict them with CUDA_VISIBLE_DEVICES on the torchrun command)
+    if not args.use_avai_gpus and not distributed:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_devices
     use_gpu = torch.cuda.is_available()
     if args.use_cpu:
         use_gpu = False
+
+    if distributed:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        if use_gpu:
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group(args.dist_backend or ("nccl" if use_gpu else "gloo"))
+        if not is_main_process():
+            # rank 0 logs, evaluates and saves checkpoints
+            sys.stdout = open(os.devnull, "w")
+
     log_name = "log_test.txt" if args.evaluate else "log_2_1_ColAug.txt"
-    sys.stdout = Logger(osp.join(args.save_dir, log_name))
+    if is_main_process():
+        sys.stdout = Logger(osp.join(args.save_dir, log_name))
     print("==========")
-    student_id = os.environ.get('STUDENT_ID', '<your id>')
-    student_name = os.environ.get('STUDENT_NAME', '<your name>')
+    student_id = os.environ.get("STUDENT_ID", "<your id>")
+    student_name = os.environ.get("STUDENT_NAME", "<your name>")
     print("Student ID:{}".format(student_id))
     print("Student name:{}".format(student_name))
     print("UUID:{}".format(uuid.uuid4()))
-    print("Experiment time:{}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
+    print(
+        "Experiment time:{}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        )
+    )
     print("==========")
     print(f"==========\nArgs:{args}\n==========")
+    if distributed:
+        print(
+            f"Distributed training on {dist.get_world_size()} processes "
+            f"({dist.get_backend()} backend)"
+        )
 
     if use_gpu:
         print(f"Currently using GPU {args.gpu_devices}")
@@ -64,6 +107,12 @@ def main():
     else:
         warnings.warn("Currently using CPU, however, GPU is highly recommended")
 
+    if args.feature_dtype == "float16" and not args.normalize_feature:
+        warnings.warn(
+            "Squared euclidean distances of unnormalized features may overflow "
+            "in float16, consider --normalize-feature"
+        )
+
     print("Initializing image data manager")
     dm = ImageDataManager(use_gpu, **dataset_kwargs(args))
     trainloader, testloader_dict = dm.return_dataloaders()
@@ -75,18 +124,46 @@ def main():
         loss={"xent", "htri"},
         pretrained=not args.no_pretrained,
         use_gpu=use_gpu,
+        partial_fc=args.partial_fc,
     )
     print("Model size: {:.3f} M".format(count_num_param(model)))
 
     if args.load_weights and check_isfile(args.load_weights):
         load_pretrained_weights(model, args.load_weights)
 
-    model = nn.DataParallel(model).cuda() if use_gpu else model
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if distributed:
+        model = model.cuda() if use_gpu else model
+        # PartialFC gradients are sparse, gathered by the optimizer, see init_optimizer
+        nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(
+            model,
+            [
+                f"{name}.{param}"
+                for name, m in model.named_modules()
+                if isinstance(m, PartialFC)
+                for param in ("weight", "bias")
+            ],
+        )
+        model = nn.parallel.DistributedDataParallel(
+            model, device_ids=[local_rank] if use_gpu else None
+        )
+    else:
+        if use_gpu and args.partial_fc > 0 and torch.cuda.device_count() > 1:
+            # every replica would sample its own classes
+            raise ValueError(
+                "--partial-fc is not supported with nn.DataParallel on several GPUs, "
+                "use one GPU or launch one process per GPU with torchrun"
+            )
+        model = nn.DataParallel(model).cuda() if use_gpu else model
+    # evaluated by rank 0 alone, outside of the collectives of DDP
+    eval_model = model.module if distributed else model
 
     criterion_xent = CrossEntropyLoss(
         num_classes=dm.num_train_pids, use_gpu=use_gpu, label_smooth=args.label_smooth
     )
-    criterion_htri = TripletLoss(margin=args.margin)
+    criterion_htri = TripletLoss(margin=args.margin, mining=args.triplet_mining)
     optimizer = init_optimizer(model, **optimizer_kwargs(args))
     scheduler = init_lr_scheduler(optimizer, **lr_scheduler_kwargs(args))
 
@@ -95,24 +172,44 @@ def main():
             args.resume, model, optimizer=optimizer
         )
 
+    pq_trainloader = None
+    if args.pq_subvectors > 0:
+        pq_trainloader = dm.return_train_evalloader(args.pq_train_size, args.seed)
+
     if args.evaluate:
         print("Evaluate only")
+        if not is_main_process():
+            dist.destroy_process_group()
+            return
+
+        if not args.visualize_ranks:
+            test_targets(eval_model, testloader_dict, use_gpu, pq_trainloader)
+            if distributed:
+                dist.destroy_process_group()
+            return
 
         for name in args.target_names:
             print(f"Evaluating {name} ...")
             queryloader = testloader_dict[name]["query"]
             galleryloader = testloader_dict[name]["gallery"]
             distmat = test(
-                model, queryloader, galleryloader, use_gpu, return_distmat=True
+                eval_model,
+                queryloader,
+                galleryloader,
+                use_gpu,
+                return_distmat=True,
+                pq_trainloader=pq_trainloader,
+                use_metric_vehicleid=name == "vehicleID",
             )
 
-            if args.visualize_ranks:
-                visualize_ranked_results(
-                    distmat,
-                    dm.return_testdataset_by_name(name),
-                    save_dir=osp.join(args.save_dir, "ranked_results", name),
-                    topk=20,
-                )
+            visualize_ranked_results(
+                distmat,
+                dm.return_testdataset_by_name(name),
+                save_dir=osp.join(args.save_dir, "ranked_results", name),
+                topk=20,
+            )
+        if distributed:
+            dist.destroy_process_group()
         return
 
     time_start = time.time()
@@ -130,6 +227,9 @@ def main():
         optimizer.load_state_dict(initial_optim_state)
     """
     for epoch in range(args.start_epoch, args.max_epoch):
+        for loader_part in (trainloader.dataset, trainloader.sampler):
+            if hasattr(loader_part, "set_epoch"):
+                loader_part.set_epoch(epoch)
         train(
             epoch,
             model,
@@ -138,6 +238,7 @@ def main():
             optimizer,
             trainloader,
             use_gpu,
+            batch_transform=dm.train_batch_transform,
         )
 
         scheduler.step()
@@ -148,34 +249,46 @@ def main():
             and (epoch + 1) % args.eval_freq == 0
             or (epoch + 1) == args.max_epoch
         ):
-            print("=> Test")
-
-            for name in args.target_names:
-                print(f"Evaluating {name} ...")
-                queryloader = testloader_dict[name]["query"]
-                galleryloader = testloader_dict[name]["gallery"]
-                rank1 = test(model, queryloader, galleryloader, use_gpu)
-                ranklogger.write(name, epoch + 1, rank1)
-
-            save_checkpoint(
-                {
-                    "state_dict": model.state_dict(),
-                    "rank1": rank1,
-                    "epoch": epoch + 1,
-                    "arch": args.arch,
-                    "optimizer": optimizer.state_dict(),
-                },
-                args.save_dir,
-            )
+            if is_main_process():
+                print("=> Test")
+
+                rank1s = test_targets(
+                    eval_model, testloader_dict, use_gpu, pq_trainloader
+                )
+                for name in args.target_names:
+                    rank1 = rank1s[name]
+                    ranklogger.write(name, epoch + 1, rank1)
+
+                save_checkpoint(
+                    {
+                        "state_dict": model.state_dict(),
+                        "rank1": rank1,
+                        "epoch": epoch + 1,
+                        "arch": args.arch,
+                        "optimizer": optimizer.state_dict(),
+                    },
+                    args.save_dir,
+                )
+            if distributed:
+                dist.barrier()
 
     elapsed = round(time.time() - time_start)
     elapsed = str(datetime.timedelta(seconds=elapsed))
     print(f"Elapsed {elapsed}")
     ranklogger.show_summary()
+    if distributed:
+        dist.destroy_process_group()
 
 
 def train(
-    epoch, model, criterion_xent, criterion_htri, optimizer, trainloader, use_gpu
+    epoch,
+    model,
+    criterion_xent,
+    criterion_htri,
+    optimizer,
+    trainloader,
+    use_gpu,
+    batch_transform=None,
 ):
     xent_losses = AverageMeter()
     htri_losses = AverageMeter()
@@ -187,143 +300,455 @@ def train(
     for p in model.parameters():
         p.requires_grad = True  # open all layers
 
+    # ranks may run out of batches at different steps, e.g. with shards, which
+    # Join handles by shadowing the collectives of the finished ranks, those of
+    # DDP and of the PartialFC update
+    joinables = [model]
+    if optimizer.sampled_rows_update is not None:
+        joinables.append(optimizer.sampled_rows_update)
+    join = (
+        Join(joinables)
+        if isinstance(model, nn.parallel.DistributedDataParallel)
+        else contextlib.nullcontext()
+    )
+
     end = time.time()
-    for batch_idx, (imgs, pids, _, _) in enumerate(trainloader):
-        data_time.update(time.time() - end)
+    with join:
+        for batch_idx, (imgs, pids, _, _) in enumerate(trainloader):
+            data_time.update(time.time() - end)
 
-        if use_gpu:
-            imgs, pids = imgs.cuda(), pids.cuda()
+            if use_gpu:
+                imgs, pids = imgs.cuda(), pids.cuda()
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
+            if args.channels_last:
+                imgs = imgs.contiguous(memory_format=torch.channels_last)
+
+            with autocast_context(args.precision, use_gpu):
+                outputs, features = model(imgs, pids)
+            # losses are computed in float32
+            outputs, features = to_float(outputs), to_float(features)
+            # with --partial-fc, outputs only score the classes sampled for the batch
+            xent_pids = PartialFC.sampled_targets(pids) if args.partial_fc > 0 else pids
+            if isinstance(outputs, (tuple, list)):
+                xent_loss = DeepSupervision(criterion_xent, outputs, xent_pids)
+            else:
+                xent_loss = criterion_xent(outputs, xent_pids)
+
+            if isinstance(features, (tuple, list)):
+                htri_loss = DeepSupervision(criterion_htri, features, pids)
+            else:
+                htri_loss = criterion_htri(features, pids)
+
+            loss = args.lambda_xent * xent_loss + args.lambda_htri * htri_loss
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
 
-        outputs, features = model(imgs)
-        if isinstance(outputs, (tuple, list)):
-            xent_loss = DeepSupervision(criterion_xent, outputs, pids)
-        else:
-            xent_loss = criterion_xent(outputs, pids)
+            batch_time.update(time.time() - end)
 
-        if isinstance(features, (tuple, list)):
-            htri_loss = DeepSupervision(criterion_htri, features, pids)
-        else:
-            htri_loss = criterion_htri(features, pids)
-
-        loss = args.lambda_xent * xent_loss + args.lambda_htri * htri_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        batch_time.update(time.time() - end)
-
-        xent_losses.update(xent_loss.item(), pids.size(0))
-        htri_losses.update(htri_loss.item(), pids.size(0))
-        accs.update(accuracy(outputs, pids)[0])
-
-        if (batch_idx + 1) % args.print_freq == 0:
-            print(
-                "Epoch: [{0}][{1}/{2}]\t"
-                "Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
-                "Data {data_time.val:.4f} ({data_time.avg:.4f})\t"
-                "Xent {xent.val:.4f} ({xent.avg:.4f})\t"
-                "Htri {htri.val:.4f} ({htri.avg:.4f})\t"
-                "Acc {acc.val:.2f} ({acc.avg:.2f})\t".format(
-                    epoch + 1,
-                    batch_idx + 1,
-                    len(trainloader),
-                    batch_time=batch_time,
-                    data_time=data_time,
-                    xent=xent_losses,
-                    htri=htri_losses,
-                    acc=accs,
+            xent_losses.update(xent_loss.item(), pids.size(0))
+            htri_losses.update(htri_loss.item(), pids.size(0))
+            accs.update(accuracy(outputs, xent_pids)[0])
+
+            if (batch_idx + 1) % args.print_freq == 0:
+                print(
+                    "Epoch: [{0}][{1}/{2}]\t"
+                    "Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
+                    "Data {data_time.val:.4f} ({data_time.avg:.4f})\t"
+                    "Xent {xent.val:.4f} ({xent.avg:.4f})\t"
+                    "Htri {htri.val:.4f} ({htri.avg:.4f})\t"
+                    "Acc {acc.val:.2f} ({acc.avg:.2f})\t".format(
+                        epoch + 1,
+                        batch_idx + 1,
+                        len(trainloader),
+                        batch_time=batch_time,
+                        data_time=data_time,
+                        xent=xent_losses,
+                        htri=htri_losses,
+                        acc=accs,
+                    )
                 )
-            )
 
-        end = time.time()
+            end = time.time()
 
 
-def test(
-    model,
-    queryloader,
-    galleryloader,
-    use_gpu,
-    ranks=[1, 5, 10, 20],
-    return_distmat=False,
-):
-    batch_time = AverageMeter()
+def to_float(outputs):
+    """Cast the (tuples or lists of) outputs of a model to float32"""
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(output.float() for output in outputs)
+    return outputs.float()
 
-    model.eval()
 
+def extract_features(
+    model, dataloader, use_gpu, batch_time, feature_dtype=torch.float32, normalize=False
+):
+    features_, pids_, camids_ = [], [], []
     with torch.no_grad():
-        qf, q_pids, q_camids = [], [], []
-        for batch_idx, (imgs, pids, camids, _) in enumerate(queryloader):
+        for batch_idx, (imgs, pids, camids, _) in enumerate(dataloader):
             if use_gpu:
                 imgs = imgs.cuda()
+            if args.channels_last:
+                imgs = imgs.contiguous(memory_format=torch.channels_last)
 
             end = time.time()
-            features = model(imgs)
+            with autocast_context(args.precision, use_gpu):
+                features = model(imgs)
             batch_time.update(time.time() - end)
 
-            features = features.data.cpu()
-            qf.append(features)
-            q_pids.extend(pids)
-            q_camids.extend(camids)
-        qf = torch.cat(qf, 0)
-        q_pids = np.asarray(q_pids)
-        q_camids = np.asarray(q_camids)
+            features = features.data.float().cpu()
+            if normalize:
+                features = F.normalize(features, p=2, dim=1)
+            features_.append(features.to(feature_dtype))
+            pids_.extend(pids)
+            camids_.extend(camids)
+    return torch.cat(features_, 0), np.asarray(pids_), np.asarray(camids_)
 
-        print(
-            "Extracted features for query set, obtained {}-by-{} matrix".format(
-                qf.size(0), qf.size(1)
-            )
+
+def load_or_extract_features(
+    model, dataloader, use_gpu, batch_time, weights_hash, feature_dtype=torch.float32
+):
+    """Reuse the features cached in --feature-cache-dir for the same weights,
+    architecture, image size and image list, or extract and cache them."""
+    if not args.feature_cache_dir:
+        return extract_features(
+            model,
+            dataloader,
+            use_gpu,
+            batch_time,
+            feature_dtype=feature_dtype,
+            normalize=args.normalize_feature,
         )
 
-        gf, g_pids, g_camids = [], [], []
-        for batch_idx, (imgs, pids, camids, _) in enumerate(galleryloader):
-            if use_gpu:
-                imgs = imgs.cuda()
+    store = FeatureStore(args.feature_cache_dir)
+    key = store.make_key(
+        weights_hash,
+        args.arch,
+        args.height,
+        args.width,
+        [img_path for img_path, _, _ in dataloader.dataset.dataset],
+        dtype=feature_dtype,
+        normalize=args.normalize_feature,
+        jpeg_draft=args.jpeg_draft,
+        precision=args.precision,
+        # e.g. dataset-specific with --dataset-norm
+        normalization=get_normalization(dataloader.dataset.transform),
+    )
+    cached = store.load(key)
+    if cached is not None:
+        print(f'Loaded cached features "{key}"')
+        return cached
+
+    features, pids, camids = extract_features(
+        model,
+        dataloader,
+        use_gpu,
+        batch_time,
+        feature_dtype=feature_dtype,
+        normalize=args.normalize_feature,
+    )
+    store.save(key, features, pids, camids, arch=args.arch)
+    print(f'Cached features to "{key}"')
+    return features, pids, camids
 
-            end = time.time()
-            features = model(imgs)
-            batch_time.update(time.time() - end)
 
-            features = features.data.cpu()
-            gf.append(features)
-            g_pids.extend(pids)
-            g_camids.extend(camids)
-        gf = torch.cat(gf, 0)
-        g_pids = np.asarray(g_pids)
-        g_camids = np.asarray(g_camids)
+def extract_test_features(
+    model,
+    queryloader,
+    galleryloader,
+    use_gpu,
+    batch_time,
+    weights_hash,
+    feature_dtype,
+    pq_trainloader=None,
+):
+    """Extract query and gallery features (and training features to learn the
+    product quantizer from, if used) into a dict."""
+    features = {}
+    qf, q_pids, q_camids = load_or_extract_features(
+        model, queryloader, use_gpu, batch_time, weights_hash, feature_dtype
+    )
+    print(
+        "Extracted features for query set, obtained {}-by-{} matrix".format(
+            qf.size(0), qf.size(1)
+        )
+    )
+
+    gf, g_pids, g_camids = load_or_extract_features(
+        model, galleryloader, use_gpu, batch_time, weights_hash, feature_dtype
+    )
+    print(
+        "Extracted features for gallery set, obtained {}-by-{} matrix".format(
+            gf.size(0), gf.size(1)
+        )
+    )
+    features.update(
+        qf=qf, q_pids=q_pids, q_camids=q_camids, gf=gf, g_pids=g_pids, g_camids=g_camids
+    )
 
+    if pq_trainloader is not None:
+        features["tf"], _, _ = load_or_extract_features(
+            model, pq_trainloader, use_gpu, batch_time, weights_hash
+        )
+    return features
+
+
+def compute_metrics(features, use_metric_vehicleid=False, return_distmat=False):
+    """Compute CMC and mAP from the output of extract_test_features.
+    This only needs the features and args, so it can run in a worker process."""
+    qf, q_pids, q_camids = features["qf"], features["q_pids"], features["q_camids"]
+    gf, g_pids, g_camids = features["gf"], features["g_pids"], features["g_camids"]
+    metric = "cosine" if args.normalize_feature else "euclidean"
+
+    if use_metric_vehicleid and args.vehicleid_splits > 0 and not return_distmat:
+        # query and gallery together are the whole test list, from which every
+        # split picks its own random gallery without extracting features again
+        print(f"Computing CMC and mAP over {args.vehicleid_splits} random splits")
+        all_cmc, all_mAP = evaluate_random_splits(
+            torch.cat([qf, gf], 0),
+            np.concatenate([q_pids, g_pids]),
+            np.concatenate([q_camids, g_camids]),
+            num_splits=args.vehicleid_splits,
+            seed=args.seed,
+            workers=args.eval_workers,
+            # all queries at once when --eval-block-size <= 0, as below
+            block_size=(
+                args.eval_block_size
+                if args.eval_block_size > 0
+                else qf.size(0) + gf.size(0)
+            ),
+            method=args.eval_method,
+            metric=metric,
+        )
+        return {
+            "cmc": all_cmc.mean(0),
+            "cmc_std": all_cmc.std(0),
+            "mAP": all_mAP.mean(),
+            "mAP_std": all_mAP.std(),
+        }
+
+    gallery_index = None
+    if "tf" in features:
+        # learn the quantizer on training features and keep only the codes of
+        # the gallery, which is then scored with asymmetric distances
+        gallery_index = init_index(
+            "pq", num_subvectors=args.pq_subvectors, nbits=args.pq_bits, seed=args.seed
+        )
+        gallery_index.train(features["tf"])
+        gallery_index.add(gf)
+        raw_size = gf.size(1) * gf.element_size()
         print(
-            "Extracted features for gallery set, obtained {}-by-{} matrix".format(
-                gf.size(0), gf.size(1)
+            "Product-quantized gallery: {} bytes per feature instead of {} ({:.0f}x smaller)".format(
+                gallery_index.code_size, raw_size, raw_size / gallery_index.code_size
             )
         )
 
+    print("Computing CMC and mAP")
+    eval_start = time.time()
+    distmat = None
+    if return_distmat or args.eval_block_size <= 0:
+        if gallery_index is not None:
+            distmat = to_numpy(gallery_index.compute_distances(qf))
+        else:
+            distmat = to_numpy(compute_distance_matrix(qf, gf, metric))
+        cmc, mAP = evaluate(
+            distmat,
+            q_pids,
+            g_pids,
+            q_camids,
+            g_camids,
+            method=args.eval_method,
+            use_metric_vehicleid=use_metric_vehicleid,
+        )
+    elif gallery_index is not None:
+        cmc, mAP = evaluate_index(
+            qf,
+            gallery_index,
+            q_pids,
+            g_pids,
+            q_camids,
+            g_camids,
+            block_size=args.eval_block_size,
+            method=args.eval_method,
+            use_metric_vehicleid=use_metric_vehicleid,
+        )
+    else:
+        # stream query blocks so the full distance matrix is never materialized
+        cmc, mAP = evaluate_features(
+            qf,
+            gf,
+            q_pids,
+            g_pids,
+            q_camids,
+            g_camids,
+            block_size=args.eval_block_size,
+            method=args.eval_method,
+            metric=metric,
+            use_metric_vehicleid=use_metric_vehicleid,
+        )
     print(
-        f"=> BatchTime(s)/BatchSize(img): {batch_time.avg:.3f}/{args.test_batch_size}"
+        "=> Evaluated {} queries against {} gallery samples in {:.1f}s, "
+        "peak memory {:.0f} MB".format(
+            qf.size(0), gf.size(0), time.time() - eval_start, peak_memory_mb()
+        )
     )
+    return {"cmc": cmc, "mAP": mAP, "distmat": distmat}
+
+
+def _compute_metrics_worker(features, use_metric_vehicleid):
+    # capture the output so the parent prints it in target order
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        results = compute_metrics(features, use_metric_vehicleid)
+    return results, output.getvalue()
+
+
+def print_results(results, ranks):
+    cmc, mAP = results["cmc"], results["mAP"]
+    if "cmc_std" in results:
+        cmc_std = results["cmc_std"]
+        print("Results (mean ± std over random splits) ----------")
+        print(f"mAP: {mAP:.1%} ± {results['mAP_std']:.1%}")
+        print("CMC curve")
+        for r in ranks:
+            print("Rank-{:<3}: {:.1%} ± {:.1%}".format(r, cmc[r - 1], cmc_std[r - 1]))
+    else:
+        print("Results ----------")
+        print(f"mAP: {mAP:.1%}")
+        print("CMC curve")
+        for r in ranks:
+            print("Rank-{:<3}: {:.1%}".format(r, cmc[r - 1]))
+    print("------------------")
+
+
+def test(
+    model,
+    queryloader,
+    galleryloader,
+    use_gpu,
+    ranks=[1, 5, 10, 20],
+    return_distmat=False,
+    pq_trainloader=None,
+    use_metric_vehicleid=False,
+):
+    batch_time = AverageMeter()
 
-    m, n = qf.size(0), gf.size(0)
-    distmat = (
-        torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n)
-        + torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+    model.eval()
+    weights_hash = hash_state_dict(model) if args.feature_cache_dir else None
+    # features are stored, and distances computed, in feature_dtype
+    feature_dtype = getattr(torch, args.feature_dtype)
+
+    features = extract_test_features(
+        model,
+        queryloader,
+        galleryloader,
+        use_gpu,
+        batch_time,
+        weights_hash,
+        feature_dtype,
+        pq_trainloader=pq_trainloader,
+    )
+    print(
+        f"=> BatchTime(s)/BatchSize(img): {batch_time.avg:.3f}/{args.test_batch_size}"
     )
-    distmat.addmm_(qf, gf.t(), beta=1, alpha=-2)
-    distmat = distmat.numpy()
 
-    print("Computing CMC and mAP")
-    # cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, args.target_names)
-    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
-
-    print("Results ----------")
-    print(f"mAP: {mAP:.1%}")
-    print("CMC curve")
-    for r in ranks:
-        print("Rank-{:<3}: {:.1%}".format(r, cmc[r - 1]))
-    print("------------------")
+    results = compute_metrics(features, use_metric_vehicleid, return_distmat)
+    print_results(results, ranks)
+    cmc, mAP = results["cmc"], results["mAP"]
+
+    if args.precision_drift and feature_dtype != torch.float32:
+        # extract float32 features again to measure what reduced precision costs,
+        # evaluated as the features above, e.g. on a product-quantized gallery
+        qf, _, _ = load_or_extract_features(
+            model, queryloader, use_gpu, batch_time, weights_hash
+        )
+        gf, _, _ = load_or_extract_features(
+            model, galleryloader, use_gpu, batch_time, weights_hash
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            results_fp32 = compute_metrics(
+                dict(features, qf=qf, gf=gf), use_metric_vehicleid, return_distmat
+            )
+        cmc_fp32, mAP_fp32 = results_fp32["cmc"], results_fp32["mAP"]
+        print(
+            "Drift of {} against float32: rank1 {:+.2%} (float32 {:.1%}), "
+            "mAP {:+.2%} (float32 {:.1%})".format(
+                args.feature_dtype,
+                cmc[0] - cmc_fp32[0],
+                cmc_fp32[0],
+                mAP - mAP_fp32,
+                mAP_fp32,
+            )
+        )
 
     if return_distmat:
-        return distmat
+        return results["distmat"]
     return cmc[0]
 
 
+def test_targets(model, testloader_dict, use_gpu, pq_trainloader=None):
+    """
+    Evaluate every target dataset and return their rank1 in a dict.
+    With --eval-workers > 1 and several targets, the metrics of a target are
+    computed in a worker process while the features of the next target are
+    extracted, and the results are printed in the order of --target-names.
+    """
+    rank1s = {}
+    if (
+        args.eval_workers <= 1
+        or len(args.target_names) < 2
+        or (args.precision_drift and args.feature_dtype != "float32")
+    ):
+        for name in args.target_names:
+            print(f"Evaluating {name} ...")
+            rank1s[name] = test(
+                model,
+                testloader_dict[name]["query"],
+                testloader_dict[name]["gallery"],
+                use_gpu,
+                pq_trainloader=pq_trainloader,
+                use_metric_vehicleid=name == "vehicleID",
+            )
+        return rank1s
+
+    batch_time = AverageMeter()
+    model.eval()
+    weights_hash = hash_state_dict(model) if args.feature_cache_dir else None
+    feature_dtype = getattr(torch, args.feature_dtype)
+
+    futures = {}
+    # spawn rather than fork, the parent holds model, loader and OpenMP threads
+    with ProcessPoolExecutor(
+        max_workers=min(args.eval_workers, len(args.target_names)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        for name in args.target_names:
+            print(f"Extracting features of {name} ...")
+            features = extract_test_features(
+                model,
+                testloader_dict[name]["query"],
+                testloader_dict[name]["gallery"],
+                use_gpu,
+                batch_time,
+                weights_hash,
+                feature_dtype,
+                pq_trainloader=pq_trainloader,
+            )
+            futures[name] = executor.submit(
+                _compute_metrics_worker, features, name == "vehicleID"
+            )
+        print(
+            f"=> BatchTime(s)/BatchSize(img): {batch_time.avg:.3f}/{args.test_batch_size}"
+        )
+
+        for name in args.target_names:
+            results, output = futures[name].result()
+            print(f"Evaluating {name} ...")
+            print(output, end="")
+            print_results(results, [1, 5, 10, 20])
+            rank1s[name] = results["cmc"][0]
+    return rank1s
+
+
 if __name__ == "__main__":
     main()
@@ -1,11 +1,29 @@
 # Copyright (c) EEEM071, University of Surrey
 
+import hashlib
+import os.path as osp
+import warnings
+
+import numpy as np
+import torch.distributed as dist
+import torchvision.transforms as T
 from torch.utils.data import DataLoader
 
 from .dataset_loader import ImageDataset
-from .datasets import init_imgreid_dataset
+from .datasets import ColumnarDataset, init_imgreid_dataset
+from .image_cache import ImageCache
 from .samplers import build_train_sampler
-from .transforms import build_transforms
+from .shards import (
+    PackedImageDataset,
+    ShardedImageDataset,
+    ShardLocations,
+    read_shard_index,
+    test_split_name,
+)
+from .transforms import build_batch_transform, build_transforms
+from .utils.iotools import read_json, write_json
+from .utils.mean_and_std import ImageStats, get_mean_and_std
+from .utils.torchtools import is_main_process
 
 
 class BaseDataManager:
@@ -17,6 +35,7 @@ class BaseDataManager:
         root="datasets",
         height=128,
         width=256,
+        test_size=800,  # number of test identities (for vehicleID)
         train_batch_size=32,
         test_batch_size=100,
         workers=4,
@@ -24,7 +43,12 @@ class BaseDataManager:
         random_erase=False,  # use random erasing for data augmentation
         color_jitter=False,  # randomly change the brightness, contrast and saturation
         color_aug=False,  # randomly alter the intensities of RGB channels
+        batch_augment=False,  # augment collated batches instead of every sample
         num_instances=4,  # number of instances per identity (for RandomIdentitySampler)
+        image_cache_dir="",  # directory of decoded and resized images, "" to disable
+        jpeg_draft=False,  # decode JPEGs at reduced resolution
+        shard_dir="",  # directory of the datasets packed into shards, "" to disable
+        dataset_norm=False,  # normalize with the mean and std of the train images
         **kwargs,
     ):
         self.use_gpu = use_gpu
@@ -33,6 +57,7 @@ class BaseDataManager:
         self.root = root
         self.height = height
         self.width = width
+        self.test_size = test_size
         self.train_batch_size = train_batch_size
         self.test_batch_size = test_batch_size
         self.workers = workers
@@ -40,17 +65,84 @@ class BaseDataManager:
         self.random_erase = random_erase
         self.color_jitter = color_jitter
         self.color_aug = color_aug
+        self.batch_augment = batch_augment
         self.num_instances = num_instances
+        self.image_cache_dir = image_cache_dir
+        self.jpeg_draft = jpeg_draft
+        # JPEGs are decoded at the smallest scale at least as large as the input
+        self.draft_size = (height, width) if jpeg_draft else None
+        self.shard_dir = shard_dir
+        self.dataset_norm = dataset_norm
+
+        self.build_transforms()
 
+    def build_transforms(self, mean=None, std=None):
+        """Build the transforms, normalizing with the imagenet mean and std if None"""
         transform_train, transform_test = build_transforms(
             self.height,
             self.width,
             random_erase=self.random_erase,
             color_jitter=self.color_jitter,
             color_aug=self.color_aug,
+            batch_augment=self.batch_augment,
+            mean=mean,
+            std=std,
         )
         self.transform_train = transform_train
         self.transform_test = transform_test
+        # applied by the training loop to the collated uint8 batches
+        self.train_batch_transform = None
+        if self.batch_augment:
+            kwargs = {} if mean is None or std is None else {"mean": mean, "std": std}
+            self.train_batch_transform = build_batch_transform(
+                random_erase=self.random_erase, color_aug=self.color_aug, **kwargs
+            )
+
+    def compute_train_stats(self):
+        """
+        Return the mean and std of every channel over the train images resized to
+        height x width. They are computed in one streaming pass, with the
+        partial statistics of the images merged from the dataloader workers, and
+        cached under root/.stats by source datasets, resolution and image list.
+        """
+        sha = hashlib.sha1(self.train.path_bytes.tobytes())
+        sha.update(self.train.offsets.tobytes())
+        draft = "-draft" if self.jpeg_draft else ""
+        stats_path = osp.join(
+            self.root,
+            ".stats",
+            f"{'+'.join(self.source_names)}-{self.height}x{self.width}{draft}-"
+            f"{sha.hexdigest()[:16]}.json",
+        )
+        if osp.isfile(stats_path):
+            stats = read_json(stats_path)
+            print(f'=> Loaded train mean and std from "{stats_path}"')
+            return stats["mean"], stats["std"]
+
+        transform = T.Compose([T.Resize((self.height, self.width)), ImageStats()])
+        mean, std = get_mean_and_std(self.return_train_evalloader(transform=transform))
+        stats = {"mean": mean.tolist(), "std": std.tolist()}
+        try:
+            write_json(stats, stats_path)
+        except OSError as e:
+            warnings.warn(f'Cannot write train mean and std "{stats_path}": {e}')
+        return stats["mean"], stats["std"]
+
+    def build_image_cache(self, dataset):
+        """
+        Return the ImageCache of a list of (img_path, pid, camid), or None if
+        image caching is disabled.
+        """
+        if not self.image_cache_dir:
+            return None
+        return ImageCache(
+            self.image_cache_dir,
+            [img_path for img_path, _, _ in dataset],
+            self.height,
+            self.width,
+            workers=self.workers,
+            jpeg_draft=self.jpeg_draft,
+        )
 
     @property
     def num_train_pids(self):
@@ -66,9 +158,50 @@ class BaseDataManager:
         """
         return self.trainloader, self.testloader_dict
 
+    def return_train_evalloader(self, num_samples=0, seed=0, transform=None):
+        """
+        Return a loader of (a random subset of) the training images with the test
+        transforms, e.g. to extract training features for learning a quantizer.
+        Args:
+        - num_samples (int): size of the random subset, 0 for all training images.
+        - transform (callable): transform used instead of the test transforms.
+        """
+        if transform is None:
+            transform = self.transform_test
+        train = self.train
+        if 0 < num_samples < len(train):
+            rng = np.random.RandomState(seed)
+            keep = np.sort(rng.choice(len(train), num_samples, replace=False))
+        else:
+            keep = np.arange(len(train))
+        if self.shard_dir:
+            dataset = PackedImageDataset(
+                {
+                    "dataset": train.subset(keep),
+                    "locations": self.train_locations.subset(keep),
+                },
+                transform=transform,
+                draft_size=self.draft_size,
+            )
+        else:
+            dataset = ImageDataset(
+                train.subset(keep),
+                transform=transform,
+                image_cache=self.train_image_cache,
+                draft_size=self.draft_size,
+            )
+        return DataLoader(
+            dataset,
+            batch_size=self.test_batch_size,
+            shuffle=False,
+            num_workers=self.workers,
+            pin_memory=self.use_gpu,
+            drop_last=False,
+        )
+
     def return_testdataset_by_name(self, name):
         """
-        Return query and gallery, each containing a list of (img_path, pid, camid).
+        Return query and gallery, each a ColumnarDataset of (img_path, pid, camid).
         """
         return (
             self.testdataset_dict[name]["query"],
@@ -89,32 +222,97 @@ class ImageDataManager(BaseDataManager):
         self._num_train_pids = 0
         self._num_train_cams = 0
 
+        train_shard_indexes = []
+
         for name in self.source_names:
-            dataset = init_imgreid_dataset(root=self.root, name=name)
+            if self.shard_dir:
+                shard_index = read_shard_index(
+                    osp.join(self.shard_dir, name),
+                    "train",
+                    pid_offset=self._num_train_pids,
+                    camid_offset=self._num_train_cams,
+                )
+                train_shard_indexes.append(shard_index)
+                train.append(shard_index["dataset"])
+                self._num_train_pids += shard_index["num_pids"]
+                self._num_train_cams += shard_index["num_cams"]
+                continue
+
+            dataset = init_imgreid_dataset(
+                root=self.root, name=name, test_size=self.test_size
+            )
 
-            for img_path, pid, camid in dataset.train:
-                pid += self._num_train_pids
-                camid += self._num_train_cams
-                train.append((img_path, pid, camid))
+            train.append(
+                dataset.train.shift(self._num_train_pids, self._num_train_cams)
+            )
 
             self._num_train_pids += dataset.num_train_pids
             self._num_train_cams += dataset.num_train_cams
 
-        self.train_sampler = build_train_sampler(
-            train,
-            self.train_sampler,
-            train_batch_size=self.train_batch_size,
-            num_instances=self.num_instances,
-        )
-        self.trainloader = DataLoader(
-            ImageDataset(train, transform=self.transform_train),
-            sampler=self.train_sampler,
-            batch_size=self.train_batch_size,
-            shuffle=False,
-            num_workers=self.workers,
-            pin_memory=self.use_gpu,
-            drop_last=True,
-        )
+        # one set of arrays shared by the dataloader workers, see ColumnarDataset
+        train = ColumnarDataset.concat(train)
+        self.train = train
+
+        if self.shard_dir:
+            self.train_locations = ShardLocations.concat(
+                [index["locations"] for index in train_shard_indexes]
+            )
+        else:
+            self.train_image_cache = self.build_image_cache(train)
+
+        if self.dataset_norm:
+            if dist.is_available() and dist.is_initialized():
+                # computed by rank 0 alone
+                stats = [self.compute_train_stats() if is_main_process() else None]
+                dist.broadcast_object_list(stats, src=0)
+                mean, std = stats[0]
+            else:
+                mean, std = self.compute_train_stats()
+            print(f"=> Normalizing with train mean {mean} and std {std}")
+            self.build_transforms(mean, std)
+
+        if self.shard_dir:
+            # the shards are streamed in random order, identity batching is done
+            # in a shuffle buffer instead of by a sampler
+            num_instances = 0
+            if self.train_sampler == "RandomIdentitySampler":
+                num_instances = self.num_instances
+            train_dataset = ShardedImageDataset(
+                train_shard_indexes,
+                transform=self.transform_train,
+                batch_size=self.train_batch_size,
+                num_instances=num_instances,
+                draft_size=self.draft_size,
+            )
+            self.trainloader = DataLoader(
+                train_dataset,
+                # P x K batches, so that they do not straddle identity groups
+                batch_size=train_dataset.batch_size,
+                num_workers=self.workers,
+                pin_memory=self.use_gpu,
+                drop_last=True,
+            )
+        else:
+            self.train_sampler = build_train_sampler(
+                train,
+                self.train_sampler,
+                train_batch_size=self.train_batch_size,
+                num_instances=self.num_instances,
+            )
+            self.trainloader = DataLoader(
+                ImageDataset(
+                    train,
+                    transform=self.transform_train,
+                    image_cache=self.train_image_cache,
+                    draft_size=self.draft_size,
+                ),
+                sampler=self.train_sampler,
+                batch_size=self.train_batch_size,
+                shuffle=False,
+                num_workers=self.workers,
+                pin_memory=self.use_gpu,
+                drop_last=True,
+            )
 
         print("=> Initializing TEST (target) datasets")
         self.testloader_dict = {
@@ -125,10 +323,39 @@ class ImageDataManager(BaseDataManager):
         }
 
         for name in self.target_names:
-            dataset = init_imgreid_dataset(root=self.root, name=name)
+            if self.shard_dir:
+                query, gallery = [
+                    read_shard_index(
+                        osp.join(self.shard_dir, name),
+                        test_split_name(split, name, self.test_size),
+                    )
+                    for split in ("query", "gallery")
+                ]
+                queryset = PackedImageDataset(
+                    query, transform=self.transform_test, draft_size=self.draft_size
+                )
+                galleryset = PackedImageDataset(
+                    gallery, transform=self.transform_test, draft_size=self.draft_size
+                )
+            else:
+                dataset = init_imgreid_dataset(
+                    root=self.root, name=name, test_size=self.test_size
+                )
+                queryset = ImageDataset(
+                    dataset.query,
+                    transform=self.transform_test,
+                    image_cache=self.build_image_cache(dataset.query),
+                    draft_size=self.draft_size,
+                )
+                galleryset = ImageDataset(
+                    dataset.gallery,
+                    transform=self.transform_test,
+                    image_cache=self.build_image_cache(dataset.gallery),
+                    draft_size=self.draft_size,
+                )
 
             self.testloader_dict[name]["query"] = DataLoader(
-                ImageDataset(dataset.query, transform=self.transform_test),
+                queryset,
                 batch_size=self.test_batch_size,
                 shuffle=False,
                 num_workers=self.workers,
@@ -137,7 +364,7 @@ class ImageDataManager(BaseDataManager):
             )
 
             self.testloader_dict[name]["gallery"] = DataLoader(
-                ImageDataset(dataset.gallery, transform=self.transform_test),
+                galleryset,
                 batch_size=self.test_batch_size,
                 shuffle=False,
                 num_workers=self.workers,
@@ -145,8 +372,8 @@ class ImageDataManager(BaseDataManager):
                 drop_last=False,
             )
 
-            self.testdataset_dict[name]["query"] = dataset.query
-            self.testdataset_dict[name]["gallery"] = dataset.gallery
+            self.testdataset_dict[name]["query"] = queryset.dataset
+            self.testdataset_dict[name]["gallery"] = galleryset.dataset
 
         print("\n")
         print("  **************** Summary ****************")
@@ -1,42 +1,76 @@
 # Copyright (c) EEEM071, University of Surrey
 
 import os.path as osp
+import time
 
 from PIL import Image
 from torch.utils.data import Dataset
 
 
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
+def open_image(fp, draft_size=None):
+    """
+    Decode an image to RGB.
+    Args:
+    - fp (str or file): image file.
+    - draft_size (tuple): (height, width) the image is resized to afterwards. JPEGs
+      are then decoded at the smallest DCT scale (1, 1/2, 1/4 or 1/8) that is at
+      least this size, which skips most of the decoding of large images.
+    """
+    img = Image.open(fp)
+    if draft_size is not None:
+        img.draft("RGB", (draft_size[1], draft_size[0]))
+    return img.convert("RGB")
+
+
+def read_image(img_path, draft_size=None, max_retries=5, backoff=0.1):
+    """Read an image, retrying up to max_retries times with exponential backoff.
+    This can avoid IOError incurred by heavy IO process, while a corrupt file
+    raises instead of stalling the dataloader worker."""
     if not osp.exists(img_path):
         raise OSError(f"{img_path} does not exist")
-    while not got_img:
+    for attempt in range(max_retries + 1):
         try:
-            img = Image.open(img_path).convert("RGB")
-            got_img = True
-        except OSError:
+            return open_image(img_path, draft_size)
+        except OSError as e:
+            if attempt == max_retries:
+                raise OSError(
+                    f'Cannot read "{img_path}" after {max_retries} retries, '
+                    "run tools.verify_images to quarantine corrupt images"
+                ) from e
             print(
-                f'IOError incurred when reading "{img_path}". Will redo. Don\'t worry. Just chill.'
+                f'IOError incurred when reading "{img_path}". '
+                f"Retrying in {backoff * 2**attempt:.1f}s ({attempt + 1}/{max_retries})."
             )
-            pass
-    return img
+            time.sleep(backoff * 2**attempt)
 
 
 class ImageDataset(Dataset):
-    """Image Person ReID Dataset"""
+    """
+    Image Person ReID Dataset
+    Args:
+    - dataset (list): (img_path, pid, camid) tuples.
+    - transform (callable): transform applied to every image.
+    - image_cache (ImageCache): cache of decoded and resized images to read from
+      instead of the image files. Default: None.
+    - draft_size (tuple): (height, width) to decode JPEGs at reduced resolution
+      for, see open_image. Default: None.
+    """
 
-    def __init__(self, dataset, transform=None):
+    def __init__(self, dataset, transform=None, image_cache=None, draft_size=None):
         self.dataset = dataset
         self.transform = transform
+        self.image_cache = image_cache
+        self.draft_size = draft_size
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, index):
         img_path, pid, camid = self.dataset[index]
-        img = read_image(img_path)
+        if self.image_cache is not None:
+            img = Image.fromarray(self.image_cache[img_path])
+        else:
+            img = read_image(img_path, self.draft_size)
 
         if self.transform is not None:
             img = self.transform(img)
@@ -1,5 +1,6 @@
 # Copyright (c) EEEM071, University of Surrey
 
+from .columnar import ColumnarDataset
 from .vehicleid import VehicleID
 from .veri import VeRi
 
@@ -8,6 +9,9 @@ __imgreid_factory = {
     "vehicleID": VehicleID,
 }
 
+# datasets built in this process, by name and arguments
+__imgreid_cache = {}
+
 
 def init_imgreid_dataset(name, **kwargs):
     if name not in list(__imgreid_factory.keys()):
@@ -16,4 +20,7 @@ def init_imgreid_dataset(name, **kwargs):
                 name, list(__imgreid_factory.keys())
             )
         )
-    return __imgreid_factory[name](**kwargs)
+    key = (name, tuple(sorted(kwargs.items())))
+    if key not in __imgreid_cache:
+        __imgreid_cache[key] = __imgreid_factory[name](**kwargs)
+    return __imgreid_cache[key]
@@ -1,6 +1,15 @@
 # Copyright (c) EEEM071, University of Surrey
 
+import hashlib
+import json
+import os
 import os.path as osp
+import warnings
+
+import numpy as np
+
+from ..utils.iotools import mkdir_if_missing, read_json
+from .columnar import ColumnarDataset
 
 
 class BaseDataset:
@@ -11,7 +20,73 @@ class BaseDataset:
     def __init__(self, root):
         self.root = osp.expanduser(root)
 
+    @staticmethod
+    def source_signature(path):
+        """mtime and number of entries of a directory, or mtime and size of a file"""
+        stat = os.stat(path)
+        if osp.isdir(path):
+            with os.scandir(path) as it:
+                return [stat.st_mtime_ns, sum(1 for _ in it)]
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def load_manifest(self, sources, parse):
+        """
+        Return the output of parse(), cached in a JSON manifest under
+        root/.manifests. The manifest is parsed again when the mtime or number of
+        entries of any source changes.
+        Args:
+        - sources (list): directories and files that parse() reads.
+        - parse (callable): function returning a JSON-serializable object.
+        """
+        sha = hashlib.sha1(type(self).__name__.encode())
+        for path in sources:
+            sha.update(f"\n{osp.abspath(path)}".encode())
+        manifest_path = osp.join(
+            self.root,
+            ".manifests",
+            f"{type(self).__name__}-{sha.hexdigest()[:16]}.json",
+        )
+        signature = [self.source_signature(path) for path in sources]
+
+        if osp.isfile(manifest_path):
+            manifest = read_json(manifest_path)
+            if manifest["signature"] == signature:
+                return manifest["data"]
+
+        data = parse()
+        try:
+            mkdir_if_missing(osp.dirname(manifest_path))
+            # written compactly to a temporary file, then renamed, so that
+            # concurrent runs never read a partial manifest
+            tmp_path = f"{manifest_path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump({"signature": signature, "data": data}, f)
+            os.replace(tmp_path, manifest_path)
+        except OSError as e:
+            warnings.warn(f'Cannot write dataset manifest "{manifest_path}": {e}')
+        return data
+
+    @property
+    def quarantine_path(self):
+        """List of unreadable images written by tools.verify_images"""
+        return osp.join(self.root, ".quarantine", f"{type(self).__name__}.txt")
+
+    def load_quarantine(self):
+        """Return the absolute paths of the quarantined images"""
+        if not osp.isfile(self.quarantine_path):
+            return set()
+        with open(self.quarantine_path) as f:
+            quarantined = {osp.abspath(line.strip()) for line in f if line.strip()}
+        if quarantined:
+            print(
+                f"=> Skipping {len(quarantined)} quarantined images listed in "
+                f'"{self.quarantine_path}"'
+            )
+        return quarantined
+
     def get_imagedata_info(self, data):
+        if isinstance(data, ColumnarDataset):
+            return len(np.unique(data.pids)), len(data), len(np.unique(data.camids))
         pids, cams = [], []
         for _, pid, camid in data:
             pids += [pid]
@@ -0,0 +1,93 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import numpy as np
+
+
+class ColumnarDataset:
+    """
+    Read-only list of (img_path, pid, camid) stored column by column: pids and
+    camids in int64 arrays, and image paths in one byte buffer with offsets.
+    Unlike a list of tuples, it is a handful of objects whatever its length, so
+    forked dataloader workers do not copy it by touching reference counts.
+    Indexing and iterating give (img_path, pid, camid) tuples as a list would.
+    Args:
+    - data (list): list of (img_path, pid, camid).
+    """
+
+    def __init__(self, data=()):
+        paths = [img_path.encode() for img_path, _, _ in data]
+        self.offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in paths], out=self.offsets[1:])
+        self.path_bytes = np.frombuffer(b"".join(paths), dtype=np.uint8)
+        self.pids = np.array([pid for _, pid, _ in data], dtype=np.int64)
+        self.camids = np.array([camid for _, _, camid in data], dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, path_bytes, offsets, pids, camids):
+        dataset = cls()
+        dataset.path_bytes = path_bytes
+        dataset.offsets = offsets
+        dataset.pids = pids
+        dataset.camids = camids
+        return dataset
+
+    @classmethod
+    def concat(cls, datasets):
+        """Concatenate ColumnarDatasets into one"""
+        offsets = [np.zeros(1, dtype=np.int64)]
+        start = 0
+        for dataset in datasets:
+            offsets.append(dataset.offsets[1:] + start)
+            start += dataset.offsets[-1]
+        return cls.from_arrays(
+            np.concatenate([d.path_bytes for d in datasets] + [np.zeros(0, np.uint8)]),
+            np.concatenate(offsets),
+            np.concatenate([d.pids for d in datasets] + [np.zeros(0, np.int64)]),
+            np.concatenate([d.camids for d in datasets] + [np.zeros(0, np.int64)]),
+        )
+
+    def shift(self, pid_offset=0, camid_offset=0):
+        """Return the dataset with pids and camids shifted, sharing the paths"""
+        return self.from_arrays(
+            self.path_bytes,
+            self.offsets,
+            self.pids + pid_offset,
+            self.camids + camid_offset,
+        )
+
+    def subset(self, indices):
+        """Return the samples at indices, as a ColumnarDataset"""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        lengths = ends - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # gather the path bytes of every sample with one fancy index
+        byte_index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return self.from_arrays(
+            self.path_bytes[byte_index],
+            offsets,
+            self.pids[indices],
+            self.camids[indices],
+        )
+
+    def path(self, index):
+        return (
+            self.path_bytes[self.offsets[index] : self.offsets[index + 1]]
+            .tobytes()
+            .decode()
+        )
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("dataset index out of range")
+        return self.path(index), int(self.pids[index]), int(self.camids[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
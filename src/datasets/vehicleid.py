@@ -5,6 +5,7 @@ import random
 from collections import defaultdict
 
 from .base import BaseImageDataset
+from .columnar import ColumnarDataset
 
 
 class VehicleID(BaseImageDataset):
@@ -30,6 +31,7 @@ class VehicleID(BaseImageDataset):
     """
 
     dataset_dir = "VehicleID"
+    test_sizes = [800, 1600, 2400, 3200, 6000, 13164]
 
     def __init__(self, root="datasets", verbose=True, test_size=800, **kwargs):
         super().__init__(root)
@@ -38,22 +40,16 @@ class VehicleID(BaseImageDataset):
         self.split_dir = osp.join(self.dataset_dir, "train_test_split")
         self.train_list = osp.join(self.split_dir, "train_list.txt")
         self.test_size = test_size
-
-        if self.test_size == 800:
-            self.test_list = osp.join(self.split_dir, "test_list_800.txt")
-        elif self.test_size == 1600:
-            self.test_list = osp.join(self.split_dir, "test_list_1600.txt")
-        elif self.test_size == 2400:
-            self.test_list = osp.join(self.split_dir, "test_list_2400.txt")
+        self.test_list = osp.join(self.split_dir, f"test_list_{self.test_size}.txt")
 
         print(self.test_list)
 
         self.check_before_run()
 
         train, query, gallery = self.process_split(relabel=True)
-        self.train = train
-        self.query = query
-        self.gallery = gallery
+        self.train = ColumnarDataset(train)
+        self.query = ColumnarDataset(query)
+        self.gallery = ColumnarDataset(gallery)
 
         if verbose:
             print("=> VehicleID loaded")
@@ -83,7 +79,7 @@ class VehicleID(BaseImageDataset):
             raise RuntimeError(f'"{self.split_dir}" is not available')
         if not osp.exists(self.train_list):
             raise RuntimeError(f'"{self.train_list}" is not available')
-        if self.test_size not in [800, 1600, 2400]:
+        if self.test_size not in self.test_sizes:
             raise RuntimeError(f'"{self.test_size}" is not available')
         if not osp.exists(self.test_list):
             raise RuntimeError(f'"{self.test_list}" is not available')
@@ -102,23 +98,39 @@ class VehicleID(BaseImageDataset):
             if pid2label is not None:
                 pid = pid2label[pid]
             camid = 1  # don't have camid information use 1 for all
-            img_path = osp.join(self.img_dir, name + ".jpg")
-            output.append((img_path, pid, camid))
+            output.append((self.get_img_path(name), pid, camid))
         return output
 
-    def process_split(self, relabel=False):
-        # read train paths
-        train_pid_dict = defaultdict(list)
+    def get_img_path(self, name):
+        return osp.join(self.img_dir, name + ".jpg")
 
+    def parse_lists(self):
+        """Return the (name, pid) pairs of the train and test lists"""
         # 'train_list.txt' format:
         # the first number is the number of image
         # the second number is the id of vehicle
-        with open(self.train_list) as f_train:
-            train_data = f_train.readlines()
-            for data in train_data:
-                name, pid = data.split(" ")
-                pid = int(pid)
-                train_pid_dict[pid].append([name, pid])
+        lists = {}
+        for key, list_path in (("train", self.train_list), ("test", self.test_list)):
+            with open(list_path) as f:
+                lists[key] = [line.split(" ") for line in f.readlines()]
+        return lists
+
+    def process_split(self, relabel=False):
+        lists = self.load_manifest([self.train_list, self.test_list], self.parse_lists)
+        quarantined = self.load_quarantine()
+        if quarantined:
+            for key in lists:
+                lists[key] = [
+                    (name, pid)
+                    for name, pid in lists[key]
+                    if osp.abspath(self.get_img_path(name)) not in quarantined
+                ]
+
+        # read train paths
+        train_pid_dict = defaultdict(list)
+        for name, pid in lists["train"]:
+            pid = int(pid)
+            train_pid_dict[pid].append([name, pid])
         train_pids = list(train_pid_dict.keys())
         num_train_pids = len(train_pids)
         assert num_train_pids == 13164, (
@@ -127,11 +139,9 @@ class VehicleID(BaseImageDataset):
         )
         print(f"num of train ids: {num_train_pids}")
         test_pid_dict = defaultdict(list)
-        with open(self.test_list) as f_test:
-            test_data = f_test.readlines()
-            for data in test_data:
-                name, pid = data.split(" ")
-                test_pid_dict[pid].append([name, pid])
+        for name, pid in lists["test"]:
+            pid = int(pid)
+            test_pid_dict[pid].append([name, pid])
         test_pids = list(test_pid_dict.keys())
         num_test_pids = len(test_pids)
         assert num_test_pids == self.test_size, (
@@ -163,8 +173,6 @@ class VehicleID(BaseImageDataset):
             train_pid2label = self.get_pid2label(train_pids)
         else:
             train_pid2label = None
-        for key, value in train_pid2label.items():
-            print(f"{key}:{value}")
 
         train = self.parse_img_pids(train_data, train_pid2label)
         query = self.parse_img_pids(query_data)
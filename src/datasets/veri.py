@@ -5,6 +5,7 @@ import os.path as osp
 import re
 
 from .base import BaseImageDataset
+from .columnar import ColumnarDataset
 
 
 class VeRi(BaseImageDataset):
@@ -30,17 +31,22 @@ class VeRi(BaseImageDataset):
 
         self.check_before_run()
 
-        train = self.process_dir(self.train_dir, relabel=True)
-        query = self.process_dir(self.query_dir, relabel=False)
-        gallery = self.process_dir(self.gallery_dir, relabel=False)
+        dirs = [self.train_dir, self.query_dir, self.gallery_dir]
+        manifest = self.load_manifest(
+            dirs, lambda: {osp.basename(d): self.parse_dir(d) for d in dirs}
+        )
+        quarantined = self.load_quarantine()
+        train = self.process_dir(self.train_dir, manifest, quarantined, relabel=True)
+        query = self.process_dir(self.query_dir, manifest, quarantined)
+        gallery = self.process_dir(self.gallery_dir, manifest, quarantined)
 
         if verbose:
             print("=> VeRi loaded")
             self.print_dataset_statistics(train, query, gallery)
 
-        self.train = train
-        self.query = query
-        self.gallery = gallery
+        self.train = ColumnarDataset(train)
+        self.query = ColumnarDataset(query)
+        self.gallery = ColumnarDataset(gallery)
 
         (
             self.num_train_pids,
@@ -69,26 +75,39 @@ class VeRi(BaseImageDataset):
         if not osp.exists(self.gallery_dir):
             raise RuntimeError(f'"{self.gallery_dir}" is not available')
 
-    def process_dir(self, dir_path, relabel=False):
-        img_paths = glob.glob(osp.join(dir_path, "*.jpg"))
+    def parse_dir(self, dir_path):
+        """Return image names, pids and camids (starting from 0) of a directory"""
         pattern = re.compile(r"([-\d]+)_c([-\d]+)")
 
-        pid_container = set()
-        for img_path in img_paths:
-            pid, _ = map(int, pattern.search(img_path).groups())
-            if pid == -1:
-                continue  # junk images are just ignored
-            pid_container.add(pid)
-        pid2label = {pid: label for label, pid in enumerate(pid_container)}
-
-        dataset = []
-        for img_path in img_paths:
+        names, pids, camids = [], [], []
+        for img_path in glob.glob(osp.join(dir_path, "*.jpg")):
             pid, camid = map(int, pattern.search(img_path).groups())
             if pid == -1:
                 continue  # junk images are just ignored
             assert 0 <= pid <= 1501  # pid == 0 means background
             assert 1 <= camid <= 20
-            camid -= 1  # index starts from 0
+            names.append(osp.basename(img_path))
+            pids.append(pid)
+            camids.append(camid - 1)  # index starts from 0
+        return {"names": names, "pids": pids, "camids": camids}
+
+    def process_dir(self, dir_path, manifest, quarantined=(), relabel=False):
+        parsed = manifest[osp.basename(dir_path)]
+        data = [
+            (osp.join(dir_path, name), pid, camid)
+            for name, pid, camid in zip(
+                parsed["names"], parsed["pids"], parsed["camids"]
+            )
+        ]
+        if quarantined:
+            # dropped before relabelling, so that labels stay contiguous
+            data = [item for item in data if osp.abspath(item[0]) not in quarantined]
+
+        pid_container = {pid for _, pid, _ in data}
+        pid2label = {pid: label for label, pid in enumerate(pid_container)}
+
+        dataset = []
+        for img_path, pid, camid in data:
             if relabel:
                 pid = pid2label[pid]
             dataset.append((img_path, pid, camid))
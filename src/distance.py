@@ -0,0 +1,36 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import torch
+
+
+def compute_distance_matrix(input1, input2, metric="euclidean"):
+    """Distance between every pair of rows
+    Args:
+    - input1 (torch.Tensor): matrix with shape (m, feat_dim).
+    - input2 (torch.Tensor): matrix with shape (n, feat_dim).
+    - metric (str): "euclidean" (squared euclidean distance) or "cosine"
+                    (cosine distance, inputs must be L2-normalized).
+    Returns:
+    - distmat (torch.Tensor): matrix with shape (m, n), in the dtype of the inputs.
+    """
+    if metric == "euclidean":
+        m, n = input1.size(0), input2.size(0)
+        distmat = (
+            torch.pow(input1, 2).sum(dim=1, keepdim=True).expand(m, n)
+            + torch.pow(input2, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+        )
+        distmat.addmm_(input1, input2.t(), beta=1, alpha=-2)
+    elif metric == "cosine":
+        # a single matrix product: 1 - <x, y> for unit vectors
+        distmat = torch.mm(input1, input2.t()).neg_().add_(1)
+    else:
+        raise ValueError(f"Unsupported distance metric: {metric}")
+    return distmat
+
+
+def to_numpy(distmat):
+    """Convert a distance matrix to numpy, which has no bfloat16 type, so bfloat16
+    is widened to float32 (exactly, the order of distances is unchanged)."""
+    if distmat.dtype == torch.bfloat16:
+        distmat = distmat.float()
+    return distmat.numpy()
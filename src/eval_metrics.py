@@ -1,129 +1,414 @@
 # Copyright (c) EEEM071, University of Surrey
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from .distance import compute_distance_matrix, to_numpy
+from .utils.generaltools import peak_memory_mb
 
-def eval_vehicleid(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
-    """Evaluation with vehicleid metric
-    Key: gallery contains one images for each test vehicles and the other images in test
-         use as query
+
+class RankAccumulator:
+    """
+    Accumulates CMC hits and per-query average precision over blocks of queries,
+    so that CMC/mAP can be computed without holding every query at once.
+    Args:
+    - max_rank (int): length of the CMC curve.
     """
-    num_q, num_g = distmat.shape
 
-    if num_g < max_rank:
-        max_rank = num_g
-        print(f"Note: number of gallery samples is quite small, got {num_g}")
+    def __init__(self, max_rank):
+        self.max_rank = max_rank
+        self.cmc_hits = np.zeros(max_rank, dtype=np.int64)
+        self.all_AP = []
+        self.num_valid_q = 0
+
+    def update(self, cmc_hits, APs):
+        self.cmc_hits += cmc_hits
+        self.all_AP.append(APs)
+        self.num_valid_q += len(APs)
 
+    def compute(self):
+        assert (
+            self.num_valid_q > 0
+        ), "Error: all query identities do not appear in gallery"
+        all_cmc = self.cmc_hits.astype(np.float32) / float(self.num_valid_q)
+        mAP = np.mean(np.concatenate(self.all_AP))
+        return all_cmc, mAP
+
+
+def eval_block_sort(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, remove_junk):
+    """Evaluate a block of queries at once by sorting the full gallery of each query
+    Args:
+    - distmat (np.ndarray): distance matrix of shape (num_query_block, num_gallery).
+    - max_rank (int): length of the CMC curve.
+    - remove_junk (bool): discard gallery samples that have the same pid and camid
+                          with the query.
+    Returns:
+    - cmc_hits (np.ndarray): number of valid queries matched within each rank.
+    - APs (np.ndarray): average precision of each valid query.
+    """
     indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
+    matches = g_pids[indices] == q_pids[:, np.newaxis]
 
-    # compute cmc curve for each query
-    all_cmc = []
+    if remove_junk:
+        keep = ~(matches & (g_camids[indices] == q_camids[:, np.newaxis]))
+        matches &= keep
+        # 1-based position of each sample once the junk has been discarded,
+        # junk in front of the first kept sample is clipped to 1 as it is never used
+        kept_rank = np.maximum(np.cumsum(keep, axis=1), 1)
+    else:
+        kept_rank = np.arange(1, matches.shape[1] + 1)[np.newaxis, :]
+
+    # binary vectors, positions with value 1 are correct matches
+    num_rel = matches.sum(1)
+    valid = num_rel > 0  # false when query identity does not appear in gallery
+    matches = matches[valid]
+    num_rel = num_rel[valid]
+    if remove_junk:
+        kept_rank = kept_rank[valid]
+
+    # cmc curve: a query is matched from the rank of its first correct match onwards
+    first_match = matches.argmax(1)
+    if remove_junk:
+        first_rank = kept_rank[np.arange(len(first_match)), first_match]
+    else:
+        first_rank = first_match + 1
+    cmc_hits = np.bincount(
+        np.minimum(first_rank, max_rank + 1) - 1, minlength=max_rank + 1
+    )
+    cmc_hits = np.cumsum(cmc_hits[:max_rank])
+
+    # average precision
+    # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+    precision = np.cumsum(matches, axis=1) / kept_rank.astype(np.float64)
+    APs = (precision * matches).sum(1) / num_rel
+
+    return cmc_hits, APs
+
+
+def eval_block_count(
+    distmat, q_pids, g_pids, q_camids, g_camids, max_rank, remove_junk
+):
+    """Evaluate a block of queries without sorting the gallery
+    Exact AP and CMC only need the rank of every correct match, which is one plus
+    the number of valid gallery samples closer to the query. Only the correct
+    matches are sorted, so the cost per query is O(num_gallery * log(num_rel))
+    and no (num_query, num_gallery) index or match matrix is allocated. The CMC
+    curve follows from the rank of the best match. Ties between a correct match
+    and a wrong one are resolved in favour of the correct match.
+    Args and returns are the same as eval_block_sort.
+    """
+    cmc_hits = np.zeros(max_rank + 1, dtype=np.int64)
     all_AP = []
-    num_valid_q = 0.0  # number of valid query
-
-    for q_idx in range(num_q):
-        # get query pid and camid
-        # remove gallery samples that have the same pid and camid with query
-        """
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid) # original remove
-        """
-        remove = False  # without camid imformation remove no images in gallery
-        keep = np.invert(remove)
-        # compute cmc curve
-        raw_cmc = matches[q_idx][
-            keep
-        ]  # binary vector, positions with value 1 are correct matches
-        if not np.any(raw_cmc):
+
+    for dist, q_pid, q_camid in zip(distmat, q_pids, q_camids):
+        same_pid = g_pids == q_pid
+        if remove_junk:
+            # gallery samples with the same pid and camid are neither positives
+            # nor negatives, so they simply drop out of the ranking
+            positive = same_pid & (g_camids != q_camid)
+        else:
+            positive = same_pid
+        pos_dist = np.sort(dist[positive])
+        num_rel = pos_dist.size
+        if num_rel == 0:
             # this condition is true when query identity does not appear in gallery
             continue
 
-        cmc = raw_cmc.cumsum()
-        cmc[cmc > 1] = 1
-
-        all_cmc.append(cmc[:max_rank])
-        num_valid_q += 1.0
+        # for each negative, the number of correct matches ranked in front of it
+        num_pos_ahead = np.searchsorted(pos_dist, dist[~same_pid], side="right")
+        # for each correct match, the number of negatives ranked in front of it
+        num_neg_ahead = np.cumsum(np.bincount(num_pos_ahead, minlength=num_rel + 1))
+        hits = np.arange(1, num_rel + 1)
+        ranks = num_neg_ahead[:num_rel] + hits
 
-        # compute average precision
-        # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = raw_cmc.sum()
-        tmp_cmc = raw_cmc.cumsum()
-        tmp_cmc = [x / (i + 1.0) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
-        AP = tmp_cmc.sum() / num_rel
-        all_AP.append(AP)
+        cmc_hits[min(ranks[0], max_rank + 1) - 1] += 1
+        all_AP.append((hits / ranks.astype(np.float64)).sum() / num_rel)
 
-    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+    return np.cumsum(cmc_hits[:max_rank]), np.asarray(all_AP, dtype=np.float64)
 
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
-    all_cmc = all_cmc.sum(0) / num_valid_q
-    mAP = np.mean(all_AP)
 
-    return all_cmc, mAP
+__block_evaluators = {
+    "sort": eval_block_sort,
+    "count": eval_block_count,
+}
 
 
-def eval_veri(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
-    """Evaluation with veri metric
-    Key: for each query identity, its gallery images from the same camera view are discarded.
+def eval_distance_blocks(
+    distmat_blocks,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    max_rank,
+    remove_junk,
+    method="sort",
+):
+    """Evaluate queries from an iterable of distance matrix blocks
+    Args:
+    - distmat_blocks (iterable): consecutive row blocks of the (num_query, num_gallery)
+                                 distance matrix. Each block is released once it has
+                                 been evaluated, so blocks can be produced on the fly.
+    - method (str): "sort" (argsort every gallery) or "count" (rank correct matches only).
     """
-    num_q, num_g = distmat.shape
+    if method not in __block_evaluators:
+        raise ValueError(f"Unsupported evaluation method: {method}")
+    eval_block = __block_evaluators[method]
+    num_g = len(g_pids)
 
     if num_g < max_rank:
         max_rank = num_g
         print(f"Note: number of gallery samples is quite small, got {num_g}")
 
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
+    accumulator = RankAccumulator(max_rank)
+    start = 0
+    for distmat in distmat_blocks:
+        end = start + distmat.shape[0]
+        accumulator.update(
+            *eval_block(
+                distmat,
+                q_pids[start:end],
+                g_pids,
+                q_camids[start:end],
+                g_camids,
+                max_rank,
+                remove_junk,
+            )
+        )
+        start = end
 
-    # compute cmc curve for each query
-    all_cmc = []
-    all_AP = []
-    num_valid_q = 0.0  # number of valid query
-
-    for q_idx in range(num_q):
-        # get query pid and camid
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-
-        # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-        keep = np.invert(remove)
-
-        # compute cmc curve
-        raw_cmc = matches[q_idx][
-            keep
-        ]  # binary vector, positions with value 1 are correct matches
-        if not np.any(raw_cmc):
-            # this condition is true when query identity does not appear in gallery
-            continue
+    return accumulator.compute()
+
+
+def eval_ranks(
+    distmat,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    max_rank,
+    remove_junk,
+    block_size=256,
+    method="sort",
+):
+    """Evaluate all queries in blocks of block_size rows, which bounds the memory
+    of the sort and mask matrices to O(block_size * num_gallery)."""
+    return eval_distance_blocks(
+        (
+            distmat[start : start + block_size]
+            for start in range(0, distmat.shape[0], block_size)
+        ),
+        q_pids,
+        g_pids,
+        q_camids,
+        g_camids,
+        max_rank,
+        remove_junk,
+        method=method,
+    )
+
+
+def eval_vehicleid(
+    distmat, q_pids, g_pids, q_camids, g_camids, max_rank, block_size=256, method="sort"
+):
+    """Evaluation with vehicleid metric
+    Key: gallery contains one images for each test vehicles and the other images in test
+         use as query
+    """
+    # without camid imformation remove no images in gallery
+    return eval_ranks(
+        distmat,
+        q_pids,
+        g_pids,
+        q_camids,
+        g_camids,
+        max_rank,
+        remove_junk=False,
+        block_size=block_size,
+        method=method,
+    )
+
+
+def eval_veri(
+    distmat, q_pids, g_pids, q_camids, g_camids, max_rank, block_size=256, method="sort"
+):
+    """Evaluation with veri metric
+    Key: for each query identity, its gallery images from the same camera view are discarded.
+    """
+    return eval_ranks(
+        distmat,
+        q_pids,
+        g_pids,
+        q_camids,
+        g_camids,
+        max_rank,
+        remove_junk=True,
+        block_size=block_size,
+        method=method,
+    )
 
-        cmc = raw_cmc.cumsum()
-        cmc[cmc > 1] = 1
 
-        all_cmc.append(cmc[:max_rank])
-        num_valid_q += 1.0
+def evaluate(
+    distmat,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    max_rank=50,
+    method="sort",
+    use_metric_vehicleid=False,
+):
+    if use_metric_vehicleid:
+        return eval_vehicleid(
+            distmat, q_pids, g_pids, q_camids, g_camids, max_rank, method=method
+        )
+    return eval_veri(
+        distmat, q_pids, g_pids, q_camids, g_camids, max_rank, method=method
+    )
 
-        # compute average precision
-        # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = raw_cmc.sum()
-        tmp_cmc = raw_cmc.cumsum()
-        tmp_cmc = [x / (i + 1.0) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
-        AP = tmp_cmc.sum() / num_rel
-        all_AP.append(AP)
 
-    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+def evaluate_features(
+    qf,
+    gf,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    max_rank=50,
+    block_size=256,
+    method="sort",
+    metric="euclidean",
+    use_metric_vehicleid=False,
+):
+    """Evaluate query and gallery features without building the full distance matrix
+    Distances are computed for block_size queries at a time and folded into the
+    running CMC/AP totals, so peak memory is O(block_size * num_gallery).
+    Args:
+    - qf (torch.Tensor): query features with shape (num_query, feat_dim).
+    - gf (torch.Tensor): gallery features with shape (num_gallery, feat_dim).
+    - metric (str): distance metric, see compute_distance_matrix. Distances are
+                    computed (and ranked) in the dtype of the features.
+    - use_metric_vehicleid (bool): evaluate with the vehicleid metric instead of veri.
+    """
+    distmat_blocks = (
+        to_numpy(compute_distance_matrix(qf[start : start + block_size], gf, metric))
+        for start in range(0, qf.size(0), block_size)
+    )
+    return eval_distance_blocks(
+        distmat_blocks,
+        q_pids,
+        g_pids,
+        q_camids,
+        g_camids,
+        max_rank,
+        remove_junk=not use_metric_vehicleid,
+        method=method,
+    )
+
+
+def evaluate_index(
+    qf,
+    gallery_index,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    max_rank=50,
+    block_size=256,
+    method="sort",
+    use_metric_vehicleid=False,
+):
+    """Evaluate queries against an exhaustive gallery index (e.g. a product-quantized
+    gallery from src.retrieval), block by block as in evaluate_features.
+    Args:
+    - qf (torch.Tensor): query features with shape (num_query, feat_dim).
+    - gallery_index: index implementing compute_distances(queries).
+    """
+    distmat_blocks = (
+        to_numpy(gallery_index.compute_distances(qf[start : start + block_size]))
+        for start in range(0, qf.size(0), block_size)
+    )
+    return eval_distance_blocks(
+        distmat_blocks,
+        q_pids,
+        g_pids,
+        q_camids,
+        g_camids,
+        max_rank,
+        remove_junk=not use_metric_vehicleid,
+        method=method,
+    )
+
 
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
-    all_cmc = all_cmc.sum(0) / num_valid_q
-    mAP = np.mean(all_AP)
+def random_gallery_splits(pids, num_splits, seed=0):
+    """
+    Random gallery/query partitions of a test set, as in the VehicleID protocol:
+    one random image of every identity goes to the gallery, the others are queries.
+    Returns a list of (query_indices, gallery_indices).
+    """
+    rng = np.random.RandomState(seed)
+    splits = []
+    for _ in range(num_splits):
+        perm = rng.permutation(len(pids))
+        # the first occurrence of each identity in a random order is a random pick
+        _, first = np.unique(pids[perm], return_index=True)
+        is_gallery = np.zeros(len(pids), dtype=bool)
+        is_gallery[perm[first]] = True
+        splits.append((np.flatnonzero(~is_gallery), np.flatnonzero(is_gallery)))
+    return splits
+
+
+def evaluate_random_splits(
+    features, pids, camids, num_splits=10, seed=0, workers=1, **kwargs
+):
+    """
+    Evaluate num_splits random gallery/query partitions of the same test features
+    with the vehicleid metric, so that the features are extracted only once.
+    Splits are evaluated in parallel threads (matrix products and sorting release
+    the GIL). The time of every split is printed, with the peak memory of the
+    process so far, which includes the model, the features and the other splits,
+    as splits share the process and may run concurrently.
+    Args:
+    - features (torch.Tensor): features of every test image.
+    - pids, camids (np.ndarray): labels of every test image.
+    - kwargs: passed to evaluate_features.
+    Returns:
+    - all_cmc (np.ndarray): CMC curves with shape (num_splits, max_rank).
+    - all_mAP (np.ndarray): mAP of every split.
+    """
 
-    return all_cmc, mAP
+    def _evaluate(split_idx):
+        q_idx, g_idx = splits[split_idx]
+        start = time.time()
+        cmc, mAP = evaluate_features(
+            features[q_idx],
+            features[g_idx],
+            pids[q_idx],
+            pids[g_idx],
+            camids[q_idx],
+            camids[g_idx],
+            use_metric_vehicleid=True,
+            **kwargs,
+        )
+        print(
+            "Split {}: # query {}, # gallery {}, rank1 {:.1%}, mAP {:.1%}, "
+            "time {:.1f}s, process peak memory {:.0f} MB".format(
+                split_idx + 1,
+                len(q_idx),
+                len(g_idx),
+                cmc[0],
+                mAP,
+                time.time() - start,
+                peak_memory_mb(),
+            )
+        )
+        return cmc, mAP
 
+    splits = random_gallery_splits(pids, num_splits, seed)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = list(executor.map(_evaluate, range(num_splits)))
 
-def evaluate(distmat, q_pids, g_pids, q_camids, g_camids, max_rank=50):
-    return eval_veri(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
+    all_cmc = np.stack([cmc for cmc, _ in results])
+    all_mAP = np.asarray([mAP for _, mAP in results])
+    return all_cmc, all_mAP
@@ -0,0 +1,106 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import hashlib
+import os
+import os.path as osp
+import shutil
+import uuid
+
+import numpy as np
+import torch
+
+from .utils.iotools import mkdir_if_missing, read_json, write_json
+
+
+def hash_state_dict(model):
+    """Hash the weights of a model, ignoring the "module." prefix of nn.DataParallel"""
+    sha = hashlib.sha1()
+    for k, v in sorted(model.state_dict().items()):
+        if k.startswith("module."):
+            k = k[7:]
+        sha.update(k.encode())
+        sha.update(str(v.dtype).encode())
+        sha.update(v.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    return sha.hexdigest()
+
+
+class FeatureStore:
+    """
+    On-disk cache of extracted features.
+    Every entry is a directory holding features.npy, pids.npy and camids.npy,
+    which are memory-mapped when loaded, so reusing an entry costs no forward pass.
+    Args:
+    - cache_dir (str): directory to save the entries.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        mkdir_if_missing(self.cache_dir)
+
+    @staticmethod
+    def make_key(weights_hash, arch, height, width, img_paths, **kwargs):
+        """
+        Build the key of an entry.
+        Args:
+        - weights_hash (str): output of hash_state_dict.
+        - arch (str): model architecture.
+        - height, width (int): test image size.
+        - img_paths (list): images the features are extracted from, in order.
+        - kwargs: any other setting the features depend on.
+        """
+        sha = hashlib.sha1()
+        sha.update(f"{weights_hash}|{arch}|{height}|{width}".encode())
+        for k in sorted(kwargs):
+            sha.update(f"|{k}={kwargs[k]}".encode())
+        for img_path in img_paths:
+            sha.update(f"\n{img_path}".encode())
+        return sha.hexdigest()
+
+    def load(self, key):
+        """Return (features, pids, camids) of an entry, or None if it is missing"""
+        entry_dir = osp.join(self.cache_dir, key)
+        if not osp.isfile(osp.join(entry_dir, "meta.json")):
+            return None
+        meta = read_json(osp.join(entry_dir, "meta.json"))
+        # copy-on-write mapping, pages are only read from disk when touched
+        features = np.load(osp.join(entry_dir, "features.npy"), mmap_mode="c")
+        features = torch.from_numpy(features)
+        if meta.get("dtype") == "bfloat16":
+            features = features.view(torch.bfloat16)
+        pids = np.load(osp.join(entry_dir, "pids.npy"))
+        camids = np.load(osp.join(entry_dir, "camids.npy"))
+        return features, pids, camids
+
+    def save(self, key, features, pids, camids, **meta):
+        """
+        Write an entry. Files are written to a temporary directory first, which is
+        renamed at the end, so an interrupted run never leaves a partial entry behind.
+        """
+        entry_dir = osp.join(self.cache_dir, key)
+        tmp_dir = osp.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}")
+        mkdir_if_missing(tmp_dir)
+
+        meta["dtype"] = str(features.dtype).replace("torch.", "")
+        if features.dtype == torch.bfloat16:
+            # numpy has no bfloat16, the raw bits are stored instead
+            features = features.view(torch.int16)
+        features = features.numpy()
+        mmap = np.lib.format.open_memmap(
+            osp.join(tmp_dir, "features.npy"),
+            mode="w+",
+            dtype=features.dtype,
+            shape=features.shape,
+        )
+        mmap[:] = features
+        mmap.flush()
+        del mmap
+        np.save(osp.join(tmp_dir, "pids.npy"), np.asarray(pids, dtype=np.int64))
+        np.save(osp.join(tmp_dir, "camids.npy"), np.asarray(camids, dtype=np.int64))
+        meta.update({"num": features.shape[0], "dim": features.shape[1]})
+        write_json(meta, osp.join(tmp_dir, "meta.json"))
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another run has written the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
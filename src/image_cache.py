@@ -0,0 +1,136 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import hashlib
+import itertools
+import os
+import os.path as osp
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from .dataset_loader import read_image
+from .utils.iotools import mkdir_if_missing, read_json, write_json
+
+
+class ImageCache:
+    """
+    On-disk cache of decoded images, resized to height x width.
+    Images are stored in one uint8 array of shape (N, height, width, 3) next to an
+    index of their paths. The array is memory-mapped when loaded, so reading an
+    image is a slice of the page cache instead of a JPEG decode and a resize.
+    The entry is built the first time a set of images is seen at a resolution.
+    Args:
+    - cache_dir (str): directory to save the entries.
+    - img_paths (list): images to cache.
+    - height (int): target image height.
+    - width (int): target image width.
+    - workers (int): number of threads decoding images while the entry is built.
+    - jpeg_draft (bool): decode JPEGs at reduced resolution, see open_image.
+    """
+
+    def __init__(
+        self, cache_dir, img_paths, height, width, workers=4, jpeg_draft=False
+    ):
+        self.height = height
+        self.width = width
+        self.jpeg_draft = jpeg_draft
+        img_paths = sorted(set(img_paths))
+
+        sha = hashlib.sha1()
+        sha.update(f"{height}|{width}".encode())
+        if jpeg_draft:
+            sha.update(b"|draft")
+        for img_path in img_paths:
+            sha.update(f"\n{img_path}".encode())
+        self.entry_dir = osp.join(cache_dir, sha.hexdigest())
+
+        if not osp.isfile(osp.join(self.entry_dir, "index.json")):
+            self._build(cache_dir, img_paths, workers)
+        # sorted encoded paths and their rows in images, looked up by binary
+        # search: two arrays instead of a dict of per-image objects, which forked
+        # dataloader workers would copy by touching reference counts
+        paths = np.array(
+            [p.encode() for p in read_json(osp.join(self.entry_dir, "index.json"))],
+            dtype=bytes,
+        )
+        self.rows = np.argsort(paths, kind="stable")
+        self.paths = paths[self.rows]
+        self._images = None
+
+    def _build(self, cache_dir, img_paths, workers):
+        print(
+            f"=> Caching {len(img_paths)} images at {self.height}x{self.width} "
+            f"to {self.entry_dir}"
+        )
+        # written to a temporary directory which is renamed at the end, so an
+        # interrupted run never leaves a partial entry behind
+        tmp_dir = osp.join(
+            cache_dir, f".{osp.basename(self.entry_dir)}.{uuid.uuid4().hex}"
+        )
+        mkdir_if_missing(tmp_dir)
+        images = np.lib.format.open_memmap(
+            osp.join(tmp_dir, "images.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(img_paths), self.height, self.width, 3),
+        )
+
+        def load(images, i):
+            # same resampling as T.Resize((height, width)) in build_transforms
+            draft_size = (self.height, self.width) if self.jpeg_draft else None
+            img = read_image(img_paths[i], draft_size).resize(
+                (self.width, self.height), Image.BILINEAR
+            )
+            images[i] = np.asarray(img)
+
+        with ThreadPoolExecutor(max(workers, 1)) as executor:
+            for _ in executor.map(
+                load, itertools.repeat(images), range(len(img_paths))
+            ):
+                pass
+        images.flush()
+        write_json(img_paths, osp.join(tmp_dir, "index.json"))
+
+        try:
+            os.rename(tmp_dir, self.entry_dir)
+        except OSError:
+            # another run has written the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @property
+    def images(self):
+        # opened lazily, so that every dataloader worker maps the file itself
+        # instead of receiving a pickled copy of the array
+        if self._images is None:
+            self._images = np.load(
+                osp.join(self.entry_dir, "images.npy"), mmap_mode="r"
+            )
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def _row(self, img_path):
+        key = img_path.encode()
+        i = np.searchsorted(self.paths, key)
+        if i == len(self.paths) or self.paths[i] != key:
+            return None
+        return self.rows[i]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, img_path):
+        return self._row(img_path) is not None
+
+    def __getitem__(self, img_path):
+        """Return the (height, width, 3) uint8 view of an image"""
+        row = self._row(img_path)
+        if row is None:
+            raise KeyError(img_path)
+        return self.images[row]
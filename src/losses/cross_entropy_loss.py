@@ -15,7 +15,7 @@ class CrossEntropyLoss(nn.Module):
     Args:
     - num_classes (int): number of classes
     - epsilon (float): weight
-    - use_gpu (bool): whether to use gpu devices
+    - use_gpu (bool): unused, the loss is computed on the device of the inputs
     - label_smooth (bool): whether to apply label smoothing, if False, epsilon = 0
     """
 
@@ -33,11 +33,11 @@ class CrossEntropyLoss(nn.Module):
         - targets: ground truth labels with shape (num_classes)
         """
         log_probs = self.logsoftmax(inputs)
-        targets = torch.zeros(log_probs.size()).scatter_(
-            1, targets.unsqueeze(1).data.cpu(), 1
-        )
-        if self.use_gpu:
-            targets = targets.cuda()
-        targets = (1 - self.epsilon) * targets + self.epsilon / self.num_classes
-        loss = (-targets * log_probs).mean(0).sum()
-        return loss
+        # sum of the smoothed targets times the log probabilities, without
+        # building the (batch_size, num_classes) target matrix
+        nll = -log_probs.gather(1, targets.unsqueeze(1)).squeeze(1)
+        loss = (1 - self.epsilon) * nll
+        if self.epsilon > 0:
+            # smoothed over the classes scored, e.g. those sampled by PartialFC
+            loss = loss - self.epsilon / inputs.size(1) * log_probs.sum(1)
+        return loss.mean()
@@ -9,15 +9,29 @@ class TripletLoss(nn.Module):
 
     Reference:
     Hermans et al. In Defense of the Triplet Loss for Person Re-Identification. arXiv:1703.07737.
+    Schroff et al. FaceNet: A Unified Embedding for Face Recognition and Clustering. CVPR 2015.
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py.
 
     Args:
     - margin (float): margin for triplet.
+    - mining (str): triplets the loss is computed on,
+      "hard": the hardest positive and negative of every anchor (batch hard),
+      "batch_all": all triplets of the batch, averaged over those with a positive loss,
+      "semi_hard": for every anchor-positive pair, the closest negative farther than
+      the positive, or the farthest negative if there is none.
     """
 
-    def __init__(self, margin=0.3):
+    minings = ["hard", "batch_all", "semi_hard"]
+
+    def __init__(self, margin=0.3, mining="hard"):
         super().__init__()
+        if mining not in self.minings:
+            raise KeyError(
+                f'Invalid triplet mining, got "{mining}", but expected to be one of '
+                f"{self.minings}"
+            )
         self.margin = margin
+        self.mining = mining
         self.ranking_loss = nn.MarginRankingLoss(margin=margin)
 
     def forward(self, inputs, targets):
@@ -26,24 +40,42 @@ class TripletLoss(nn.Module):
         - inputs: feature matrix with shape (batch_size, feat_dim)
         - targets: ground truth labels with shape (num_classes)
         """
-        n = inputs.size(0)
-
         # Compute pairwise distance, replace by the official when merged
-        dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
+        dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True)
         dist = dist + dist.t()
         dist.addmm_(inputs, inputs.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
 
-        # For each anchor, find the hardest positive and negative
-        mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
-
-        # Compute ranking hinge loss
-        y = torch.ones_like(dist_an)
-        loss = self.ranking_loss(dist_an, dist_ap, y)
-        return loss
+        is_pos = targets[:, None] == targets[None, :]
+
+        if self.mining == "hard":
+            # For each anchor, find the hardest positive and negative
+            inf = dist.new_tensor(float("inf"))
+            dist_ap = torch.where(is_pos, dist, -inf).amax(1)
+            dist_an = torch.where(is_pos, inf, dist).amin(1)
+
+            # Compute ranking hinge loss
+            y = torch.ones_like(dist_an)
+            return self.ranking_loss(dist_an, dist_ap, y)
+
+        # (anchor, positive) pairs, excluding the anchor itself, and the
+        # distances of every pair to all samples, (num_pairs, batch_size)
+        is_pair = is_pos & ~torch.eye(len(dist), dtype=torch.bool, device=dist.device)
+        anchor, positive = is_pair.nonzero(as_tuple=True)
+        dist_ap = dist[anchor, positive][:, None]
+        dist_an = dist[anchor]
+        is_neg = ~is_pos[anchor]
+
+        if self.mining == "batch_all":
+            loss = (dist_ap - dist_an + self.margin).clamp(min=0) * is_neg
+            num_active = (loss > 0).sum()
+            return loss.sum() / num_active.clamp(min=1)
+
+        # semi_hard
+        inf = dist.new_tensor(float("inf"))
+        semi_hard = torch.where(is_neg & (dist_an > dist_ap), dist_an, inf).amin(1)
+        hardest = torch.where(is_neg, dist_an, -inf).amax(1)
+        hardest = torch.where(hardest > -inf, hardest, inf)  # no negative, no loss
+        dist_an = torch.where(semi_hard < inf, semi_hard, hardest)
+        loss = (dist_ap.squeeze(1) - dist_an + self.margin).clamp(min=0)
+        return loss.mean() if len(loss) else dist.sum() * 0
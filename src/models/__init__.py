@@ -1,5 +1,6 @@
 # Copyright (c) EEEM071, University of Surrey
 
+from .partial_fc import PartialFC
 from .resnet import (
     resnet18,
     resnet18_fc512,
@@ -0,0 +1,108 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class _GatherRows(torch.autograd.Function):
+    """Rows of a weight and a bias, with sparse gradients"""
+
+    @staticmethod
+    def forward(ctx, classes, weight, bias):
+        ctx.save_for_backward(classes)
+        ctx.num_classes = weight.size(0)
+        return weight[classes], bias[classes]
+
+    @staticmethod
+    def backward(ctx, grad_weight, grad_bias):
+        (classes,) = ctx.saved_tensors
+        # classes are distinct, so the gradients are coalesced
+        sparse = dict(is_coalesced=True, check_invariants=False)
+        indices = classes[None]
+        return (
+            None,
+            torch.sparse_coo_tensor(
+                indices, grad_weight, (ctx.num_classes, grad_weight.size(1)), **sparse
+            ),
+            torch.sparse_coo_tensor(indices, grad_bias, (ctx.num_classes,), **sparse),
+        )
+
+
+class PartialFC(nn.Module):
+    """
+    Linear classifier computing, in training, the logits of the classes of the
+    batch plus a random subset of the other classes only (sampled softmax). The
+    classes of the batch come first, in increasing order, so the targets of the
+    logits are given by PartialFC.sampled_targets. Parameters have the names and
+    shapes of nn.Linear, and all classes are scored in eval mode.
+    In training, the gradients of the parameters are sparse tensors holding the
+    rows of the scored classes only, which init_optimizer updates row by row, see
+    SampledRowsUpdate.
+
+    Reference:
+    An et al. Partial FC: Training 10 Million Identities on a Single Machine. ICCVW 2021.
+
+    Args:
+    - in_features (int): feature dimension.
+    - num_classes (int): number of classes.
+    - sample_rate (float): fraction of all the classes scored in a step, at least
+      the classes of the batch.
+    """
+
+    def __init__(self, in_features, num_classes, sample_rate=0.1):
+        super().__init__()
+        self.in_features = in_features
+        self.num_classes = num_classes
+        self.sample_rate = sample_rate
+        self.num_sampled = min(num_classes, max(1, int(sample_rate * num_classes)))
+        self.weight = nn.Parameter(torch.empty(num_classes, in_features))
+        self.bias = nn.Parameter(torch.empty(num_classes))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # initialized as nn.Linear
+        nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+        bound = 1 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    @staticmethod
+    def sampled_targets(targets):
+        """Return the targets of the logits computed for a batch of targets"""
+        return torch.unique(targets, return_inverse=True)[1]
+
+    def sample(self, targets):
+        """Return the classes scored for a batch of targets, positives first"""
+        positives = torch.unique(targets)
+        num_negatives = self.num_sampled - len(positives)
+        if num_negatives <= 0:
+            return positives
+        scores = torch.rand(self.num_classes, device=targets.device)
+        scores[positives] = -1
+        negatives = scores.topk(num_negatives, sorted=False)[1]
+        return torch.cat([positives, negatives])
+
+    def forward(self, x, targets=None):
+        if not self.training or targets is None:
+            return F.linear(x, self.weight, self.bias)
+        weight, bias = _GatherRows.apply(self.sample(targets), self.weight, self.bias)
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self):
+        return (
+            f"in_features={self.in_features}, num_classes={self.num_classes}, "
+            f"sample_rate={self.sample_rate}"
+        )
+
+
+def build_classifier(in_features, num_classes, partial_fc=0):
+    """
+    Build the classifier of a model.
+    Args:
+    - partial_fc (float): sample rate of a PartialFC classifier, 0 for nn.Linear.
+    """
+    if partial_fc > 0:
+        return PartialFC(in_features, num_classes, sample_rate=partial_fc)
+    return nn.Linear(in_features, num_classes)
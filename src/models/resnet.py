@@ -6,6 +6,8 @@ import torchvision
 from torch import nn
 from torch.nn import functional as F
 
+from .partial_fc import PartialFC, build_classifier
+
 __all__ = [
     "resnet18",
     "resnet18_fc512",
@@ -124,6 +126,7 @@ class ResNet(nn.Module):
         last_stride=2,
         fc_dims=None,
         dropout_p=None,
+        partial_fc=0,
         **kwargs,
     ):
         self.inplanes = 64
@@ -143,7 +146,7 @@ class ResNet(nn.Module):
 
         self.global_avgpool = nn.AdaptiveAvgPool2d(1)
         self.fc = self._construct_fc_layer(fc_dims, 512 * block.expansion, dropout_p)
-        self.classifier = nn.Linear(self.feature_dim, num_classes)
+        self.classifier = build_classifier(self.feature_dim, num_classes, partial_fc)
 
         self._init_params()
 
@@ -210,7 +213,7 @@ class ResNet(nn.Module):
             elif isinstance(m, nn.BatchNorm1d):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
-            elif isinstance(m, nn.Linear):
+            elif isinstance(m, (nn.Linear, PartialFC)):
                 nn.init.normal_(m.weight, 0, 0.01)
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
@@ -226,7 +229,13 @@ class ResNet(nn.Module):
         x = self.layer4(x)
         return x
 
-    def forward(self, x):
+    def forward(self, x, targets=None):
+        """
+        Args:
+        - x: images with shape (batch_size, 3, height, width)
+        - targets: labels of the images, to sample the classes of a PartialFC
+          classifier from in training (see PartialFC.sampled_targets)
+        """
         f = self.featuremaps(x)
         v = self.global_avgpool(f)
         v = v.view(v.size(0), -1)
@@ -237,7 +246,10 @@ class ResNet(nn.Module):
         if not self.training:
             return v
 
-        y = self.classifier(v)
+        if isinstance(self.classifier, PartialFC):
+            y = self.classifier(v, targets)
+        else:
+            y = self.classifier(v)
 
         if self.loss == {"xent"}:
             return y
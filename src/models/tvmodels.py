@@ -4,11 +4,13 @@ import torch.nn as nn
 import torchvision.models as tvmodels
 import timm
 
+from .partial_fc import PartialFC, build_classifier
+
 __all__ = ["mobilenet_v3_small", "vgg16", "vit_b_16", "swin_v2_tiny_patch4_window7_224"]
 
 
 class TorchVisionModel(nn.Module):
-    def __init__(self, name, num_classes, loss, pretrained, **kwargs):
+    def __init__(self, name, num_classes, loss, pretrained, partial_fc=0, **kwargs):
         super().__init__()
 
         self.loss = loss
@@ -32,15 +34,18 @@ class TorchVisionModel(nn.Module):
               self.feature_dim = self.backbone.heads[0].in_features
               self.backbone.heads = nn.Identity()
 
-        self.classifier = nn.Linear(self.feature_dim, num_classes)
+        self.classifier = build_classifier(self.feature_dim, num_classes, partial_fc)
 
-    def forward(self, x):
+    def forward(self, x, targets=None):
         v = self.backbone(x)
 
         if not self.training:
             return v
 
-        y = self.classifier(v)
+        if isinstance(self.classifier, PartialFC):
+            y = self.classifier(v, targets)
+        else:
+            y = self.classifier(v)
 
         if self.loss == {"xent"}:
             return y
@@ -1,7 +1,222 @@
 # Copyright (c) EEEM071, University of Surrey
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+from torch.distributed.algorithms.join import Join, Joinable, JoinHook
+
+from .models.partial_fc import PartialFC
+
+
+class SampledRowsUpdate(Joinable):
+    """
+    Optimizer step hook updating the PartialFC parameters from their sparse
+    gradients, row by row, before the optimizer steps the other parameters.
+    Only the rows of the classes scored since the last step are read and written:
+    no dense gradient is built, and the rows of the other classes are left
+    bit-identical, with no weight decay and no update of their momentum or
+    moments. The state of every row, in optimizer.state as for any parameter, so
+    that it is saved and resumed as usual, holds its own step count, which gives
+    a row scored for the first time the bias correction of a first Adam step.
+    The hyperparameters of adam, amsgrad, sgd and rmsprop are read from the param
+    group of the parameter, so learning rate schedules apply as usual.
+    In distributed training, DDP ignores the PartialFC parameters (see main.py)
+    and the rows are gathered from all ranks here, averaged as DDP averages
+    gradients. It is a Joinable, to be joined along with the DDP model when ranks
+    have uneven inputs.
+    Args:
+    - optimizer (torch.optim.Optimizer): optimizer of the model.
+    - modules (list): PartialFC modules of the model.
+    """
+
+    def __init__(self, optimizer, modules):
+        super().__init__()
+        if not isinstance(
+            optimizer, (torch.optim.Adam, torch.optim.SGD, torch.optim.RMSprop)
+        ):
+            raise ValueError(
+                f"PartialFC does not support {type(optimizer).__name__}, use adam, "
+                "amsgrad, sgd or rmsprop"
+            )
+        self.optimizer = optimizer
+        self.params = [p for module in modules for p in (module.weight, module.bias)]
+        param_ids = {id(p) for p in self.params}
+        self.groups = {
+            p: group
+            for group in optimizer.param_groups
+            for p in group["params"]
+            if id(p) in param_ids
+        }
+        self.distributed = dist.is_available() and dist.is_initialized()
+        if self.distributed:
+            # not broadcast by DDP, which ignores them
+            for p in self.params:
+                dist.broadcast(p.data, src=0)
+        optimizer.register_step_pre_hook(self.step)
+
+    def step(self, optimizer, args, kwargs):
+        if self.distributed:
+            Join.notify_join_context(self)
+        for p in self.params:
+            rows, grad = self._sparse_grad(p)
+            if self.distributed:
+                rows, grad = self._all_gather(p, rows, grad)
+            if len(rows) and p in self.groups:
+                with torch.no_grad():
+                    self._update(p, rows, grad, self.groups[p])
+            # skipped by the optimizer
+            p.grad = None
+
+    @staticmethod
+    def _sparse_grad(p):
+        if p.grad is None:
+            return (
+                torch.zeros(0, dtype=torch.long, device=p.device),
+                p.new_zeros((0,) + p.shape[1:]),
+            )
+        if p.grad.is_sparse:
+            grad = p.grad.coalesce()
+            return grad.indices()[0], grad.values()
+        # e.g. scored by a forward without targets
+        return torch.arange(len(p), device=p.device), p.grad
+
+    def _all_gather(self, p, rows, grad):
+        world_size = dist.get_world_size()
+        counts = [
+            torch.zeros(1, dtype=torch.long, device=p.device) for _ in range(world_size)
+        ]
+        dist.all_gather(counts, torch.tensor([len(rows)], device=p.device))
+        counts = [int(c) for c in counts]
+        # padded to the same number of rows on every rank
+        size = max(counts)
+        padded_rows = rows.new_zeros(size)
+        padded_rows[: len(rows)] = rows
+        padded_grad = grad.new_zeros((size,) + grad.shape[1:])
+        padded_grad[: len(grad)] = grad
+        all_rows = [torch.empty_like(padded_rows) for _ in range(world_size)]
+        all_grads = [torch.empty_like(padded_grad) for _ in range(world_size)]
+        dist.all_gather(all_rows, padded_rows)
+        dist.all_gather(all_grads, padded_grad)
+        grad = torch.sparse_coo_tensor(
+            torch.cat([r[:c] for r, c in zip(all_rows, counts)])[None],
+            torch.cat([g[:c] for g, c in zip(all_grads, counts)]),
+            p.shape,
+            check_invariants=False,
+        ).coalesce()
+        return grad.indices()[0], grad.values() / world_size
+
+    def _update(self, p, rows, grad, group):
+        state = self.optimizer.state[p]
+        for key in self._state_keys(group):
+            if key not in state:
+                state[key] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        if "row_step" not in state:
+            state["row_step"] = torch.zeros(len(p), device=p.device)
+        step = state["row_step"][rows] + 1
+        state["row_step"][rows] = step
+        # per row factors, broadcast over the row
+        step = step.view((-1,) + (1,) * (p.dim() - 1))
+
+        param = p[rows]
+        if group["weight_decay"] != 0:
+            grad = grad.add(param, alpha=group["weight_decay"])
+        lr = group["lr"]
+
+        if isinstance(self.optimizer, torch.optim.Adam):
+            beta1, beta2 = group["betas"]
+            exp_avg = state["exp_avg"][rows].lerp_(grad, 1 - beta1)
+            exp_avg_sq = state["exp_avg_sq"][rows].mul_(beta2)
+            exp_avg_sq.addcmul_(grad, grad, value=1 - beta2)
+            state["exp_avg"][rows] = exp_avg
+            state["exp_avg_sq"][rows] = exp_avg_sq
+            if group["amsgrad"]:
+                exp_avg_sq = torch.maximum(state["max_exp_avg_sq"][rows], exp_avg_sq)
+                state["max_exp_avg_sq"][rows] = exp_avg_sq
+            bias_correction1 = 1 - beta1**step
+            bias_correction2 = 1 - beta2**step
+            denom = (exp_avg_sq.sqrt() / bias_correction2.sqrt()).add_(group["eps"])
+            param -= lr / bias_correction1 * exp_avg / denom
+
+        elif isinstance(self.optimizer, torch.optim.SGD):
+            momentum = group["momentum"]
+            if momentum != 0:
+                buf = state["momentum_buffer"][rows]
+                buf = torch.where(
+                    step == 1,
+                    grad,
+                    buf.mul_(momentum).add_(grad, alpha=1 - group["dampening"]),
+                )
+                state["momentum_buffer"][rows] = buf
+                grad = grad.add(buf, alpha=momentum) if group["nesterov"] else buf
+            param -= lr * grad
+
+        else:
+            alpha, momentum = group["alpha"], group["momentum"]
+            square_avg = state["square_avg"][rows].mul_(alpha)
+            square_avg.addcmul_(grad, grad, value=1 - alpha)
+            state["square_avg"][rows] = square_avg
+            if group["centered"]:
+                grad_avg = state["grad_avg"][rows].lerp_(grad, 1 - alpha)
+                state["grad_avg"][rows] = grad_avg
+                avg = square_avg.addcmul(grad_avg, grad_avg, value=-1).sqrt_()
+            else:
+                avg = square_avg.sqrt()
+            avg = avg.add_(group["eps"])
+            if momentum > 0:
+                buf = state["momentum_buffer"][rows].mul_(momentum)
+                buf.addcdiv_(grad, avg)
+                state["momentum_buffer"][rows] = buf
+                param -= lr * buf
+            else:
+                param -= lr * grad / avg
+
+        p[rows] = param
+
+    def _state_keys(self, group):
+        if isinstance(self.optimizer, torch.optim.Adam):
+            keys = ["exp_avg", "exp_avg_sq"]
+            return keys + ["max_exp_avg_sq"] if group["amsgrad"] else keys
+        if isinstance(self.optimizer, torch.optim.SGD):
+            return ["momentum_buffer"] if group["momentum"] != 0 else []
+        keys = ["square_avg"]
+        if group["centered"]:
+            keys.append("grad_avg")
+        if group["momentum"] > 0:
+            keys.append("momentum_buffer")
+        return keys
+
+    def join_hook(self, **kwargs):
+        return _SampledRowsJoinHook(self)
+
+    @property
+    def join_device(self):
+        return self.params[0].device
+
+    @property
+    def join_process_group(self):
+        return dist.group.WORLD
+
+
+class _SampledRowsJoinHook(JoinHook):
+    """
+    Shadows the gathering of the rows on ranks which have run out of inputs, and
+    gives all ranks the parameters of the last one to join, as DDP does.
+    """
+
+    def __init__(self, update):
+        self.update = update
+
+    def main_hook(self):
+        for p in self.update.params:
+            self.update._all_gather(p, *self.update._sparse_grad(p))
+
+    def post_hook(self, is_last_joiner):
+        rank = torch.tensor(
+            [dist.get_rank() if is_last_joiner else -1], device=self.update.join_device
+        )
+        dist.all_reduce(rank, op=dist.ReduceOp.MAX)
+        for p in self.update.params:
+            dist.broadcast(p.data, src=int(rank))
 
 
 def init_optimizer(
@@ -44,7 +259,37 @@ def init_optimizer(
     else:
         param_groups = model.parameters()
 
-    # Construct optimizer
+    optimizer = _build_optimizer(
+        param_groups,
+        optim,
+        lr,
+        weight_decay,
+        momentum,
+        sgd_dampening,
+        sgd_nesterov,
+        rmsprop_alpha,
+        adam_beta1,
+        adam_beta2,
+    )
+    partial_fcs = [m for m in model.modules() if isinstance(m, PartialFC)]
+    optimizer.sampled_rows_update = (
+        SampledRowsUpdate(optimizer, partial_fcs) if partial_fcs else None
+    )
+    return optimizer
+
+
+def _build_optimizer(
+    param_groups,
+    optim,
+    lr,
+    weight_decay,
+    momentum,
+    sgd_dampening,
+    sgd_nesterov,
+    rmsprop_alpha,
+    adam_beta1,
+    adam_beta2,
+):
     if optim == "adam":
         return torch.optim.Adam(
             param_groups,
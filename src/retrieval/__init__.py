@@ -0,0 +1,21 @@
+# Copyright (c) EEEM071, University of Surrey
+
+from .flat import FlatIndex
+from .ivf import IVFIndex
+from .pq import PQIndex, ProductQuantizer
+
+__index_factory = {
+    "flat": FlatIndex,
+    "ivf": IVFIndex,
+    "pq": PQIndex,
+}
+
+
+def get_names():
+    return list(__index_factory.keys())
+
+
+def init_index(name, **kwargs):
+    if name not in list(__index_factory.keys()):
+        raise KeyError(f"Unknown gallery index: {name}")
+    return __index_factory[name](**kwargs)
@@ -0,0 +1,57 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import torch
+
+
+class BaseIndex:
+    """
+    Base class of gallery indexes.
+    Gallery features are identified by the order in which they are added.
+    Distances are squared euclidean, the same as in evaluation.
+    """
+
+    def __init__(self):
+        self.ntotal = 0
+
+    @property
+    def is_trained(self):
+        return True
+
+    def train(self, features):
+        """Learn the index structure from representative features (if any)"""
+        pass
+
+    def add(self, features):
+        raise NotImplementedError
+
+    def build(self, features):
+        """Train the index on the gallery features and add them"""
+        if not self.is_trained:
+            self.train(features)
+        self.add(features)
+        return self
+
+    def compute_distances(self, queries):
+        """Distances between queries and every gallery feature, with shape
+        (num_query, ntotal). Only available for exhaustive indexes."""
+        raise NotImplementedError
+
+    def search(self, queries, k):
+        """
+        Retrieve the k nearest gallery features of every query.
+        Args:
+        - queries (torch.Tensor): matrix with shape (num_query, feat_dim).
+        - k (int): number of neighbours.
+        Returns:
+        - distances (torch.Tensor): (num_query, k) ascending distances, inf when fewer
+                                    than k gallery features were visited.
+        - indices (torch.Tensor): (num_query, k) gallery ids, -1 for missing entries.
+        """
+        raise NotImplementedError
+
+
+def merge_topk(distances, indices, k):
+    """Keep the k smallest distances of each row and their indices"""
+    k = min(k, distances.size(1))
+    distances, order = torch.topk(distances, k, dim=1, largest=False)
+    return distances, torch.gather(indices, 1, order)
@@ -0,0 +1,40 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import torch
+
+from ..distance import compute_distance_matrix
+from .base import BaseIndex
+
+
+class FlatIndex(BaseIndex):
+    """
+    Exact brute-force search over all gallery features.
+    Args:
+    - block_size (int): number of queries searched at a time.
+    """
+
+    def __init__(self, block_size=1024, **kwargs):
+        super().__init__()
+        self.block_size = block_size
+        self.features = None
+
+    def add(self, features):
+        features = features.float()
+        if self.features is None:
+            self.features = features
+        else:
+            self.features = torch.cat([self.features, features], 0)
+        self.ntotal = self.features.size(0)
+
+    def compute_distances(self, queries):
+        return compute_distance_matrix(queries.float(), self.features)
+
+    def search(self, queries, k):
+        k = min(k, self.ntotal)
+        distances, indices = [], []
+        for start in range(0, queries.size(0), self.block_size):
+            distmat = self.compute_distances(queries[start : start + self.block_size])
+            d, i = torch.topk(distmat, k, dim=1, largest=False)
+            distances.append(d)
+            indices.append(i)
+        return torch.cat(distances, 0), torch.cat(indices, 0)
@@ -0,0 +1,108 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import torch
+
+from ..distance import compute_distance_matrix
+from .base import BaseIndex, merge_topk
+from .kmeans import assign_nearest, kmeans
+
+
+class IVFIndex(BaseIndex):
+    """
+    Inverted file index.
+    Gallery features are partitioned by a coarse k-means quantizer, and a query only
+    visits the nprobe partitions whose centroids are closest to it, so the search
+    cost is roughly nprobe / nlist of a flat search.
+    Args:
+    - nlist (int): number of partitions (k-means centroids).
+    - nprobe (int): number of partitions visited per query.
+    - niter (int): number of k-means iterations.
+    - seed (int): seed of the k-means initialization.
+    - block_size (int): maximum number of queries compared with a partition at a time.
+    """
+
+    def __init__(
+        self, nlist=100, nprobe=8, niter=20, seed=0, block_size=1024, **kwargs
+    ):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.seed = seed
+        self.block_size = block_size
+        self.centroids = None
+        # features are stored grouped by partition, partition l owning rows
+        # list_offsets[l]:list_offsets[l + 1] of list_features and list_ids
+        self.list_features = None
+        self.list_ids = None
+        self.list_offsets = None
+        self._chunks = []
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, features):
+        self.centroids = kmeans(features.float(), self.nlist, self.niter, self.seed)
+
+    def add(self, features):
+        assert self.is_trained, "IVFIndex must be trained before adding features"
+        features = features.float()
+        self._chunks.append((features, assign_nearest(features, self.centroids)))
+        self.ntotal += features.size(0)
+        self.list_features = None
+
+    def _build_lists(self):
+        features = torch.cat([f for f, _ in self._chunks], 0)
+        assign = torch.cat([a for _, a in self._chunks], 0)
+        self._chunks = [(features, assign)]
+        order = torch.sort(assign, stable=True).indices
+        self.list_features = features[order]
+        self.list_ids = order
+        counts = torch.bincount(assign, minlength=self.nlist)
+        self.list_offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+
+    def search(self, queries, k):
+        if self.list_features is None:
+            self._build_lists()
+        queries = queries.float()
+        num_q = queries.size(0)
+        nprobe = min(self.nprobe, self.nlist)
+
+        probes = torch.topk(
+            compute_distance_matrix(queries, self.centroids),
+            nprobe,
+            dim=1,
+            largest=False,
+        ).indices
+
+        # the k best candidates of each visited partition, merged at the end
+        cand_dist = queries.new_full((num_q, nprobe, k), float("inf"))
+        cand_ids = torch.full(
+            (num_q, nprobe, k), -1, dtype=torch.long, device=queries.device
+        )
+
+        # group the (query, slot) pairs by partition so that every partition is
+        # compared with all of its queries in one matrix product
+        flat_probes = probes.view(-1)
+        order = torch.sort(flat_probes, stable=True).indices
+        counts = torch.bincount(flat_probes, minlength=self.nlist).tolist()
+        start = 0
+        for lid, count in enumerate(counts):
+            pairs = order[start : start + count]
+            start += count
+            lstart, lend = self.list_offsets[lid], self.list_offsets[lid + 1]
+            if count == 0 or lend == lstart:
+                continue
+            list_features = self.list_features[lstart:lend]
+            list_ids = self.list_ids[lstart:lend]
+            kk = min(k, lend - lstart)
+            for bstart in range(0, count, self.block_size):
+                block = pairs[bstart : bstart + self.block_size]
+                rows, slots = block // nprobe, block % nprobe
+                distmat = compute_distance_matrix(queries[rows], list_features)
+                d, i = torch.topk(distmat, kk, dim=1, largest=False)
+                cand_dist[rows, slots, :kk] = d
+                cand_ids[rows, slots, :kk] = list_ids[i]
+
+        return merge_topk(cand_dist.view(num_q, -1), cand_ids.view(num_q, -1), k)
@@ -0,0 +1,54 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import torch
+
+from ..distance import compute_distance_matrix
+
+
+def assign_nearest(features, centroids, block_size=4096):
+    """Index of the nearest centroid of every feature"""
+    assign = []
+    for start in range(0, features.size(0), block_size):
+        distmat = compute_distance_matrix(
+            features[start : start + block_size], centroids
+        )
+        assign.append(distmat.argmin(1))
+    return torch.cat(assign, 0)
+
+
+def kmeans(features, num_clusters, niter=20, seed=0):
+    """
+    Lloyd's k-means.
+    Args:
+    - features (torch.Tensor): matrix with shape (num_features, feat_dim).
+    - num_clusters (int): number of centroids.
+    - niter (int): number of iterations.
+    - seed (int): seed of the centroid initialization.
+    Returns:
+    - centroids (torch.Tensor): matrix with shape (num_clusters, feat_dim).
+    """
+    num_features = features.size(0)
+    if num_features < num_clusters:
+        raise ValueError(
+            f"k-means needs at least {num_clusters} features, got {num_features}"
+        )
+    generator = torch.Generator().manual_seed(seed)
+    init = torch.randperm(num_features, generator=generator)[:num_clusters]
+    centroids = features[init].clone()
+
+    for _ in range(niter):
+        assign = assign_nearest(features, centroids)
+        counts = torch.bincount(assign, minlength=num_clusters)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, features)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).to(
+            sums.dtype
+        )
+        # re-seed empty clusters with random features
+        empty = (~nonempty).nonzero().view(-1)
+        if empty.numel() > 0:
+            centroids[empty] = features[
+                torch.randint(num_features, (empty.numel(),), generator=generator)
+            ]
+
+    return centroids
@@ -0,0 +1,146 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import torch
+
+from ..distance import compute_distance_matrix
+from .base import BaseIndex
+from .kmeans import assign_nearest, kmeans
+
+
+class ProductQuantizer:
+    """
+    Product quantization codec.
+    A feature is split into num_subvectors sub-vectors, each of which is replaced by
+    the index of its nearest centroid in a per-subspace codebook of 2**nbits entries.
+    Codes are stored as one uint8 per sub-vector, so a feature takes num_subvectors
+    bytes whatever nbits (fewer bits only make smaller codebooks).
+
+    Reference:
+    Jegou et al. Product Quantization for Nearest Neighbor Search. TPAMI 2011.
+
+    Args:
+    - num_subvectors (int): number of sub-vectors, must divide the feature dimension.
+    - nbits (int): bits per sub-vector code (at most 8).
+    - niter (int): number of k-means iterations per subspace.
+    - seed (int): seed of the k-means initialization.
+    """
+
+    def __init__(self, num_subvectors=8, nbits=8, niter=20, seed=0):
+        assert 1 <= nbits <= 8, "codes are stored as uint8, nbits must be in [1, 8]"
+        self.num_subvectors = num_subvectors
+        self.nbits = nbits
+        self.ksub = 2**nbits
+        self.niter = niter
+        self.seed = seed
+        self.codebooks = None  # (num_subvectors, ksub, dsub)
+
+    @property
+    def code_size(self):
+        """Bytes per encoded feature, as stored by encode"""
+        return self.num_subvectors  # one uint8 per sub-vector
+
+    def _split(self, features):
+        n, dim = features.size()
+        return features.float().view(n, self.num_subvectors, dim // self.num_subvectors)
+
+    def train(self, features):
+        dim = features.size(1)
+        if dim % self.num_subvectors != 0:
+            raise ValueError(
+                f"Feature dimension {dim} is not divisible by "
+                f"num_subvectors={self.num_subvectors}"
+            )
+        subvectors = self._split(features)
+        self.codebooks = torch.stack(
+            [
+                kmeans(
+                    subvectors[:, j].contiguous(), self.ksub, self.niter, self.seed + j
+                )
+                for j in range(self.num_subvectors)
+            ]
+        )
+
+    def encode(self, features):
+        subvectors = self._split(features)
+        codes = [
+            assign_nearest(subvectors[:, j].contiguous(), self.codebooks[j])
+            for j in range(self.num_subvectors)
+        ]
+        return torch.stack(codes, 1).to(torch.uint8)
+
+    def decode(self, codes):
+        codes = codes.long()
+        subvectors = [
+            self.codebooks[j][codes[:, j]] for j in range(self.num_subvectors)
+        ]
+        return torch.cat(subvectors, 1)
+
+    def distance_tables(self, queries):
+        """Squared distances between every query sub-vector and every codeword,
+        with shape (num_query, num_subvectors, ksub)"""
+        subvectors = self._split(queries)
+        return torch.stack(
+            [
+                compute_distance_matrix(subvectors[:, j], self.codebooks[j])
+                for j in range(self.num_subvectors)
+            ],
+            1,
+        )
+
+    def asymmetric_distances(self, queries, codes):
+        """Squared distances between raw queries and encoded features, looked up
+        from the distance tables instead of decoding the features"""
+        tables = self.distance_tables(queries)
+        codes = codes.long()
+        distmat = tables[:, 0].index_select(1, codes[:, 0])
+        for j in range(1, self.num_subvectors):
+            distmat += tables[:, j].index_select(1, codes[:, j])
+        return distmat
+
+
+class PQIndex(BaseIndex):
+    """
+    Exhaustive search over product-quantized gallery features with asymmetric
+    distance computation.
+    Args:
+    - num_subvectors, nbits, niter, seed: see ProductQuantizer.
+    - block_size (int): number of queries scored at a time.
+    """
+
+    def __init__(
+        self, num_subvectors=8, nbits=8, niter=20, seed=0, block_size=1024, **kwargs
+    ):
+        super().__init__()
+        self.pq = ProductQuantizer(num_subvectors, nbits, niter, seed)
+        self.block_size = block_size
+        self.codes = None
+
+    @property
+    def is_trained(self):
+        return self.pq.codebooks is not None
+
+    @property
+    def code_size(self):
+        return self.pq.code_size
+
+    def train(self, features):
+        self.pq.train(features)
+
+    def add(self, features):
+        assert self.is_trained, "PQIndex must be trained before adding features"
+        codes = self.pq.encode(features)
+        self.codes = codes if self.codes is None else torch.cat([self.codes, codes], 0)
+        self.ntotal = self.codes.size(0)
+
+    def compute_distances(self, queries):
+        return self.pq.asymmetric_distances(queries, self.codes)
+
+    def search(self, queries, k):
+        k = min(k, self.ntotal)
+        distances, indices = [], []
+        for start in range(0, queries.size(0), self.block_size):
+            distmat = self.compute_distances(queries[start : start + self.block_size])
+            d, i = torch.topk(distmat, k, dim=1, largest=False)
+            distances.append(d)
+            indices.append(i)
+        return torch.cat(distances, 0), torch.cat(indices, 0)
@@ -1,87 +1,223 @@
 # Copyright (c) EEEM071, University of Surrey
 
-import copy
-import random
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import Sampler, RandomSampler
 
 
+def get_pids(data_source):
+    """Return the pids of a ColumnarDataset or a list of (img_path, pid, camid)"""
+    if hasattr(data_source, "pids"):
+        return data_source.pids
+    return np.array([pid for _, pid, _ in data_source], dtype=np.int64)
+
+
 class RandomIdentitySampler(Sampler):
     """
     Randomly sample N identities, then for each identity,
     randomly sample K instances, therefore batch size is N*K.
+    The samples of every identity are shuffled and cut into groups of K (an
+    identity with fewer than K samples gives one group drawn with replacement).
+    Batches are then planned in rounds: round r holds the r-th group of every
+    identity that has more than r groups, in random order, so that all
+    identities are consumed at the same rate and the N identities of a batch are
+    distinct. The plan is made with NumPy in time linear in the number of
+    samples (plus one sort), and the plan of the next epoch is prepared in a
+    background thread while the current one is consumed.
     Args:
-    - data_source (list): list of (img_path, pid, camid).
+    - data_source (ColumnarDataset or list): (img_path, pid, camid) samples.
     - num_instances (int): number of instances per identity in a batch.
     - batch_size (int): number of examples in a batch.
+    - seed (int): seed of the plans, which only depend on seed and epoch. If
+      None, it is drawn from np.random, so it follows set_random_seed.
+    - prefetch (bool): plan the next epoch in the background.
     """
 
-    def __init__(self, data_source, batch_size, num_instances):
+    def __init__(
+        self, data_source, batch_size, num_instances, seed=None, prefetch=True
+    ):
         self.data_source = data_source
         self.batch_size = batch_size
         self.num_instances = num_instances
         self.num_pids_per_batch = self.batch_size // self.num_instances
-        self.index_dic = defaultdict(list)
-        for index, (_, pid, _) in enumerate(self.data_source):
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
+        # flat arrays rather than lists of Python ints, which forked dataloader
+        # workers would copy
+        _, self.pid_codes = np.unique(get_pids(self.data_source), return_inverse=True)
+        self.pid_codes = self.pid_codes.reshape(-1)
+        self.counts = np.bincount(self.pid_codes)
+        self.num_groups = np.maximum(self.counts // self.num_instances, 1)
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.epoch = 0
+
+        self._executor = ThreadPoolExecutor(1) if prefetch else None
+        self._prefetched = None
 
         # estimate number of examples in an epoch
-        self.length = 0
-        for pid in self.pids:
-            idxs = self.index_dic[pid]
-            num = len(idxs)
-            if num < self.num_instances:
-                num = self.num_instances
-            self.length += num - num % self.num_instances
+        self.length = int(self.num_groups.sum()) * self.num_instances
+
+    def set_epoch(self, epoch):
+        """Plan the given epoch on the next iteration (epochs otherwise follow on)"""
+        self.epoch = epoch
+
+    def plan_epoch(self, epoch):
+        """Return the sample indices of an epoch, batch after batch"""
+        rng = np.random.default_rng([self.seed, epoch])
+        K, P = self.num_instances, self.num_pids_per_batch
+
+        # shuffle the samples of every identity: random order, then stable
+        # grouping by identity
+        order = rng.permutation(len(self.pid_codes))
+        order = order[np.argsort(self.pid_codes[order], kind="stable")]
+        codes = self.pid_codes[order]
+        starts = np.cumsum(self.counts) - self.counts
+        group_starts = np.cumsum(self.num_groups) - self.num_groups
+
+        # groups of K samples, identity after identity; the remainder of an
+        # identity that does not fill a group is dropped
+        groups = np.empty(int(self.num_groups.sum()) * K, dtype=np.int64)
+        rank = np.arange(len(order)) - starts[codes]
+        keep = (rank < self.num_groups[codes] * K) & (self.counts[codes] >= K)
+        groups[group_starts[codes[keep]] * K + rank[keep]] = order[keep]
+        small = np.flatnonzero(self.counts < K)
+        if small.size > 0:
+            draws = rng.random((small.size, K)) * self.counts[small, None]
+            draws = starts[small, None] + draws.astype(np.int64)
+            groups[group_starts[small, None] * K + np.arange(K)] = order[draws]
+
+        # identities in decreasing number of groups, so that the identities of
+        # round r are the first round_sizes[r] of them
+        by_groups = np.argsort(-self.num_groups, kind="stable")
+        round_sizes = len(self.counts) - np.cumsum(np.bincount(self.num_groups))[:-1]
+
+        batch_pids, batch_rounds = [], []
+        pending = np.zeros(0, dtype=np.int64)
+        pending_rounds = np.zeros(0, dtype=np.int64)
+        for r, size in enumerate(round_sizes):
+            pids = by_groups[rng.permutation(size)]
+            if pending.size > 0:
+                # complete the last batch of the previous round with identities
+                # that are not already in it
+                need = P - pending.size
+                fresh = np.flatnonzero(~np.isin(pids, pending))[:need]
+                if fresh.size < need:
+                    break
+                batch_pids += [pending, pids[fresh]]
+                batch_rounds += [pending_rounds, np.full(need, r)]
+                pids = np.delete(pids, fresh)
+            end = pids.size - pids.size % P
+            batch_pids.append(pids[:end])
+            batch_rounds.append(np.full(end, r))
+            pending, pending_rounds = pids[end:], np.full(pids.size - end, r)
+
+        if not batch_pids:
+            return np.zeros(0, dtype=np.int64)
+        batch_pids = np.concatenate(batch_pids)
+        batch_rounds = np.concatenate(batch_rounds)
+        first = (group_starts[batch_pids] + batch_rounds) * K
+        return groups[first[:, None] + np.arange(K)].reshape(-1)
 
     def __iter__(self):
-        batch_idxs_dict = defaultdict(list)
-
-        for pid in self.pids:
-            idxs = copy.deepcopy(self.index_dic[pid])
-            if len(idxs) < self.num_instances:
-                idxs = np.random.choice(idxs, size=self.num_instances, replace=True)
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.num_instances:
-                    batch_idxs_dict[pid].append(batch_idxs)
-                    batch_idxs = []
-
-        avai_pids = copy.deepcopy(self.pids)
-        final_idxs = []
-
-        while len(avai_pids) >= self.num_pids_per_batch:
-            selected_pids = random.sample(avai_pids, self.num_pids_per_batch)
-            for pid in selected_pids:
-                batch_idxs = batch_idxs_dict[pid].pop(0)
-                final_idxs.extend(batch_idxs)
-                if len(batch_idxs_dict[pid]) == 0:
-                    avai_pids.remove(pid)
-
-        return iter(final_idxs)
+        epoch = self.epoch
+        if self._prefetched is not None and self._prefetched[0] == epoch:
+            plan = self._prefetched[1].result()
+        else:
+            plan = self.plan_epoch(epoch)
+
+        self.epoch = epoch + 1
+        if self._executor is not None:
+            self._prefetched = (
+                self.epoch,
+                self._executor.submit(self.plan_epoch, self.epoch),
+            )
+        return iter(plan.tolist())
 
     def __len__(self):
         return self.length
 
 
+class DistributedRandomIdentitySampler(RandomIdentitySampler):
+    """
+    RandomIdentitySampler for distributed training. Every rank plans the same
+    global epoch from the shared seed and takes every world_size-th batch of it,
+    so ranks see disjoint, whole P x K batches (P = batch_size // num_instances),
+    and the same number of them.
+    Call set_epoch at the start of every epoch.
+    Args:
+    - data_source (ColumnarDataset or list): (img_path, pid, camid) samples.
+    - num_instances (int): number of instances per identity in a batch.
+    - batch_size (int): number of examples in a batch of one rank.
+    - num_replicas (int): number of ranks, the world size by default.
+    - rank (int): rank of this process, the global rank by default.
+    - seed (int): seed of the plans, drawn on rank 0 and broadcast if None.
+    - prefetch (bool): plan the next epoch in the background.
+    """
+
+    def __init__(
+        self,
+        data_source,
+        batch_size,
+        num_instances,
+        num_replicas=None,
+        rank=None,
+        seed=None,
+        prefetch=True,
+    ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        if seed is None:
+            seed = [np.random.randint(2**31)]
+            dist.broadcast_object_list(seed, src=0)
+            seed = seed[0]
+        self.num_replicas = num_replicas
+        self.rank = rank
+        super().__init__(
+            data_source, batch_size, num_instances, seed=seed, prefetch=prefetch
+        )
+        # the plan is made of P x K batches, which is less than batch_size when
+        # batch_size is not a multiple of num_instances
+        self.plan_batch_size = self.num_pids_per_batch * self.num_instances
+        # estimate number of examples of a rank in an epoch
+        num_batches = self.length // (self.plan_batch_size * self.num_replicas)
+        self.length = num_batches * self.plan_batch_size
+
+    def plan_epoch(self, epoch):
+        plan = super().plan_epoch(epoch).reshape(-1, self.plan_batch_size)
+        num_batches = len(plan) - len(plan) % self.num_replicas
+        return plan[self.rank : num_batches : self.num_replicas].reshape(-1)
+
+
 def build_train_sampler(
     data_source, train_sampler, train_batch_size, num_instances, **kwargs
 ):
     """Build sampler for training
     Args:
-    - data_source (list): list of (img_path, pid, camid).
+    - data_source (ColumnarDataset or list): (img_path, pid, camid) samples.
     - train_sampler (str): sampler name (default: RandomSampler).
-    - train_batch_size (int): batch size during training.
+    - train_batch_size (int): batch size during training (of one rank when
+      torch.distributed is initialized, in which case the distributed samplers
+      are used).
     - num_instances (int): number of instances per identity in a batch (for RandomIdentitySampler).
     """
 
+    distributed = dist.is_available() and dist.is_initialized()
+
     if train_sampler == "RandomIdentitySampler":
-        sampler = RandomIdentitySampler(data_source, train_batch_size, num_instances)
+        if distributed:
+            sampler = DistributedRandomIdentitySampler(
+                data_source, train_batch_size, num_instances
+            )
+        else:
+            sampler = RandomIdentitySampler(
+                data_source, train_batch_size, num_instances
+            )
+
+    elif distributed:
+        sampler = DistributedSampler(data_source, shuffle=True)
 
     else:
         sampler = RandomSampler(data_source)
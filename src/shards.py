@@ -0,0 +1,386 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import io
+import os.path as osp
+import random
+from collections import defaultdict
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from .dataset_loader import open_image
+from .datasets import ColumnarDataset
+from .utils.iotools import mkdir_if_missing, read_json, write_json
+
+
+def test_split_name(split, name, test_size):
+    """Name under which the query or gallery split of a dataset is packed"""
+    # every VehicleID test list is a different query/gallery split
+    return f"{split}_{test_size}" if name == "vehicleID" else split
+
+
+def write_shards(data, shard_dir, split, shard_size=64 * 1024**2, group_pids=False):
+    """
+    Pack the encoded image files of a split into shard files of about shard_size
+    bytes, next to an index {split}.json holding the offset, length, img_path,
+    pid and camid of every image.
+    Args:
+    - data (list): list of (img_path, pid, camid).
+    - shard_dir (str): directory to write the shards to.
+    - split (str): split name, e.g. "train".
+    - shard_size (int): target size of a shard in bytes.
+    - group_pids (bool): store the images of an identity next to each other, with
+      identities in random order, so that a shuffle buffer holds enough images of
+      every identity for P x K batches. Otherwise the order of data is kept.
+    """
+    mkdir_if_missing(shard_dir)
+    if group_pids:
+        by_pid = defaultdict(list)
+        for item in data:
+            by_pid[item[1]].append(item)
+        pids = sorted(by_pid)
+        random.Random(0).shuffle(pids)
+        data = [item for pid in pids for item in by_pid[pid]]
+
+    shards, records = [], []
+    f = None
+    for img_path, pid, camid in data:
+        if f is None or f.tell() >= shard_size:
+            if f is not None:
+                f.close()
+            shards.append(f"{split}-{len(shards):05d}.bin")
+            f = open(osp.join(shard_dir, shards[-1]), "wb")
+        with open(img_path, "rb") as img_f:
+            img_bytes = img_f.read()
+        records.append(
+            [len(shards) - 1, f.tell(), len(img_bytes), img_path, pid, camid]
+        )
+        f.write(img_bytes)
+    if f is not None:
+        f.close()
+
+    write_json(
+        {
+            "shards": shards,
+            "num_pids": len({r[4] for r in records}),
+            "num_cams": len({r[5] for r in records}),
+            "records": records,
+        },
+        osp.join(shard_dir, f"{split}.json"),
+    )
+    print(f"=> Packed {len(records)} {split} images into {len(shards)} shards")
+
+
+class ShardLocations:
+    """
+    Read-only list of the (shard_path, offset, length) of encoded images, stored
+    as arrays: the shard of every image in an int32 array of ids into the list of
+    shard paths, and the offsets and lengths in int64 arrays. Like
+    ColumnarDataset, it is a handful of objects whatever its length, so forked
+    dataloader workers do not copy it by touching reference counts.
+    Args:
+    - shard_paths (list): path of every shard.
+    - shard_ids (array): shard id of every image.
+    - offsets (array): offset of every image in its shard.
+    - lengths (array): length in bytes of every image.
+    """
+
+    def __init__(self, shard_paths=(), shard_ids=(), offsets=(), lengths=()):
+        self.shard_paths = list(shard_paths)
+        self.shard_ids = np.asarray(shard_ids, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    @classmethod
+    def concat(cls, locations):
+        """Concatenate ShardLocations into one"""
+        shard_paths, shard_ids = [], [np.zeros(0, np.int32)]
+        for loc in locations:
+            shard_ids.append(loc.shard_ids + len(shard_paths))
+            shard_paths.extend(loc.shard_paths)
+        return cls(
+            shard_paths,
+            np.concatenate(shard_ids),
+            np.concatenate(
+                [loc.offsets for loc in locations] + [np.zeros(0, np.int64)]
+            ),
+            np.concatenate(
+                [loc.lengths for loc in locations] + [np.zeros(0, np.int64)]
+            ),
+        )
+
+    def subset(self, indices):
+        """Return the locations at indices, as ShardLocations"""
+        indices = np.asarray(indices, dtype=np.int64)
+        return ShardLocations(
+            self.shard_paths,
+            self.shard_ids[indices],
+            self.offsets[indices],
+            self.lengths[indices],
+        )
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return (
+            self.shard_paths[self.shard_ids[index]],
+            int(self.offsets[index]),
+            int(self.lengths[index]),
+        )
+
+
+def read_shard_index(shard_dir, split, pid_offset=0, camid_offset=0):
+    """
+    Read the index of a packed split.
+    Returns a dict with
+    - dataset: ColumnarDataset of (img_path, pid, camid), pids and camids shifted
+      by the offsets.
+    - locations: ShardLocations of the encoded images.
+    - num_pids, num_cams: number of identities and cameras.
+    """
+    index_path = osp.join(shard_dir, f"{split}.json")
+    if not osp.isfile(index_path):
+        raise RuntimeError(f"'{index_path}' is not available")
+    index = read_json(index_path)
+    shard_paths = [osp.join(shard_dir, shard) for shard in index["shards"]]
+    records = index["records"]
+    return {
+        "dataset": ColumnarDataset(
+            [
+                (img_path, pid + pid_offset, camid + camid_offset)
+                for _, _, _, img_path, pid, camid in records
+            ]
+        ),
+        "locations": ShardLocations(
+            shard_paths,
+            [r[0] for r in records],
+            [r[1] for r in records],
+            [r[2] for r in records],
+        ),
+        "num_pids": index["num_pids"],
+        "num_cams": index["num_cams"],
+    }
+
+
+def decode_image(img_bytes, draft_size=None):
+    return open_image(io.BytesIO(img_bytes), draft_size)
+
+
+class PackedImageDataset(Dataset):
+    """
+    Image dataset reading from shards, in place of ImageDataset.
+    Read in order, e.g. by the query and gallery loaders, every shard is read
+    front to back.
+    Args:
+    - shard_index (dict): output of read_shard_index.
+    - transform (callable): transform applied to every image.
+    - draft_size (tuple): (height, width) to decode JPEGs at reduced resolution
+      for, see open_image.
+    """
+
+    def __init__(self, shard_index, transform=None, draft_size=None):
+        self.dataset = shard_index["dataset"]
+        self.locations = shard_index["locations"]
+        self.transform = transform
+        self.draft_size = draft_size
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img_path, pid, camid = self.dataset[index]
+        shard_path, offset, length = self.locations[index]
+        with open(shard_path, "rb") as f:
+            f.seek(offset)
+            img = decode_image(f.read(length), self.draft_size)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, pid, camid, img_path
+
+
+class ShardedImageDataset(IterableDataset):
+    """
+    Training dataset streaming shards sequentially, in random order, and shuffling
+    the images in a buffer. Shards are divided among the dataloader workers, and
+    among the ranks when torch.distributed is initialized.
+    With num_instances > 0, the stream of every worker is made of P x K batches as
+    with RandomIdentitySampler: P = batch_size // num_instances identities, with
+    K = num_instances images each, drawn from the identities in the buffer. The
+    batches of the DataLoader must then be of ShardedImageDataset.batch_size,
+    P x K, which is less than batch_size when it is not a multiple of K.
+    Args:
+    - shard_indexes (list): outputs of read_shard_index.
+    - transform (callable): transform applied to every image.
+    - batch_size (int): number of examples in a batch.
+    - num_instances (int): number of instances per identity in a batch, 0 to only
+      shuffle the images.
+    - buffer_size (int): number of encoded images held in the shuffle buffer.
+    - seed (int): seed of the shard order and of the shuffling, None for random
+      (drawn on rank 0 and broadcast in distributed training).
+    - draft_size (tuple): (height, width) to decode JPEGs at reduced resolution
+      for, see open_image.
+    """
+
+    def __init__(
+        self,
+        shard_indexes,
+        transform=None,
+        batch_size=32,
+        num_instances=0,
+        buffer_size=4096,
+        seed=None,
+        draft_size=None,
+    ):
+        self.dataset = ColumnarDataset.concat(
+            [index["dataset"] for index in shard_indexes]
+        )
+        self.locations = ShardLocations.concat(
+            [index["locations"] for index in shard_indexes]
+        )
+        self.transform = transform
+        self.num_instances = num_instances
+        if num_instances > 0:
+            if batch_size < num_instances:
+                raise ValueError(
+                    f"batch_size ({batch_size}) must be at least num_instances "
+                    f"({num_instances})"
+                )
+            batch_size -= batch_size % num_instances
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.rank, self.num_replicas = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.num_replicas = dist.get_rank(), dist.get_world_size()
+        if seed is None:
+            # the shard order must be the same on all ranks
+            seed = [random.randrange(2**31)]
+            if self.num_replicas > 1:
+                dist.broadcast_object_list(seed, src=0)
+            seed = seed[0]
+        self.seed = seed
+        self.epoch = 0
+        self.draft_size = draft_size
+
+        # records of every shard, in file order, as one index array per shard
+        order = np.lexsort((self.locations.offsets, self.locations.shard_ids))
+        counts = np.bincount(
+            self.locations.shard_ids, minlength=len(self.locations.shard_paths)
+        )
+        indexes = np.split(order, np.cumsum(counts)[:-1])
+        self.shards = sorted(
+            (shard_path, indexes[shard_id])
+            for shard_id, shard_path in enumerate(self.locations.shard_paths)
+            if counts[shard_id]
+        )
+
+        if self.num_instances > 0:
+            # estimate number of examples in an epoch, as RandomIdentitySampler
+            self.length = 0
+            for num in np.unique(self.dataset.pids, return_counts=True)[1]:
+                num = max(num, self.num_instances)
+                self.length += num - num % self.num_instances
+        else:
+            self.length = len(self.dataset)
+        self.length //= self.num_replicas
+
+    def set_epoch(self, epoch):
+        """Use a different shard order and shuffling in every epoch"""
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.length
+
+    def _read(self, shard_ids):
+        # every shard is read front to back, in one pass
+        for shard_id in shard_ids:
+            shard_path, indexes = self.shards[shard_id]
+            with open(shard_path, "rb") as f:
+                for index in indexes.tolist():
+                    f.seek(self.locations.offsets[index])
+                    yield index, f.read(self.locations.lengths[index])
+
+    def _shuffle(self, stream, rng):
+        buffer = []
+        for item in stream:
+            buffer.append(item)
+            if len(buffer) >= self.buffer_size:
+                i = rng.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _pop_batch(self, buckets, rng):
+        num_pids_per_batch = self.batch_size // self.num_instances
+        avai_pids = [
+            pid for pid, items in buckets.items() if len(items) >= self.num_instances
+        ]
+        if len(avai_pids) < num_pids_per_batch:
+            return []
+        batch = []
+        for pid in rng.sample(avai_pids, num_pids_per_batch):
+            items = buckets[pid]
+            rng.shuffle(items)
+            batch.extend(items[: self.num_instances])
+            del items[: self.num_instances]
+            if not items:
+                del buckets[pid]
+        return batch
+
+    def _identity_batches(self, stream, rng, pid_counts):
+        buckets = defaultdict(list)
+        num_buffered = 0
+        for item in stream:
+            buckets[self.dataset.pids[item[0]]].append(item)
+            num_buffered += 1
+            if num_buffered >= self.buffer_size:
+                batch = self._pop_batch(buckets, rng)
+                num_buffered -= len(batch)
+                yield from batch
+
+        # identities with fewer than K images are sampled with replacement
+        for pid, items in buckets.items():
+            if pid_counts[pid] < self.num_instances:
+                items.extend(rng.choices(items, k=self.num_instances - len(items)))
+        while True:
+            batch = self._pop_batch(buckets, rng)
+            if not batch:
+                break
+            yield from batch
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        # the shard order is the same in all workers of all ranks, which take
+        # every (num_replicas * num_workers)-th shard of it
+        worker_id += self.rank * num_workers
+        num_workers *= self.num_replicas
+        shard_ids = list(range(len(self.shards)))
+        random.Random(self.seed + self.epoch).shuffle(shard_ids)
+        shard_ids = shard_ids[worker_id::num_workers]
+        stream = self._read(shard_ids)
+
+        rng = random.Random(f"{self.seed}-{self.epoch}-{worker_id}")
+        if self.num_instances > 0:
+            # images of the identities in the shards of this worker, which may
+            # only hold part of those of an identity
+            indexes = [self.shards[shard_id][1] for shard_id in shard_ids]
+            pids = self.dataset.pids[np.concatenate(indexes + [np.zeros(0, np.int64)])]
+            pid_counts = dict(zip(*np.unique(pids, return_counts=True)))
+            stream = self._identity_batches(stream, rng, pid_counts)
+        else:
+            stream = self._shuffle(stream, rng)
+
+        for index, img_bytes in stream:
+            img_path, pid, camid = self.dataset[index]
+            img = decode_image(img_bytes, self.draft_size)
+            if self.transform is not None:
+                img = self.transform(img)
+            yield img, pid, camid, img_path
@@ -123,19 +123,132 @@ class ColorAugmentation:
         return tensor
 
 
+class BatchColorAugmentation(ColorAugmentation):
+    """
+    ColorAugmentation of a float batch (B, 3, H, W) in place, with the random
+    decision and intensities drawn for every sample.
+    """
+
+    def sample(self, batch_size, device):
+        """Return the (batch_size, 3) intensities added to the RGB channels"""
+        self.eig_vec = self.eig_vec.to(device)
+        self.eig_val = self.eig_val.to(device)
+        alpha = torch.randn(batch_size, 3, device=device) * 0.1
+        alpha *= torch.rand(batch_size, 1, device=device) < self.p
+        return torch.mm(self.eig_val * alpha, self.eig_vec)
+
+    def __call__(self, imgs):
+        quatity = self.sample(imgs.size(0), imgs.device)
+        return imgs.add_(quatity.view(-1, 3, 1, 1))
+
+
+class BatchRandomErasing(RandomErasing):
+    """
+    RandomErasing of a float batch (B, C, H, W) in place. The 100 attempts of
+    every sample are drawn at once and the first one that fits is erased.
+    """
+
+    def __call__(self, imgs):
+        B, C, H, W = imgs.size()
+        device = imgs.device
+        num_attempts = 100
+
+        area = H * W
+        target_area = torch.empty(B, num_attempts, device=device)
+        target_area = target_area.uniform_(self.sl, self.sh) * area
+        aspect_ratio = torch.empty(B, num_attempts, device=device)
+        aspect_ratio = aspect_ratio.uniform_(self.r1, 1 / self.r1)
+        h = torch.sqrt(target_area * aspect_ratio).round_().long()
+        w = torch.sqrt(target_area / aspect_ratio).round_().long()
+
+        fits = (w < W) & (h < H)
+        first = fits.int().argmax(1, keepdim=True)
+        h = h.gather(1, first).squeeze(1)
+        w = w.gather(1, first).squeeze(1)
+        erase = fits.any(1) & (torch.rand(B, device=device) <= self.probability)
+
+        x1 = (torch.rand(B, device=device) * (H - h + 1).clamp(min=1)).long()
+        y1 = (torch.rand(B, device=device) * (W - w + 1).clamp(min=1)).long()
+
+        # only the erased pixels are written, one slice per erased sample
+        mean = torch.tensor(self.mean[:C] if C == 3 else self.mean[:1], device=device)
+        mean = mean.view(-1, 1, 1).to(imgs.dtype)
+        params = torch.stack([x1, y1, h, w], 1)[erase].tolist()
+        for i, (x1, y1, h, w) in zip(erase.nonzero().flatten().tolist(), params):
+            imgs[i, :, x1 : x1 + h, y1 : y1 + w] = mean
+        return imgs
+
+
+class BatchAugmentation:
+    """
+    Train augmentation of collated uint8 batches (B, 3, H, W), in place of
+    T.ToTensor, ColorAugmentation, T.Normalize and RandomErasing per sample.
+    Conversion to float, color augmentation and normalization are one affine map
+    per sample and channel, computed in place after the conversion.
+    Args:
+    - mean, std (list): normalization of every channel.
+    - color_aug (bool): randomly alter the intensities of RGB channels.
+    - random_erase (bool): use random erasing.
+    """
+
+    def __init__(self, mean, std, color_aug=True, random_erase=False):
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.color_aug = BatchColorAugmentation() if color_aug else None
+        self.random_erase = BatchRandomErasing() if random_erase else None
+
+    def __call__(self, imgs):
+        self.mean = self.mean.to(imgs.device)
+        self.std = self.std.to(imgs.device)
+        # (x / 255 + quatity - mean) / std
+        offset = -self.mean
+        if self.color_aug is not None:
+            quatity = self.color_aug.sample(imgs.size(0), imgs.device)
+            offset = offset + quatity.view(-1, 3, 1, 1)
+        imgs = imgs.float().mul_(1 / (255 * self.std)).add_(offset / self.std)
+        if self.random_erase is not None:
+            imgs = self.random_erase(imgs)
+        return imgs
+
+
+def build_batch_transform(
+    random_erase=False,  # use random erasing for data augmentation
+    color_aug=True,  # randomly alter the intensities of RGB channels
+    mean=[0.485, 0.456, 0.406],
+    std=[0.229, 0.224, 0.225],
+):
+    """
+    Build the augmentation of collated uint8 batches, e.g. on the GPU, which
+    replaces the train transformations after the conversion to tensor when
+    build_transforms is called with batch_augment=True.
+    """
+    return BatchAugmentation(mean, std, color_aug=color_aug, random_erase=random_erase)
+
+
+def get_normalization(transform):
+    """Return the (mean, std) lists of the T.Normalize of a T.Compose, or None"""
+    for t in getattr(transform, "transforms", [transform]):
+        if isinstance(t, T.Normalize):
+            return list(t.mean), list(t.std)
+    return None
+
+
 def build_transforms(
     height,
     width,
     random_erase=False,  # use random erasing for data augmentation
     color_jitter=False,  # randomly change the brightness, contrast and saturation
     color_aug=True,  # randomly alter the intensities of RGB channels
+    batch_augment=False,  # leave tensor conversion and augmentation to batches
+    mean=None,  # dataset-specific mean, see BaseDataManager.compute_train_stats
+    std=None,  # dataset-specific std
     **kwargs
 ):
     # use imagenet mean and std as default
-    # TODO: compute dataset-specific mean and std
-    imagenet_mean = [0.485, 0.456, 0.406]
-    imagenet_std = [0.229, 0.224, 0.225]
-    normalize = T.Normalize(mean=imagenet_mean, std=imagenet_std)
+    if mean is None or std is None:
+        mean = [0.485, 0.456, 0.406]
+        std = [0.229, 0.224, 0.225]
+    normalize = T.Normalize(mean=mean, std=std)
 
     # build train transformations
     transform_train = []
@@ -150,12 +263,16 @@ def build_transforms(
         transform_train += [
             T.ColorJitter(brightness=0.2, contrast=0.15, saturation=0, hue=0)
         ]
-    transform_train += [T.ToTensor()]
-    if color_aug:
-        transform_train += [ColorAugmentation()]
-    transform_train += [normalize]
-    if random_erase:
-        transform_train += [RandomErasing()]
+    if batch_augment:
+        # uint8 tensors, see build_batch_transform
+        transform_train += [T.PILToTensor()]
+    else:
+        transform_train += [T.ToTensor()]
+        if color_aug:
+            transform_train += [ColorAugmentation()]
+        transform_train += [normalize]
+        if random_erase:
+            transform_train += [RandomErasing()]
     transform_train = T.Compose(transform_train)
 
     # build test transformations
@@ -1,6 +1,7 @@
 # Copyright (c) EEEM071, University of Surrey
 
 import random
+import sys
 
 import numpy as np
 import torch
@@ -11,3 +12,14 @@ def set_random_seed(seed):
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+
+
+def peak_memory_mb():
+    """Peak resident memory of the current process in MB (nan if not available)"""
+    try:
+        import resource
+    except ImportError:  # not available on windows
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
@@ -1,29 +1,65 @@
 # Copyright (c) EEEM071, University of Surrey
 
 import torch
+import torchvision.transforms.functional as F
 
 
-def get_mean_and_std(dataloader, dataset):
-    # Compute the mean and std value of dataset.
-    mean = torch.zeros(3)
-    std = torch.zeros(3)
+class ImageStats:
+    """
+    Transform returning the (count, mean, M2) of every channel of an image, a
+    (3, C) float64 tensor, instead of the image. Used as the last transform of
+    a dataset, the statistics are computed in the dataloader workers and only
+    partial results are sent to the main process, see merge_stats.
+    """
+
+    def __call__(self, img):
+        if not isinstance(img, torch.Tensor):
+            img = F.pil_to_tensor(img)
+        x = img.flatten(1).double()
+        if not img.is_floating_point():
+            x /= 255
+        mean = x.mean(1)
+        m2 = (x - mean[:, None]).pow_(2).sum(1)
+        return torch.stack([torch.full_like(mean, x.size(1)), mean, m2])
+
+
+def batch_stats(imgs):
+    """Return the (count, mean, M2) of every channel of a float batch (B, C, H, W)"""
+    x = imgs.transpose(0, 1).flatten(1).double()
+    mean = x.mean(1)
+    m2 = (x - mean[:, None]).pow_(2).sum(1)
+    return torch.stack([torch.full_like(mean, x.size(1)), mean, m2])
+
+
+def merge_stats(stats):
+    """
+    Merge partial statistics with the parallel algorithm of Chan et al.
+    Args:
+    - stats (torch.Tensor): (N, 3, C) partial (count, mean, M2) of every channel.
+    """
+    count, mean, m2 = stats.unbind(1)
+    total = count.sum(0)
+    merged_mean = (count * mean).sum(0) / total
+    merged_m2 = m2.sum(0) + (count * (mean - merged_mean).pow(2)).sum(0)
+    return torch.stack([total, merged_mean, merged_m2])
+
+
+def get_mean_and_std(dataloader, dataset=None):
+    """
+    Compute the mean and std of every channel over all pixels of a dataset in one
+    streaming pass. The loader yields either float images (B, C, H, W), or the
+    partial statistics (B, 3, C) of a dataset transformed by ImageStats.
+    """
     print("==> Computing mean and std..")
-    for inputs, _, _ in dataloader:
-        for i in range(3):
-            mean[i] += inputs[:, i, :, :].mean()
-            std[i] += inputs[:, i, :, :].std()
-    mean.div_(len(dataset))
-    std.div_(len(dataset))
-    return mean, std
-
-
-def calculate_mean_and_std(dataset_loader, dataset_size):
-    mean = torch.zeros(3)
-    std = torch.zeros(3)
-    for data in dataset_loader:
-        now_batch_size, c, h, w = data[0].shape
-        mean += torch.sum(torch.mean(torch.mean(data[0], dim=3), dim=2), dim=0)
-        std += torch.sum(
-            torch.std(data[0].view(now_batch_size, c, h * w), dim=2), dim=0
-        )
-    return mean / dataset_size, std / dataset_size
+    total = None
+    for inputs, *_ in dataloader:
+        stats = inputs.double() if inputs.dim() == 3 else batch_stats(inputs)[None]
+        if total is not None:
+            stats = torch.cat([total[None], stats])
+        total = merge_stats(stats)
+    count, mean, m2 = total
+    return mean.float(), (m2 / count).sqrt().float()
+
+
+def calculate_mean_and_std(dataset_loader, dataset_size=None):
+    return get_mean_and_std(dataset_loader)
@@ -1,16 +1,33 @@
 # Copyright (c) EEEM071, University of Surrey
 
+import contextlib
 import os.path as osp
 import shutil
 import warnings
 from collections import OrderedDict
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 
 from .iotools import mkdir_if_missing
 
 
+def is_main_process():
+    """Whether this is rank 0 of torch.distributed, or the only process"""
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def autocast_context(precision, use_gpu):
+    """
+    Context running the ops that support it in reduced precision, e.g. bfloat16
+    on CPUs with native support, and a no-op for float32.
+    """
+    if precision == "float32":
+        return contextlib.nullcontext()
+    return torch.autocast("cuda" if use_gpu else "cpu", dtype=getattr(torch, precision))
+
+
 def save_checkpoint(state, save_dir, is_best=False, remove_module_from_keys=False):
     mkdir_if_missing(save_dir)
     if remove_module_from_keys:
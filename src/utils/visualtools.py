@@ -13,9 +13,8 @@ def visualize_ranked_results(distmat, dataset, save_dir="log/ranked_results", to
     Visualize ranked results
     Args:
     - distmat: distance matrix of shape (num_query, num_gallery).
-    - dataset: a 2-tuple containing (query, gallery), each contains a list of (img_path, pid, camid);
-               for imgreid, img_path is a string, while for vidreid, img_path is a tuple containing
-               a sequence of strings.
+    - dataset: a 2-tuple containing (query, gallery), each a ColumnarDataset of
+               (img_path, pid, camid).
     - save_dir: directory to save output images.
     - topk: int, denoting top-k images in the rank list to be visualized.
     """
@@ -52,21 +51,15 @@ def visualize_ranked_results(distmat, dataset, save_dir="log/ranked_results", to
 
     for q_idx in range(num_q):
         qimg_path, qpid, qcamid = query[q_idx]
-        if isinstance(qimg_path, tuple) or isinstance(qimg_path, list):
-            qdir = osp.join(save_dir, osp.basename(qimg_path[0]))
-        else:
-            qdir = osp.join(save_dir, osp.basename(qimg_path))
+        qdir = osp.join(save_dir, osp.basename(qimg_path))
         mkdir_if_missing(qdir)
         _cp_img_to(qimg_path, qdir, rank=0, prefix="query")
 
-        rank_idx = 1
-        for g_idx in indices[q_idx, :]:
-            gimg_path, gpid, gcamid = gallery[g_idx]
-            invalid = (qpid == gpid) & (qcamid == gcamid)
-            if not invalid:
-                _cp_img_to(gimg_path, qdir, rank=rank_idx, prefix="gallery")
-                rank_idx += 1
-                if rank_idx > topk:
-                    break
+        # skip gallery samples of the same identity and camera, reading only
+        # the pid and camid columns
+        order = indices[q_idx, :]
+        invalid = (gallery.pids[order] == qpid) & (gallery.camids[order] == qcamid)
+        for rank_idx, g_idx in enumerate(order[~invalid][:topk], 1):
+            _cp_img_to(gallery.path(g_idx), qdir, rank=rank_idx, prefix="gallery")
 
     print("Done")
@@ -0,0 +1,114 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import pytest
+import torch
+import torch.nn as nn
+
+from src.losses import CrossEntropyLoss
+from src.models import PartialFC
+from src.optimizers import init_optimizer
+
+
+class Head(nn.Module):
+    def __init__(self, num_classes=100, feature_dim=16):
+        super().__init__()
+        self.fc = nn.Linear(8, feature_dim)
+        self.classifier = PartialFC(feature_dim, num_classes, sample_rate=0.1)
+
+    def forward(self, x, targets):
+        return self.classifier(self.fc(x), targets)
+
+
+def backward(model, x, targets):
+    """Return the mask of the classes scored, from the sparse gradient"""
+    loss = CrossEntropyLoss(model.classifier.num_classes, use_gpu=False)(
+        model(x, targets), PartialFC.sampled_targets(targets)
+    )
+    loss.backward()
+    grad = model.classifier.weight.grad
+    assert grad.is_sparse and model.classifier.bias.grad.is_sparse
+    scored = torch.zeros(model.classifier.num_classes, dtype=torch.bool)
+    scored[grad.coalesce().indices()[0]] = True
+    return scored
+
+
+@pytest.mark.parametrize("optim", ["adam", "amsgrad", "sgd", "rmsprop"])
+def test_unsampled_rows_are_unchanged(optim):
+    torch.manual_seed(0)
+    model = Head()
+    optimizer = init_optimizer(model, optim=optim, lr=0.1, weight_decay=5e-4)
+    x, targets = torch.randn(8, 8), torch.arange(8) // 2
+
+    for _ in range(2):
+        weight = model.classifier.weight.detach().clone()
+        bias = model.classifier.bias.detach().clone()
+        optimizer.zero_grad()
+        scored = backward(model, x, targets)
+        optimizer.step()
+
+        assert scored.sum() == model.classifier.num_sampled
+        assert torch.equal(model.classifier.weight[~scored], weight[~scored])
+        assert torch.equal(model.classifier.bias[~scored], bias[~scored])
+        assert not torch.equal(model.classifier.weight[scored], weight[scored])
+        # the other parameters are stepped by the optimizer as usual
+        assert model.fc.weight.grad is not None
+        assert model.classifier.weight.grad is None
+
+
+@pytest.mark.parametrize("optim", ["adam", "amsgrad", "sgd", "rmsprop"])
+def test_sampled_rows_match_torch_optim(optim):
+    # a row gets the updates torch.optim would give it, counted from its first
+    # scoring: the bias correction of Adam follows the steps of the row
+    torch.manual_seed(0)
+    model = Head()
+    optimizer = init_optimizer(
+        model, optim=optim, lr=0.1, weight_decay=5e-4, sgd_nesterov=True
+    )
+    classifier = model.classifier
+    x = torch.randn(8, 8)
+
+    references = {}
+    for targets in (torch.arange(8) // 2, torch.arange(8) // 2 + 4, torch.arange(8)):
+        optimizer.zero_grad()
+        scored = backward(model, x, targets)
+        grads = classifier.weight.grad.to_dense()
+        for row in scored.nonzero().squeeze(1).tolist():
+            if row not in references:
+                weight = classifier.weight[row].detach().clone().requires_grad_()
+                references[row] = (weight, _reference_optimizer(weight, optim))
+            weight, reference = references[row]
+            weight.grad = grads[row].clone()
+            reference.step()
+        optimizer.step()
+
+    for row, (weight, _) in references.items():
+        torch.testing.assert_close(classifier.weight[row], weight.detach())
+
+
+def _reference_optimizer(weight, optim):
+    if optim in ("adam", "amsgrad"):
+        return torch.optim.Adam(
+            [weight], lr=0.1, weight_decay=5e-4, amsgrad=optim == "amsgrad"
+        )
+    if optim == "sgd":
+        return torch.optim.SGD(
+            [weight], lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=True
+        )
+    return torch.optim.RMSprop(
+        [weight], lr=0.1, momentum=0.9, weight_decay=5e-4, alpha=0.99
+    )
+
+
+def test_row_state_is_saved_with_the_optimizer():
+    torch.manual_seed(0)
+    model = Head()
+    optimizer = init_optimizer(model, optim="adam", lr=0.1)
+    x, targets = torch.randn(8, 8), torch.arange(8) // 2
+    scored = backward(model, x, targets)
+    optimizer.step()
+
+    state = optimizer.state_dict()["state"]
+    row_steps = [s["row_step"] for s in state.values() if "row_step" in s]
+    assert len(row_steps) == 2
+    for row_step in row_steps:
+        assert torch.equal(row_step, scored.float())
@@ -0,0 +1,48 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import itertools
+
+import numpy as np
+import pytest
+
+from src.datasets import ColumnarDataset
+from src.samplers import DistributedRandomIdentitySampler, RandomIdentitySampler
+
+
+def make_dataset(num_pids=200, seed=0):
+    rng = np.random.RandomState(seed)
+    pids = np.repeat(np.arange(num_pids), rng.randint(1, 17, num_pids))
+    return ColumnarDataset.from_arrays(
+        np.zeros(0, np.uint8), np.zeros(len(pids) + 1, np.int64), pids, pids * 0
+    )
+
+
+@pytest.mark.parametrize("batch_size", [32, 30])
+def test_distributed_sampler_splits_the_global_plan(batch_size):
+    dataset = make_dataset()
+    num_instances, num_replicas = 4, 3
+    samplers = [
+        DistributedRandomIdentitySampler(
+            dataset,
+            batch_size,
+            num_instances,
+            num_replicas=num_replicas,
+            rank=rank,
+            seed=7,
+        )
+        for rank in range(num_replicas)
+    ]
+    for sampler in samplers:
+        sampler.set_epoch(2)
+    plans = [np.array(list(sampler)) for sampler in samplers]
+
+    # every rank gets the same number of samples, as announced by len
+    assert all(len(plan) == len(samplers[0]) > 0 for plan in plans)
+    # whole P x K batches of the global plan, disjoint across ranks
+    plan_batch_size = batch_size // num_instances * num_instances
+    batches = [set(map(tuple, plan.reshape(-1, plan_batch_size))) for plan in plans]
+    for batches_a, batches_b in itertools.combinations(batches, 2):
+        assert not batches_a & batches_b
+    full = RandomIdentitySampler(dataset, batch_size, num_instances, seed=7)
+    full = full.plan_epoch(2).reshape(-1, plan_batch_size)
+    assert set().union(*batches) <= set(map(tuple, full))
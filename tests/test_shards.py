@@ -0,0 +1,92 @@
+# Copyright (c) EEEM071, University of Surrey
+
+import os.path as osp
+
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms as T
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from src.image_cache import ImageCache
+from src.shards import ShardedImageDataset, read_shard_index, write_shards
+
+
+def make_images(tmp_path, num_pids=6, num_imgs=3):
+    data = []
+    for pid in range(num_pids):
+        for i in range(num_imgs):
+            img_path = str(tmp_path / f"{pid:04d}_c{i:03d}.jpg")
+            Image.new("RGB", (8, 4), (pid * 40, i * 80, 0)).save(img_path)
+            data.append((img_path, pid, i))
+    return data
+
+
+def test_sharded_dataset_reads_every_image_from_arrays(tmp_path):
+    data = make_images(tmp_path)
+    shard_dir = str(tmp_path / "shards")
+    write_shards(data, shard_dir, "train", shard_size=1, group_pids=True)
+    shard_indexes = [
+        read_shard_index(shard_dir, "train"),
+        read_shard_index(shard_dir, "train", pid_offset=6, camid_offset=3),
+    ]
+    dataset = ShardedImageDataset(shard_indexes, seed=0)
+
+    locations = dataset.locations
+    assert locations.shard_ids.dtype == np.int32
+    assert locations.offsets.dtype == locations.lengths.dtype == np.int64
+    assert all(isinstance(indexes, np.ndarray) for _, indexes in dataset.shards)
+
+    # every image once per shard index, with the bytes of its file
+    read = dict(dataset._read(range(len(dataset.shards))))
+    assert sorted(read) == list(range(2 * len(data)))
+    for index, img_bytes in read.items():
+        img_path, _, _ = dataset.dataset[index]
+        with open(img_path, "rb") as f:
+            assert img_bytes == f.read()
+
+    keep = [1, 4, 20]
+    subset = locations.subset(keep)
+    assert [subset[i] for i in range(len(keep))] == [locations[i] for i in keep]
+
+
+@pytest.mark.parametrize("batch_size", [16, 18])
+def test_sharded_batches_are_whole_identity_groups(tmp_path, batch_size):
+    # one image per shard, so the images of an identity are spread over workers
+    data = make_images(tmp_path, num_pids=12, num_imgs=5)
+    shard_dir = str(tmp_path / "shards")
+    write_shards(data, shard_dir, "train", shard_size=1, group_pids=True)
+    num_instances = 4
+    dataset = ShardedImageDataset(
+        [read_shard_index(shard_dir, "train")],
+        transform=T.ToTensor(),
+        batch_size=batch_size,
+        num_instances=num_instances,
+        buffer_size=8,
+        seed=0,
+    )
+    assert dataset.batch_size == 16
+    loader = DataLoader(
+        dataset, batch_size=dataset.batch_size, num_workers=2, drop_last=True
+    )
+
+    num_batches = 0
+    for _, pids, _, _ in loader:
+        counts = torch.unique(pids, return_counts=True)[1]
+        assert counts.tolist() == [num_instances] * (16 // num_instances)
+        num_batches += 1
+    assert num_batches > 0
+
+
+def test_image_cache_looks_up_paths(tmp_path):
+    data = make_images(tmp_path)
+    img_paths = [img_path for img_path, _, _ in data][::-1]
+    cache = ImageCache(str(tmp_path / "cache"), img_paths, 4, 8, workers=1)
+
+    assert len(cache) == len(data)
+    assert osp.join(str(tmp_path), "missing.jpg") not in cache
+    for img_path in img_paths:
+        assert img_path in cache
+        expected = np.asarray(Image.open(img_path).convert("RGB").resize((8, 4)))
+        np.testing.assert_array_equal(cache[img_path], expected)
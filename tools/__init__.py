@@ -0,0 +1 @@
+# Copyright (c) EEEM071, University of Surrey
@@ -0,0 +1,54 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Pack the train, query and gallery images of a dataset into shards, which main.py
+reads with --shard-dir instead of the image files.
+
+Usage: python -m tools.pack_shards --root datasets -d veri --shard-dir shards
+For VehicleID, the query and gallery of every --test_size are packed separately:
+    python -m tools.pack_shards -d vehicleID --test_size 800 1600 2400
+"""
+
+import argparse
+import os.path as osp
+
+from src.datasets import init_imgreid_dataset
+from src.shards import test_split_name, write_shards
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="./datasets")
+    parser.add_argument("-d", "--datasets", type=str, nargs="+", required=True)
+    parser.add_argument("--shard-dir", type=str, required=True)
+    parser.add_argument("--test_size", type=int, nargs="+", default=[800])
+    parser.add_argument(
+        "--shard-size", type=int, default=64, help="size of a shard in MB"
+    )
+    args = parser.parse_args()
+
+    for name in args.datasets:
+        shard_dir = osp.join(args.shard_dir, name)
+        test_sizes = args.test_size if name == "vehicleID" else args.test_size[:1]
+        for i, test_size in enumerate(test_sizes):
+            dataset = init_imgreid_dataset(
+                root=args.root, name=name, test_size=test_size
+            )
+            if i == 0:
+                write_shards(
+                    dataset.train,
+                    shard_dir,
+                    "train",
+                    shard_size=args.shard_size * 1024**2,
+                    group_pids=True,
+                )
+            for split in ("query", "gallery"):
+                write_shards(
+                    getattr(dataset, split),
+                    shard_dir,
+                    test_split_name(split, name, test_size),
+                    shard_size=args.shard_size * 1024**2,
+                )
+
+
+if __name__ == "__main__":
+    main()
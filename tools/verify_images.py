@@ -0,0 +1,70 @@
+# Copyright (c) EEEM071, University of Surrey
+"""
+Decode every image of a dataset in parallel and write the ones that cannot be
+read to its quarantine list (<root>/.quarantine/<dataset class>.txt), which the
+dataset classes skip when they are loaded. Images quarantined by a previous run
+are checked again, so repaired files are released.
+
+Usage: python -m tools.verify_images --root datasets -d veri vehicleID -j 8
+"""
+
+import argparse
+import os
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from src.datasets import init_imgreid_dataset
+from src.utils.iotools import mkdir_if_missing
+
+
+def verify_image(img_path):
+    """Return why an image cannot be decoded, or None if it can"""
+    try:
+        with Image.open(img_path) as img:
+            img.convert("RGB")
+    except (OSError, SyntaxError, ValueError) as e:
+        # PIL raises SyntaxError for some malformed headers
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="./datasets")
+    parser.add_argument("-d", "--datasets", type=str, nargs="+", required=True)
+    parser.add_argument("--test_size", type=int, nargs="+", default=[800])
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    for name in args.datasets:
+        test_sizes = args.test_size if name == "vehicleID" else args.test_size[:1]
+        img_paths = set()
+        for test_size in test_sizes:
+            dataset = init_imgreid_dataset(
+                root=args.root, name=name, verbose=False, test_size=test_size
+            )
+            for data in (dataset.train, dataset.query, dataset.gallery):
+                img_paths.update(osp.abspath(img_path) for img_path, _, _ in data)
+        img_paths = sorted(img_paths | dataset.load_quarantine())
+
+        print(f"=> Verifying {len(img_paths)} images of {name}")
+        with ProcessPoolExecutor(args.workers) as executor:
+            errors = list(executor.map(verify_image, img_paths, chunksize=64))
+        quarantined = []
+        for img_path, error in zip(img_paths, errors):
+            if error is not None:
+                print(f"{img_path}: {error}")
+                quarantined.append(img_path)
+
+        mkdir_if_missing(osp.dirname(dataset.quarantine_path))
+        with open(dataset.quarantine_path, "w") as f:
+            f.writelines(f"{img_path}\n" for img_path in quarantined)
+        print(
+            f'=> {len(quarantined)} unreadable images written to "{dataset.quarantine_path}"'
+        )
+
+
+if __name__ == "__main__":
+    main()